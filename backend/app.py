@@ -1,37 +1,115 @@
-from flask import Flask, jsonify, request
+from flask import Flask, Response, jsonify, request, stream_with_context
 from flask_cors import CORS
 import openai
 from dotenv import load_dotenv
 import os
 import json
 import logging
-import re
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import codec
+import corpus
+import edits
+import metrics
+import shards
+import storage
+from llm_cache import ResponseCache, request_key
+from chunking import estimate_tokens, merge_filtered_steps, split_steps
+from compaction import compact_steps, compaction_options
+from edits import EditError, find_in_history, history_hash, replace_in_history
+from leakage import scan_history
+from lazy_history import LazyHistory, build_offsets
+from lru import LRUCache
+from metrics import phase
+from search import StepIndex
+from sessions import SessionStore
+from streaming import StreamAccumulator, message_events, sse_event
+from trajectory import build_sanitized_steps, extract_content_text, iter_steps, num_steps, sanitized_step
 
 load_dotenv()
 logging.basicConfig(level=logging.INFO)
 
 app = Flask(__name__)
+app.json = codec.JSONProvider(app)
 CORS(app)
+metrics.init_app(app)
 
 client = openai.OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
-def extract_content_text(content):
-    """
-    Extract text from content field which can be either:
-    - A string: "some text"
-    - A list of objects: [{"type": "text", "text": "some text"}]
-    
-    Returns the text as a string, or empty string if content is None/invalid.
-    """
-    if content is None:
-        return ""
-    if isinstance(content, str):
-        return content
-    if isinstance(content, list) and len(content) > 0:
-        first_item = content[0]
-        if isinstance(first_item, dict):
-            return first_item.get("text", "")
-    return ""
+# Parsed trajectories kept in memory between edits, see /sessions
+sessions = SessionStore(
+    max_entries=int(os.getenv("SESSION_MAX_DOCS", "16")),
+    max_bytes=int(os.getenv("SESSION_MAX_BYTES", str(512 * 1024 * 1024))),
+)
+
+# Map-reduce semantic filtering, see _chunked_filter(). Filter requests whose
+# prompt is estimated above CHAT_CHUNK_TOKENS, and requests of no stated mode
+# above CHAT_MAX_PROMPT_TOKENS, are split into windows of CHAT_CHUNK_TOKENS
+# queried with at most CHAT_MAP_CONCURRENCY parallel calls; "chat" mode
+# requests above CHAT_MAX_PROMPT_TOKENS are refused.
+CHAT_CHUNK_TOKENS = int(os.getenv("CHAT_CHUNK_TOKENS", "60000"))
+CHAT_MAX_PROMPT_TOKENS = int(os.getenv("CHAT_MAX_PROMPT_TOKENS", "200000"))
+CHAT_MAP_CONCURRENCY = int(os.getenv("CHAT_MAP_CONCURRENCY", "4"))
+
+# Wall-clock budget in seconds for one /replace or /batch_edit pass over a
+# document, and the number of matches a /replace preview lists
+REPLACE_TIME_BUDGET = float(os.getenv("REPLACE_TIME_BUDGET", "10"))
+REPLACE_PREVIEW_MAX_MATCHES = int(os.getenv("REPLACE_PREVIEW_MAX_MATCHES", "1000"))
+
+# Bulk thought generation, see /generate_thoughts
+THOUGHT_MAX_CONCURRENCY = int(os.getenv("THOUGHT_MAX_CONCURRENCY", "8"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "5"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "1.0"))
+
+# Upstream LLM responses keyed by the full request, see llm_cache.py
+llm_cache = ResponseCache(
+    path=os.getenv("LLM_CACHE_PATH", os.path.join("data", "llm_cache.sqlite")),
+    ttl=float(os.getenv("LLM_CACHE_TTL", str(7 * 24 * 3600))),
+    max_entries=int(os.getenv("LLM_CACHE_MAX_ENTRIES", "10000")),
+    memory_entries=int(os.getenv("LLM_CACHE_MEMORY_ENTRIES", "256")),
+)
+
+# Observation compaction for prompts (see compaction.py), enabled per request
+# with `compact`, or for every request with COMPACT_PROMPTS=1
+COMPACT_PROMPTS = os.getenv("COMPACT_PROMPTS", "0") == "1"
+COMPACT_DEFAULTS = {
+    "dedupe": True,
+    "max_observation_chars": int(os.getenv("COMPACT_MAX_OBSERVATION_CHARS", "20000")),
+    "token_budget": int(os.getenv("COMPACT_TOKEN_BUDGET", "0")) or None,
+}
+
+# Sanitized steps and rendered system prompt per history content hash, see _chat_prompt()
+prompt_cache = LRUCache(
+    max_entries=int(os.getenv("PROMPT_CACHE_MAX_ENTRIES", "32")),
+    max_bytes=int(os.getenv("PROMPT_CACHE_MAX_BYTES", str(256 * 1024 * 1024))),
+)
+
+# Search indexes of inline documents per history content hash, see /search;
+# sessions keep their own index up to date across edits
+search_indexes = LRUCache(
+    max_entries=int(os.getenv("SEARCH_INDEX_MAX_ENTRIES", "16")),
+    max_bytes=int(os.getenv("SEARCH_INDEX_MAX_BYTES", str(512 * 1024 * 1024))),
+)
+SEARCH_MAX_RESULTS = int(os.getenv("SEARCH_MAX_RESULTS", "200"))
+
+# Byte offsets of the history entries of files under data/, see /steps
+history_offsets = LRUCache(max_entries=int(os.getenv("STEPS_INDEX_MAX_FILES", "64")))
+STEPS_MAX_LIMIT = int(os.getenv("STEPS_MAX_LIMIT", "200"))
+
+# Record offsets of JSONL shards under data/, see /shards/ingest
+shard_indexes = LRUCache(max_entries=int(os.getenv("SHARD_INDEX_MAX_FILES", "32")))
+SHARD_PAGE_MAX = int(os.getenv("SHARD_PAGE_MAX", "1000"))
+
+# Compression of files written by /save: "gzip", "zstd" or empty for none
+SAVE_COMPRESSION = os.getenv("SAVE_COMPRESSION", "") or None
+
+# Summaries of the trajectories under data/ for /corpus/stats, rescanned in the
+# background every CORPUS_SCAN_INTERVAL seconds once the index is first used
+# (0 to scan on every query instead)
+corpus_index = corpus.CorpusIndex('data', os.getenv("CORPUS_INDEX_PATH", os.path.join("data", "corpus.sqlite")))
+CORPUS_SCAN_INTERVAL = float(os.getenv("CORPUS_SCAN_INTERVAL", "60"))
 
 SYSTEM_PROMPT = """
 # 🔎 Identity,  Goals, and Setting
@@ -100,203 +178,599 @@ tools = [
     }
 ]
 
+
+def _stream_response(stream, done_payload):
+    """
+    Forward a streamed completion as Server-Sent Events (see streaming.py).
+    `done_payload(accumulator)` builds the final `done` event.
+    """
+    def generate():
+        accumulator = StreamAccumulator()
+        try:
+            for chunk in stream:
+                text = accumulator.add(chunk)
+                if text:
+                    yield sse_event("delta", {"content": text})
+            for name, arguments in accumulator.parsed_tool_calls():
+                yield sse_event("tool_call", {"name": name, "arguments": arguments})
+            yield sse_event("done", done_payload(accumulator))
+        except Exception as e:
+            logging.error(f"An error occurred while streaming from OpenAI: {e}")
+            yield sse_event("error", {"error": str(e)})
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _message_response(message, done=None):
+    """Answer with a complete message as SSE (see streaming.py) for streaming clients."""
+    return Response(
+        stream_with_context(message_events(message, done)),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+def _create_completion(**request_kwargs):
+    """client.chat.completions.create(), timed as the "upstream" phase and counted in /metrics."""
+    try:
+        with phase("upstream"):
+            response = client.chat.completions.create(**request_kwargs)
+    except Exception as e:
+        metrics.UPSTREAM_REQUESTS.inc(("error",))
+        metrics.UPSTREAM_ERRORS.inc((type(e).__name__,))
+        raise
+    metrics.UPSTREAM_REQUESTS.inc(("ok",))
+    return response
+
+
+def _complete(request_kwargs, use_cache=True):
+    """Run a non-streaming chat completion and return its message as a dict, cached."""
+    def call():
+        response = _create_completion(**request_kwargs)
+        return response.choices[0].message.to_dict()
+
+    if not use_cache:
+        return call()
+    return llm_cache.get_or_compute(request_key(**request_kwargs), call)
+
+
+def _completion_response(request_kwargs, payload, stream=False, use_cache=True):
+    """
+    Answer a route with `payload(message)` for the completion of `request_kwargs`,
+    as JSON or, when `stream`, as Server-Sent Events. Cached responses are
+    answered without calling upstream; streamed ones are cached once complete.
+    """
+    if not stream:
+        return jsonify(payload(_complete(request_kwargs, use_cache)))
+
+    key = request_key(**request_kwargs) if use_cache else None
+    cached = llm_cache.get(key) if key else None
+    if cached is not None:
+        return _message_response(cached, payload(cached))
+
+    response = _create_completion(stream=True, **request_kwargs)
+
+    def done(accumulator):
+        message = accumulator.message()
+        if key:
+            llm_cache.put(key, message)
+        return payload(message)
+
+    return _stream_response(response, done)
+
+
 @app.route('/')
 def index():
     return "Trajectory Viewer Backend"
 
-@app.route('/chat', methods=['POST'])
-def chat():
-    data = request.json
+
+def _chat_prompt(history, history_key=None, compact=None):
+    """
+    Return (sanitized_trajectory, system_prompt, compaction_stats) for
+    `history`, with observations compacted by the `compact` options if given.
+
+    All three are cached under the history's content hash (`history_key` if the
+    caller already knows it) and the compaction options, so follow-up turns on
+    an unchanged trajectory skip rebuilding the steps and re-rendering the
+    prompt. Reusing the cached string also keeps the system prompt
+    byte-identical across turns, which lets the provider's prompt prefix cache
+    hit.
+    """
+    if history_key is None:
+        history_key = history_hash(history if isinstance(history, list) else [])
+    cache_key = (history_key, tuple(sorted(compact.items())) if compact else None)
+    cached = prompt_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    # Build sanitized steps from history-only representation
+    with phase("build_steps"):
+        sanitized_trajectory = build_sanitized_steps(history)
+    compaction_stats = None
+    if compact:
+        with phase("compact"):
+            sanitized_trajectory, compaction_stats = compact_steps(sanitized_trajectory, **compact)
+
+    # Format the trajectory for the prompt
+    with phase("format_prompt"):
+        formatted_trajectory = json.dumps(sanitized_trajectory, indent=2)
+        prompt_with_trajectory = SYSTEM_PROMPT.format(trajectory=formatted_trajectory)
+
+    result = (sanitized_trajectory, prompt_with_trajectory, compaction_stats)
+    prompt_cache.put(cache_key, result, len(prompt_with_trajectory))
+    return result
+
+
+def filter_window_requests(sanitized_trajectory, messages):
+    """
+    Completion requests for a map-reduced apply_semantic_filter query: one per
+    token-budgeted window of steps, with the filter tool forced.
+    """
+    windows = split_steps(sanitized_trajectory, CHAT_CHUNK_TOKENS)
+    requests = []
+    for number, window in enumerate(windows, start=1):
+        prompt = SYSTEM_PROMPT.format(trajectory=json.dumps(window, indent=2))
+        prompt += f"\n(This is part {number} of {len(windows)} of the trajectory. Only filter the steps listed above.)\n"
+        requests.append({
+            "model": "gpt-5",
+            "messages": [{"role": "system", "content": prompt}] + messages,
+            "tools": tools,
+            "tool_choice": {"type": "function", "function": {"name": "apply_semantic_filter"}},
+        })
+    return requests
+
+
+def merge_filter_messages(window_messages):
+    """Merge the per-window answers of a chunked filter into one tool-call message."""
+    results = []
+    for message in window_messages:
+        for tool_call in message.get("tool_calls") or []:
+            if tool_call["function"]["name"] == "apply_semantic_filter":
+                results.append(json.loads(tool_call["function"]["arguments"]).get("filtered_steps", []))
+                break
+
+    arguments = {"filtered_steps": merge_filtered_steps(results)}
+    return {
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [{
+            "id": "chunked_filter",
+            "type": "function",
+            "function": {"name": "apply_semantic_filter", "arguments": json.dumps(arguments)},
+        }],
+        "chunks": len(window_messages),
+    }
+
+
+def _chunked_filter(sanitized_trajectory, messages, use_cache=True):
+    """
+    Map-reduce an apply_semantic_filter request over a trajectory too large for
+    one prompt: every window of steps is queried with the filter tool forced,
+    and the per-window filtered_steps are merged into a single tool call.
+    """
+    requests = filter_window_requests(sanitized_trajectory, messages)
+    logging.info(f"Chunked filter over {len(sanitized_trajectory)} steps in {len(requests)} windows")
+    # Timed here: phases of the pool's threads are not attributed to the request
+    with phase("upstream"), ThreadPoolExecutor(max_workers=max(1, CHAT_MAP_CONCURRENCY)) as pool:
+        window_messages = list(pool.map(lambda r: _complete(r, use_cache), requests))
+    return merge_filter_messages(window_messages)
+
+
+def _with_compaction(payload, compaction_stats):
+    """Wrap a response payload builder to also report the prompt compaction stats."""
+    if compaction_stats is None:
+        return payload
+    return lambda message: {**payload(message), "compaction": compaction_stats}
+
+
+def prepare_chat(data):
+    """
+    Validate a /chat body and plan the upstream work, independent of the web
+    framework serving it (see asgi.py).
+
+    Returns (plan, error) where error is a (message, status) pair or None. The
+    plan holds the `sanitized_trajectory` and user `messages` for a chunked
+    filter, or the single completion `request` otherwise.
+    """
     messages = data.get('messages', [])
     history = data.get('history')
+    doc_id = data.get('doc_id')
 
     if not messages:
-        return jsonify({"error": "No messages provided"}), 400
+        return None, ("No messages provided", 400)
+
+    if doc_id is not None:
+        session = sessions.get(doc_id)
+        if session is None:
+            return None, (f"Unknown doc_id: {doc_id}", 404)
+        with session.lock:
+            history = session.history
+            history_key = session.content_hash()
+    else:
+        history_key = None
 
-    # Build sanitized steps from history-only representation
-    sanitized_trajectory = []
     try:
-        if isinstance(history, list) and len(history) > 1:
-            # Step 0 from history[1] (do not include history[0] in display)
-            step_zero_content = history[1].get("content") if isinstance(history[1], dict) else None
-            step_zero_text = extract_content_text(step_zero_content)
-
-            sanitized_trajectory.append({
-                "step": 0,
-                "content": step_zero_text
-            })
-
-            # Subsequent steps are pairs: assistant at even i and tool at i+1
-            # history[2] & history[3] => step 1, history[4] & history[5] => step 2, ...
-            # Start at i=2 and advance by 2
-            i = 2
-            step_number = 1
-            while i + 1 < len(history):
-                assistant = history[i] if isinstance(history[i], dict) else {}
-                tool_msg = history[i + 1] if isinstance(history[i + 1], dict) else {}
-
-                thought = assistant.get('thought', '')
-                action = assistant.get('action', '')
-                observation_full = extract_content_text(tool_msg.get('content'))
-                observation = observation_full
-                try:
-                    # Extract after the delimiter if present
-                    if 'OBSERVATION:\n' in observation_full:
-                        observation = observation_full.split('OBSERVATION:\n', 1)[1]
-                except Exception:
-                    pass
-
-                sanitized_trajectory.append({
-                    "step": step_number,
-                    "thought": thought,
-                    "action": action,
-                    "observation": observation,
-                })
-
-                i += 2
-                step_number += 1
+        compact = compaction_options(data.get('compact', COMPACT_PROMPTS), COMPACT_DEFAULTS)
+    except ValueError as e:
+        return None, (str(e), 400)
+    try:
+        sanitized_trajectory, prompt_with_trajectory, compaction_stats = _chat_prompt(history, history_key, compact)
     except Exception as e:
         logging.error(f"Failed to build sanitized trajectory from history: {e}")
-        return jsonify({"error": "Invalid history format"}), 400
+        return None, ("Invalid history format", 400)
+
+    plan = {
+        "stream": bool(data.get('stream')),
+        "use_cache": data.get('cache', True) is not False,
+        "sanitized_trajectory": sanitized_trajectory,
+        "messages": messages,
+        "payload": _with_compaction(lambda message: message, compaction_stats),
+    }
 
-    # Format the trajectory for the prompt
-    formatted_trajectory = json.dumps(sanitized_trajectory, indent=2)
-    prompt_with_trajectory = SYSTEM_PROMPT.format(trajectory=formatted_trajectory)
+    # Filter requests are map-reduced past CHAT_CHUNK_TOKENS. A request of no
+    # stated mode (the chat panel's) is map-reduced as a filter only once its
+    # prompt cannot fit in one; "chat" requests have to fit in one
+    prompt_tokens = estimate_tokens(prompt_with_trajectory)
+    metrics.observe_prompt_tokens(prompt_tokens)
+    mode = data.get('mode')
+    chunked = data.get('chunked')
+    if chunked is None:
+        if mode == 'filter':
+            chunked = prompt_tokens > CHAT_CHUNK_TOKENS
+        else:
+            chunked = mode != 'chat' and prompt_tokens > CHAT_MAX_PROMPT_TOKENS
+    if not chunked and prompt_tokens > CHAT_MAX_PROMPT_TOKENS:
+        return None, (
+            f"Trajectory too large: the prompt is estimated at {prompt_tokens} tokens, above the limit of "
+            f"{CHAT_MAX_PROMPT_TOKENS}. Send it as a filter request, or pass \"compact\" "
+            "to shorten the observations.", 413)
+    plan["chunked"] = bool(chunked)
 
     # Prepend the system prompt to the messages
     full_messages = [{"role": "system", "content": prompt_with_trajectory}] + messages
+    plan["request"] = {
+        "model": "gpt-5",
+        "messages": full_messages,
+        "tools": tools,
+        "tool_choice": "auto",
+    }
+    return plan, None
+
+
+@app.route('/chat', methods=['POST'])
+def chat():
+    plan, error = prepare_chat(request.json)
+    if error is not None:
+        return jsonify({"error": error[0]}), error[1]
+
+    if plan["chunked"]:
+        try:
+            message = plan["payload"](_chunked_filter(plan["sanitized_trajectory"], plan["messages"], plan["use_cache"]))
+        except Exception as e:
+            logging.error(f"An error occurred during chunked filtering: {e}")
+            return jsonify({"error": str(e)}), 500
+        return _message_response(message) if plan["stream"] else jsonify(message)
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-5",
-            messages=full_messages,
-            tools=tools,
-            tool_choice="auto",
-        )
-        return jsonify(response.choices[0].message.to_dict())
+        return _completion_response(plan["request"], plan["payload"], plan["stream"], plan["use_cache"])
     except Exception as e:
         logging.error(f"An error occurred while communicating with OpenAI: {e}")
         return jsonify({"error": str(e)}), 500
 
+
+def _load_request_history(data, missing_error):
+    """
+    Resolve the history an edit request addresses: a session named by `doc_id`,
+    or an inline JSON document passed as `content`.
+
+    Returns (session, history). Raises EditError if neither can be loaded.
+    """
+    doc_id = data.get('doc_id')
+    if doc_id is not None:
+        session = sessions.get(doc_id)
+        if session is None:
+            raise EditError(f"Unknown doc_id: {doc_id}", 404)
+        return session, session.history
+
+    content = data.get('content')
+    if not content:
+        raise EditError(missing_error)
+    try:
+        with phase("load"):
+            doc = codec.loads(content)
+    except Exception as e:
+        raise EditError(f"Input content is not valid JSON: {e}")
+    history = doc.get('history') if isinstance(doc, dict) else None
+    if not isinstance(history, list):
+        raise EditError("No history array found in JSON")
+    return None, history
+
+
+def _wants_patch(data):
+    return data.get('response_format') == 'patch'
+
+
+def _edit_ops(data, session):
+    """
+    The list edits record their JSON Patch ops into: always for sessions, whose
+    search index is updated from them, otherwise only when the client wants a patch.
+    """
+    return [] if session is not None or _wants_patch(data) else None
+
+
+def _edit_response(data, session, history, ops, **extra):
+    """
+    Answer an edit: the session's new version, or the re-serialized document.
+
+    With `response_format: "patch"` the document is replaced by the JSON Patch
+    `ops` that produced it and the history_hash() of the result.
+    """
+    if session is not None:
+        session.record_edit(ops)
+        extra = {"doc_id": session.doc_id, "version": session.version, **extra}
+    if _wants_patch(data):
+        content_hash = session.content_hash() if session is not None else history_hash(history)
+        return jsonify({"patch": ops, "content_hash": content_hash, **extra})
+    if session is not None:
+        return jsonify(extra)
+    with phase("serialize"):
+        modified_content = codec.dumps({"history": history}, codec.compact_option(data.get('json_format')))
+    return jsonify({"modified_content": modified_content, **extra})
+
+
+@app.route('/sessions', methods=['POST'])
+def create_session():
+    """
+    Open a session from an uploaded document (`content`), from a file saved
+    under data/ (`file`, read back with its compression and journal), or from
+    one record of a JSONL shard under data/ (`shard` with `record`, its number,
+    or `record_id`; see /shards/ingest).
+    """
+    data = request.json
+    content = data.get('content')
+    filename = data.get('file')
+    shard = data.get('shard')
+
+    if not content and not filename and not shard:
+        return jsonify({"error": "Missing required fields: content"}), 400
+
+    saved = None
+    origin = None
+    try:
+        if shard:
+            index = _shard_index(shard)
+            number = index.find(data.get('record'), data.get('record_id'))
+            if number in index.errors:
+                return jsonify({"error": f"Record {number} is not a valid trajectory", "errors": index.errors[number]}), 400
+            line = shards.read_line(index, number)
+            doc = {"history": shards.record_history(codec.loads(line))[1]}
+            size = index.record_size(number)
+            # The line's hash is checked again by /shards/export
+            origin = {"shard": shard, "record": number, "id": index.ids[number], "sha256": shards.line_hash(line)}
+        elif filename:
+            # Prevent directory traversal
+            if ".." in filename or "/" in filename:
+                return jsonify({"error": "Invalid filename"}), 400
+            filepath = os.path.join('data', filename)
+            doc, saved = storage.read_saved(filepath)
+            size = saved["size"]
+        else:
+            with phase("load"):
+                doc = codec.loads(content)
+            size = len(content)
+    except FileNotFoundError:
+        return jsonify({"error": f"File not found: {shard or filename}"}), 404
+    except shards.ShardError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": f"Input content is not valid JSON: {e}"}), 400
+
+    history = doc.get('history') if isinstance(doc, dict) else None
+    if not isinstance(history, list):
+        return jsonify({"error": "No history array found in JSON"}), 400
+
+    session = sessions.create(history, size)
+    if session is None:
+        return jsonify({"error": f"Document exceeds the session memory cap of {sessions.max_bytes} bytes"}), 413
+    if saved is not None and saved["journal_entries"] is not None:
+        # Saving back to the same file can then append to its journal
+        session.saved[filepath] = {"version": 0, "snapshot": saved["snapshot"], "journal_entries": saved["journal_entries"],
+                                   "size": saved["size"]}
+    session.origin = origin
+
+    logging.info(f"Session {session.doc_id} created - size: {size}, history entries: {len(history)}")
+    return jsonify(session.describe())
+
+
+@app.route('/sessions/<doc_id>', methods=['GET'])
+def get_session(doc_id):
+    session = sessions.get(doc_id)
+    if session is None:
+        return jsonify({"error": f"Unknown doc_id: {doc_id}"}), 404
+    return jsonify(session.describe())
+
+
+def _switch_version(doc_id, move):
+    data = request.get_json(silent=True) or {}
+    session = sessions.get(doc_id)
+    if session is None:
+        return jsonify({"error": f"Unknown doc_id: {doc_id}"}), 404
+    with session.lock:
+        ops = session.undo() if move == "undo" else session.redo()
+        if ops is None:
+            return jsonify({"error": f"Nothing to {move}"}), 409
+        payload = session.describe()
+        if _wants_patch(data):
+            payload.update(patch=ops, content_hash=session.content_hash())
+        return jsonify(payload)
+
+
+@app.route('/sessions/<doc_id>/undo', methods=['POST'])
+def undo_session(doc_id):
+    """
+    Go back to the version before the session's last edit (or undo). The
+    response is the session's description; with `response_format: "patch"` it
+    also carries the JSON Patch that took the document there.
+    """
+    return _switch_version(doc_id, "undo")
+
+
+@app.route('/sessions/<doc_id>/redo', methods=['POST'])
+def redo_session(doc_id):
+    """Re-apply the edit the last undo took back, see /sessions/<doc_id>/undo."""
+    return _switch_version(doc_id, "redo")
+
+
+@app.route('/sessions/<doc_id>', methods=['DELETE'])
+def delete_session(doc_id):
+    if not sessions.delete(doc_id):
+        return jsonify({"error": f"Unknown doc_id: {doc_id}"}), 404
+    return jsonify({"message": f"Session {doc_id} closed"})
+
+
 @app.route('/replace', methods=['POST'])
 def replace():
+    """
+    Regex / literal replace across every string in the history.
+
+    Takes a single search_term/replace_term, or a `replacements` list of
+    {search_term, replace_term} objects applied in order in one pass over the
+    document; the response then carries a per-pattern `counts` list.
+    """
     data = request.json
     content = data.get('content')
+    doc_id = data.get('doc_id')
     search_term = data.get('search_term')
     replace_term = data.get('replace_term')
-
-    logging.info(f"Replace request - search_term length: {len(search_term) if search_term else 0}, replace_term length: {len(replace_term) if replace_term else 0}")
-    logging.info(f"Search term (raw): {repr(search_term)}")
-    logging.info(f"Replace term (raw): {repr(replace_term)}")
+    multi = data.get('replacements') is not None
+
+    if multi:
+        logging.info(f"Replace request - {len(data['replacements']) if isinstance(data['replacements'], list) else 0} replacement pairs")
+    else:
+        logging.info(f"Replace request - search_term length: {len(search_term) if search_term else 0}, replace_term length: {len(replace_term) if replace_term else 0}")
+        logging.info(f"Search term (raw): {repr(search_term)}")
+        logging.info(f"Replace term (raw): {repr(replace_term)}")
     logging.info(f"Content length: {len(content) if content else 0}")
 
-    if not all([content, search_term, replace_term]):
+    preview = bool(data.get('preview'))
+    if not (content or doc_id) or not (multi or (search_term and (replace_term or preview))):
         return jsonify({"error": "Missing required fields"}), 400
 
     try:
-        # Parse JSON and perform replacements only within the history object
-        doc = json.loads(content)
-        history = doc.get('history')
-        if not isinstance(history, list):
-            return jsonify({"error": "No history array found in JSON"}), 400
-
-        # Interpret common escaped newline sequences in the pattern to match actual text
-        # so users can search for "\\n" and match real newlines.
-        normalized_pattern = (
-            search_term
-            .replace('\\r\\n', '\r\n')
-            .replace('\\n', '\n')
-            .replace('\\r', '\r')
-        )
-        logging.info(f"Normalized regex pattern -> actual text: {repr(normalized_pattern)}")
-
-        pattern = re.compile(normalized_pattern, re.DOTALL)
-
-        replacements = 0
-
-        def replace_in_value(value):
-            nonlocal replacements
-            if isinstance(value, str):
-                new_value, count = pattern.subn(replace_term, value)
-                replacements += count
-                return new_value
-            if isinstance(value, list):
-                return [replace_in_value(v) for v in value]
-            if isinstance(value, dict):
-                return {k: replace_in_value(v) for k, v in value.items()}
-            return value
-
-        new_history = replace_in_value(history)
+        max_matches = data.get('max_matches', REPLACE_PREVIEW_MAX_MATCHES)
+        if isinstance(max_matches, bool) or not isinstance(max_matches, int) or max_matches <= 0:
+            raise EditError("max_matches must be a positive integer")
+
+        # Perform replacements only within the history object
+        session, history = _load_request_history(data, "Missing required fields")
+
+        pairs = edits.replacement_pairs(data, require_replace_term=not preview)
+        replacer = edits.compile_replacements(pairs)
+        deadline = time.monotonic() + REPLACE_TIME_BUDGET
+        ops = _edit_ops(data, session)
+        for matcher in replacer.matchers:
+            logging.info(f"Normalized regex pattern -> actual text: {repr(matcher.pattern)} ({type(matcher).__name__})")
+
+        if preview:
+            # Report match locations without rewriting or re-serializing anything
+            if session is not None:
+                with session.lock:
+                    history = session.history
+            if not multi:
+                matches, total = find_in_history(history, replacer.matchers[0], max_matches, deadline=deadline)
+                return jsonify({"matches": matches, "total": total, "truncated": total > len(matches)})
+            matches, totals = [], []
+            for index, matcher in enumerate(replacer.matchers):
+                found, total = find_in_history(history, matcher, max_matches - len(matches), deadline=deadline)
+                matches.extend({**m, "pattern": index} for m in found)
+                totals.append(total)
+            return jsonify({"matches": matches, "total": sum(totals), "counts": totals,
+                            "truncated": sum(totals) > len(matches)})
+
+        extra = {"counts": replacer.counts} if multi else {}
+        if session is not None:
+            with session.lock:
+                with phase("edit"):
+                    new_history, replacements = replace_in_history(session.history, replacer, ops, deadline)
+                if replacements == 0:
+                    return jsonify({"error": "Search term pattern did not match any history fields"}), 400
+                session.history = new_history
+                return _edit_response(data, session, new_history, ops, replacements=replacements, **extra)
+
+        with phase("edit"):
+            new_history, replacements = replace_in_history(history, replacer, ops, deadline)
 
         if replacements == 0:
             return jsonify({"error": "Search term pattern did not match any history fields"}), 400
 
-        modified_content = json.dumps({"history": new_history}, indent=2)
-        return jsonify({"modified_content": modified_content})
-    except re.error as rex:
-        logging.error(f"Regex error during replacement: {rex}")
-        return jsonify({"error": f"Invalid regex: {str(rex)}"}), 400
+        return _edit_response(data, None, new_history, ops, **extra)
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
     except Exception as e:
         logging.error(f"An error occurred during replacement: {e}")
         return jsonify({"error": str(e)}), 500
 
+
 @app.route('/replace_thought', methods=['POST'])
 def replace_thought():
     data = request.json
     content = data.get('content')
+    doc_id = data.get('doc_id')
     original_index = data.get('original_index')  # 1-based step index (step j)
     old_thought = data.get('old_thought', '')
     new_thought = data.get('new_thought', '')
 
-    if content is None or original_index is None or new_thought is None:
-        return jsonify({"error": "Missing required fields: content, original_index, new_thought"}), 400
+    if (content is None and doc_id is None) or original_index is None or new_thought is None:
+        return jsonify({"error": "Missing required fields: content or doc_id, original_index, new_thought"}), 400
 
     try:
-        doc = json.loads(content)
-    except Exception as e:
-        return jsonify({"error": f"Input content is not valid JSON: {e}"}), 400
+        session, history = _load_request_history(data, "Missing required fields: content or doc_id, original_index, new_thought")
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
 
     try:
-        history = doc.get('history')
-        if not isinstance(history, list):
-            return jsonify({"error": "No history array found in JSON"}), 400
-
-        step_j = int(original_index)
-        if step_j <= 0:
-            return jsonify({"error": "original_index must refer to a step >= 1 (step 0 is user instructions)"}), 400
-
-        assistant_idx = 2 * step_j
-        tool_idx = assistant_idx + 1
-        if assistant_idx < 0 or tool_idx >= len(history):
-            return jsonify({"error": f"original_index {original_index} is out of range for history pairs"}), 400
-
-        assistant_msg = history[assistant_idx]
-        if not isinstance(assistant_msg, dict):
-            return jsonify({"error": f"history[{assistant_idx}] is not an object"}), 400
-
-        current_thought = assistant_msg.get('thought', '')
-        if old_thought and current_thought.replace('\r\n', '\n') != str(old_thought).replace('\r\n', '\n'):
-            return jsonify({"error": "Current thought does not match the provided old_thought. Edit may be outdated."}), 409
-
-        # Update assistant message's thought and content
-        assistant_msg['thought'] = new_thought
-        assistant_msg['content'] = new_thought
-
-        modified_content = json.dumps({"history": history}, indent=2)
-        return jsonify({"modified_content": modified_content})
+        ops = _edit_ops(data, session)
+        if session is not None:
+            with session.lock:
+                # Edit a copy so the previous version stays intact for undo
+                new_history = list(session.history)
+                with phase("edit"):
+                    edits.replace_thought(new_history, original_index, new_thought, old_thought, ops)
+                session.history = new_history
+                return _edit_response(data, session, new_history, ops)
+
+        with phase("edit"):
+            edits.replace_thought(history, original_index, new_thought, old_thought, ops)
+        return _edit_response(data, None, history, ops)
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
     except Exception as e:
         logging.error(f"Error in replace_thought: {e}")
         return jsonify({"error": str(e)}), 500
 
+
 @app.route('/save', methods=['POST'])
 def save():
+    """
+    Write a document (`content`) or session (`doc_id`) to data/<filename>.
+
+    Files are replaced atomically and compressed with `compression` ("gzip" or
+    "zstd", default SAVE_COMPRESSION). A session saved to the same file before
+    only appends its new edits to the file's journal, see storage.py.
+    """
     data = request.json
     content = data.get('content')
+    doc_id = data.get('doc_id')
     filename = data.get('filename')
+    compression = data.get('compression', SAVE_COMPRESSION)
 
-    logging.info(f"Save request - filename: {filename}, content length: {len(content) if content else 0}")
+    logging.info(f"Save request - filename: {filename}, doc_id: {doc_id}, content length: {len(content) if content else 0}")
 
-    if not all([content, filename]):
+    if not all([content or doc_id, filename]):
         return jsonify({"error": "Missing required fields"}), 400
 
     try:
@@ -309,25 +783,81 @@ def save():
             return jsonify({"error": "Invalid filename"}), 400
 
         filepath = os.path.join('data', filename)
-        with open(filepath, 'w') as f:
-            f.write(content)
-        
-        logging.info(f"File saved successfully to {filepath}")
-        return jsonify({"message": f"File saved successfully to {filepath}"})
+        if doc_id is not None:
+            session = sessions.get(doc_id)
+            if session is None:
+                return jsonify({"error": f"Unknown doc_id: {doc_id}"}), 404
+            # Sessions are only serialized when saved, and only in full when needed
+            with session.lock, phase("write"):
+                filepath, mode = storage.save_session(
+                    session, filepath, compression, codec.compact_option(data.get('json_format')))
+        else:
+            filepath = storage.compressed_path(filepath, compression)
+            with phase("write"):
+                storage.write_snapshot(filepath, content, compression)
+            mode = "snapshot"
+
+        logging.info(f"File saved successfully to {filepath} ({mode})")
+        corpus_index.wake()
+        return jsonify({"message": f"File saved successfully to {filepath}", "path": filepath, "mode": mode})
+    except storage.StorageError as se:
+        return jsonify({"error": str(se)}), 400
     except Exception as e:
         logging.error(f"An error occurred during save: {e}")
         return jsonify({"error": str(e)}), 500
 
-@app.route('/generate_thought', methods=['POST'])
-def generate_thought():
+
+@app.route('/batch_edit', methods=['POST'])
+def batch_edit():
+    """
+    Apply an ordered list of replace / replace_thought / remove_step operations
+    in one pass, all-or-nothing. Step indices refer to the document before the
+    batch, see edits.apply_operations().
+    """
     data = request.json
-    current_step = data.get('current_step')
-    previous_steps = data.get('previous_steps', [])
-    tool_call = data.get('tool_call', '')
+    content = data.get('content')
+    doc_id = data.get('doc_id')
+    operations = data.get('operations')
 
-    if not current_step:
-        return jsonify({"error": "Current step is required"}), 400
+    if (content is None and doc_id is None) or not isinstance(operations, list) or not operations:
+        return jsonify({"error": "Missing required fields: content or doc_id, operations"}), 400
 
+    try:
+        session, history = _load_request_history(data, "Missing required fields: content or doc_id, operations")
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
+
+    results = []
+    ops = _edit_ops(data, session)
+    deadline = time.monotonic() + REPLACE_TIME_BUDGET
+    try:
+        if session is not None:
+            with session.lock:
+                with phase("edit"):
+                    session.history = edits.apply_operations(session.history, operations, results, ops, deadline)
+                return _edit_response(data, session, session.history, ops, results=results)
+
+        with phase("edit"):
+            new_history = edits.apply_operations(history, operations, results, ops, deadline)
+        return _edit_response(data, None, new_history, ops, results=results)
+    except EditError as ee:
+        logging.info(f"Batch edit rejected after {len(results)} operations: {ee.message}")
+        return jsonify({"error": ee.message, "failed_operation": len(results), "results": results}), ee.status
+    except Exception as e:
+        logging.error(f"Error in batch_edit: {e}")
+        return jsonify({"error": str(e)}), 500
+
+
+THOUGHT_SYSTEM_PROMPT = "You are an AI assistant helping to generate thoughts for trajectory steps. Generate concise, first-person thoughts that explain the reasoning behind tool calls."
+
+
+def thought_request(tool_call, previous_steps):
+    """
+    Completion request generating the thought for a step about to call
+    `tool_call`, given the previous steps as sent by the frontend: step 0 as
+    {"isStepZero": True, "content": ...}, later steps with "originalIndex",
+    "thought", "action" and "observation".
+    """
     # Create the prompt for thought generation
     prompt = f"""You are the assistant and you are just about calling this tool:
 
@@ -350,62 +880,500 @@ Previous steps context:
             observation = step.get('observation', '')
             prompt += f"\nStep {step.get('originalIndex', i)}:\nThought: {thought}\nAction: {action}\nObservation: {observation}\n"
 
+    return {
+        "model": "gpt-5",
+        "messages": [
+            {"role": "system", "content": THOUGHT_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "temperature": 1.0,
+    }
+
+
+def prepare_thought(data):
+    """
+    Validate a /generate_thought body and build its completion request.
+    Returns (plan, error) like prepare_chat().
+    """
+    current_step = data.get('current_step')
+    previous_steps = data.get('previous_steps', [])
+    tool_call = data.get('tool_call', '')
+
+    if not current_step:
+        return None, ("Current step is required", 400)
+
+    compaction_stats = None
     try:
-        response = client.chat.completions.create(
-            model="gpt-5",
-            messages=[
-                {"role": "system", "content": "You are an AI assistant helping to generate thoughts for trajectory steps. Generate concise, first-person thoughts that explain the reasoning behind tool calls."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=1.0
-        )
-        
-        generated_thought = response.choices[0].message.content
-        return jsonify({"generated_thought": generated_thought})
+        compact = compaction_options(data.get('compact', COMPACT_PROMPTS), COMPACT_DEFAULTS)
+    except ValueError as e:
+        return None, (str(e), 400)
+    if compact:
+        previous_steps, compaction_stats = compact_steps(previous_steps, index_key="originalIndex", **compact)
+
+    return {
+        "stream": bool(data.get('stream')),
+        # Thoughts are sampled, so regenerating must not replay the last one
+        "use_cache": data.get('cache') is True,
+        "request": thought_request(tool_call, previous_steps),
+        "payload": _with_compaction(thought_payload, compaction_stats),
+    }, None
+
+
+def thought_payload(message):
+    return {"generated_thought": message.get("content")}
+
+
+@app.route('/generate_thought', methods=['POST'])
+def generate_thought():
+    plan, error = prepare_thought(request.json)
+    if error is not None:
+        return jsonify({"error": error[0]}), error[1]
+
+    try:
+        return _completion_response(plan["request"], plan["payload"], plan["stream"], plan["use_cache"])
     except Exception as e:
         logging.error(f"An error occurred while generating thought: {e}")
         return jsonify({"error": str(e)}), 500
 
+
+def _retry_delay(error, attempt):
+    """Seconds to wait before retrying: the server's Retry-After, else jittered exponential backoff."""
+    response = getattr(error, 'response', None)
+    retry_after = response.headers.get('retry-after') if response is not None else None
+    try:
+        return float(retry_after)
+    except (TypeError, ValueError):
+        return LLM_RETRY_BASE_DELAY * (2 ** attempt) * (0.5 + random.random())
+
+
+def _complete_with_retry(request_kwargs, use_cache=True):
+    """_complete() retried with backoff on rate-limit errors, up to LLM_MAX_RETRIES times."""
+    for attempt in range(LLM_MAX_RETRIES + 1):
+        try:
+            return _complete(request_kwargs, use_cache)
+        except openai.RateLimitError as e:
+            if attempt == LLM_MAX_RETRIES:
+                raise
+            delay = _retry_delay(e, attempt)
+            metrics.UPSTREAM_RETRIES.inc()
+            logging.warning(f"Rate limited by OpenAI, retrying in {delay:.1f}s (attempt {attempt + 1}/{LLM_MAX_RETRIES})")
+            time.sleep(delay)
+
+
+@app.route('/generate_thoughts', methods=['POST'])
+def generate_thoughts():
+    """
+    Generate thoughts for many steps of one document and apply them in a single
+    write. Each step's context is built server-side from the history, the same
+    way the frontend builds it for /generate_thought, and generations run
+    concurrently (at most `concurrency`, capped by THOUGHT_MAX_CONCURRENCY).
+    Steps whose generation fails are reported and left unchanged.
+    """
+    data = request.json
+    content = data.get('content')
+    doc_id = data.get('doc_id')
+    indices = data.get('indices')
+    use_cache = data.get('cache') is True
+
+    if (content is None and doc_id is None) or not isinstance(indices, list) or not indices:
+        return jsonify({"error": "Missing required fields: content or doc_id, indices"}), 400
+
+    try:
+        session, history = _load_request_history(data, "Missing required fields: content or doc_id, indices")
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
+
+    if session is not None:
+        with session.lock:
+            history = list(session.history)
+    steps = list(iter_steps(history))
+
+    try:
+        indices = sorted({int(j) for j in indices})
+    except (TypeError, ValueError):
+        return jsonify({"error": "indices must be integers"}), 400
+    try:
+        concurrency = min(int(data.get('concurrency') or THOUGHT_MAX_CONCURRENCY), THOUGHT_MAX_CONCURRENCY)
+    except (TypeError, ValueError):
+        return jsonify({"error": "concurrency must be an integer"}), 400
+    for j in indices:
+        if j <= 0 or j >= len(steps):
+            return jsonify({"error": f"original_index {j} is out of range for history pairs"}), 400
+
+    # The frontend's step shape: step 0 flagged, later steps keyed by originalIndex
+    context = [{"isStepZero": True, "content": steps[0].text}] + [
+        {"originalIndex": s.number, "thought": s.thought, "action": s.action, "observation": s.observation}
+        for s in steps[1:]
+    ]
+
+    compaction_stats = None
+    try:
+        compact = compaction_options(data.get('compact', COMPACT_PROMPTS), COMPACT_DEFAULTS)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    if compact:
+        context, compaction_stats = compact_steps(context, index_key="originalIndex", **compact)
+
+    def generate(j):
+        message = _complete_with_retry(thought_request(steps[j].action, context[:j]), use_cache)
+        if not message.get("content"):
+            raise ValueError("Model returned an empty thought")
+        return message["content"]
+
+    results = []
+    operations = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+        futures = {j: pool.submit(generate, j) for j in indices}
+        for j, future in futures.items():
+            try:
+                thought = future.result()
+            except Exception as e:
+                logging.error(f"An error occurred while generating thought for step {j}: {e}")
+                results.append({"original_index": j, "error": str(e)})
+                continue
+            results.append({"original_index": j, "generated_thought": thought})
+            # old_thought guards against the session being edited meanwhile
+            operations.append({"op": "replace_thought", "original_index": j,
+                               "old_thought": steps[j].thought, "new_thought": thought})
+
+    if not operations:
+        return jsonify({"error": "No thoughts could be generated", "results": results}), 502
+
+    extra = {"compaction": compaction_stats} if compaction_stats is not None else {}
+    ops = _edit_ops(data, session)
+    try:
+        if session is not None:
+            with session.lock:
+                session.history = edits.apply_operations(session.history, operations, [], ops)
+                return _edit_response(data, session, session.history, ops, results=results, **extra)
+
+        new_history = edits.apply_operations(history, operations, [], ops)
+        return _edit_response(data, None, new_history, ops, results=results, **extra)
+    except EditError as ee:
+        return jsonify({"error": ee.message, "results": results}), ee.status
+
+
 @app.route('/remove_step', methods=['POST'])
 def remove_step():
     data = request.json
     content = data.get('content')
+    doc_id = data.get('doc_id')
     original_index = data.get('original_index')  # 1-based step index (step j)
 
-    if content is None or original_index is None:
-        return jsonify({"error": "Missing required fields: content, original_index"}), 400
+    if (content is None and doc_id is None) or original_index is None:
+        return jsonify({"error": "Missing required fields: content or doc_id, original_index"}), 400
 
     try:
-        doc = json.loads(content)
+        session, history = _load_request_history(data, "Missing required fields: content or doc_id, original_index")
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
+
+    try:
+        ops = _edit_ops(data, session)
+        if session is not None:
+            with session.lock:
+                # Edit a copy so the previous version stays intact for undo
+                new_history = list(session.history)
+                with phase("edit"):
+                    edits.remove_step(new_history, original_index, ops)
+                session.history = new_history
+                return _edit_response(data, session, new_history, ops)
+
+        with phase("edit"):
+            edits.remove_step(history, original_index, ops)
+        return _edit_response(data, None, history, ops)
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
     except Exception as e:
-        return jsonify({"error": f"Input content is not valid JSON: {e}"}), 400
+        logging.error(f"Error in remove_step: {e}")
+        return jsonify({"error": str(e)}), 500
+
 
+@app.route('/search', methods=['POST'])
+def search():
+    """
+    Ranked search over the steps' thought / action / observation text (see
+    search.py for the query syntax). Answers with the matching step indices,
+    best first, and the character offsets to highlight in each field.
+    """
+    data = request.json
+    query = data.get('query')
+    if not isinstance(query, str) or not query.strip() or (data.get('content') is None and data.get('doc_id') is None):
+        return jsonify({"error": "Missing required fields: content or doc_id, query"}), 400
+
+    started = time.perf_counter()
     try:
-        history = doc.get('history')
-        if not isinstance(history, list):
-            return jsonify({"error": "No history array found in JSON"}), 400
+        limit = min(int(data.get('limit') or 50), SEARCH_MAX_RESULTS)
+        session, history = _load_request_history(data, "Missing required fields: content or doc_id, query")
+        if session is not None:
+            with session.lock:
+                if session.search_index is None:
+                    session.search_index = StepIndex(session.history)
+                else:
+                    session.search_index.refresh(session.history)
+                with phase("search"):
+                    results, total = session.search_index.search(query, limit, bool(data.get('require_all')))
+        else:
+            key = history_hash(history)
+            index = search_indexes.get(key)
+            if index is None:
+                index = StepIndex(history)
+                search_indexes.put(key, index, len(data['content']))
+            with phase("search"):
+                results, total = index.search(query, limit, bool(data.get('require_all')))
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
+    except ValueError as ve:
+        return jsonify({"error": str(ve)}), 400
+
+    took_ms = round((time.perf_counter() - started) * 1000, 2)
+    logging.info(f"Search {query!r}: {total} steps in {took_ms} ms")
+    return jsonify({"results": results, "total": total, "took_ms": took_ms})
+
+
+@app.route('/leakage', methods=['POST'])
+def leakage():
+    """
+    Local, LLM-free scan for lines of a gold patch (unified diff, `gold_patch`)
+    in the steps of a document or session, see leakage.py. Only the steps it
+    flags need a closer look, e.g. with /chat.
+    """
+    data = request.json
+    gold_patch = data.get('gold_patch')
+    if not gold_patch or (data.get('content') is None and data.get('doc_id') is None):
+        return jsonify({"error": "Missing required fields: content or doc_id, gold_patch"}), 400
+    kinds = data.get('kinds') or ["added", "removed"]
+
+    started = time.perf_counter()
+    try:
+        session, history = _load_request_history(data, "Missing required fields: content or doc_id, gold_patch")
+        if session is not None:
+            with session.lock:
+                history = list(session.history)
+    except EditError as ee:
+        return jsonify({"error": ee.message}), ee.status
+
+    with phase("scan"):
+        matches, hunks = scan_history(history, gold_patch, kinds)
+    if not hunks:
+        return jsonify({"error": "gold_patch contains no unified diff hunks"}), 400
+    took_ms = round((time.perf_counter() - started) * 1000, 2)
+    steps = sorted({m["step"] for m in matches})
+    logging.info(f"Leakage scan: {len(hunks)} hunks, {len(matches)} matches in {len(steps)} steps, {took_ms} ms")
+    return jsonify({"matches": matches, "steps": steps, "hunks": len(hunks), "took_ms": took_ms})
+
+
+def _file_offsets(filename):
+    """HistoryOffsets of data/<filename>, rebuilt when the file has changed."""
+    path = os.path.join('data', filename)
+    offsets = history_offsets.get(path)
+    if offsets is None or not offsets.is_current():
+        offsets = build_offsets(path)
+        history_offsets.put(path, offsets)
+    return offsets
+
+
+def _shard_index(filename):
+    """ShardIndex of data/<filename>, rebuilt when the file has changed. Raises ShardError."""
+    # Prevent directory traversal
+    if not filename or ".." in filename or "/" in filename:
+        raise shards.ShardError("Invalid filename")
+    if not filename.endswith(shards.SHARD_SUFFIXES):
+        raise shards.ShardError(f"Shard files must end in {', '.join(shards.SHARD_SUFFIXES)}")
+    path = os.path.join('data', filename)
+    index = shard_indexes.get(path)
+    if index is None or not index.is_current():
+        with phase("index"):
+            index = shards.build_index(path)
+        shard_indexes.put(path, index)
+    return index
+
+
+@app.route('/shards/ingest', methods=['POST'])
+def ingest_shard():
+    """
+    Read a JSONL shard under data/ (`file`, optionally gzip or zstd
+    compressed) record by record and validate every record's history. Answers
+    the record counts and a page (`offset`, `limit`) of the records with their
+    number, id and problems; valid records can then be opened with
+    POST /sessions {"shard", "record"}.
+    """
+    data = request.json or {}
+    try:
+        offset = max(0, int(data.get('offset') or 0))
+        limit = max(0, min(int(data.get('limit') or 100), SHARD_PAGE_MAX))
+    except (TypeError, ValueError):
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    try:
+        index = _shard_index(data.get('file'))
+    except FileNotFoundError:
+        return jsonify({"error": f"File not found: {data.get('file')}"}), 404
+    except (shards.ShardError, storage.StorageError) as e:
+        return jsonify({"error": str(e)}), 400
+
+    page = [
+        {"record": n, "id": index.ids[n], "valid": n not in index.errors, **({"errors": index.errors[n]} if n in index.errors else {})}
+        for n in range(offset, min(offset + limit, len(index)))
+    ]
+    return jsonify({
+        "file": data.get('file'),
+        "records": len(index),
+        "valid": len(index) - len(index.errors),
+        "invalid": len(index.errors),
+        "offset": offset,
+        "page": page,
+    })
+
+
+@app.route('/shards/export', methods=['POST'])
+def export_shard():
+    """
+    Write a JSONL shard under data/ (`file`) to `output` (default: the shard
+    itself) with the records edited in sessions replaced by the sessions'
+    current history. The sessions are those opened from the shard, or the
+    ones listed in `doc_ids`. The shard is streamed record by record and the
+    output written atomically, compressed as `compression` or its suffix asks.
+    """
+    data = request.json or {}
+    filename = data.get('file')
+    output = data.get('output') or filename
+    try:
+        index = _shard_index(filename)
+        if ".." in output or "/" in output or not output.endswith(shards.SHARD_SUFFIXES):
+            raise shards.ShardError("Invalid output filename")
+    except FileNotFoundError:
+        return jsonify({"error": f"File not found: {filename}"}), 404
+    except shards.ShardError as e:
+        return jsonify({"error": str(e)}), 400
+
+    doc_ids = data.get('doc_ids')
+    if doc_ids is None:
+        selected = [s for s in sessions.values() if s.origin is not None and s.origin["shard"] == filename]
+    else:
+        selected = []
+        for doc_id in doc_ids:
+            session = sessions.get(doc_id)
+            if session is None:
+                return jsonify({"error": f"Unknown doc_id: {doc_id}"}), 404
+            if session.origin is None or session.origin["shard"] != filename:
+                return jsonify({"error": f"Session {doc_id} was not opened from {filename}"}), 400
+            selected.append(session)
+
+    histories = {}
+    origins = {}
+    for session in selected:
+        with session.lock:
+            # Shallow copy: edits replace entries, they never change them
+            histories[session.origin["record"]] = list(session.history)
+        origins[session.origin["record"]] = session.origin["sha256"]
+
+    compression = data.get('compression', storage.compression_of(output))
+    try:
+        with phase("write"):
+            records, replaced, written = shards.export_shard(
+                index.path, os.path.join('data', output), histories, compression, origins)
+    except (shards.ShardError, storage.StorageError) as e:
+        return jsonify({"error": str(e)}), 400
+    if output == filename:
+        # The exported records are now the sessions' origins
+        for session in selected:
+            session.origin["sha256"] = written[session.origin["record"]]
+    logging.info(f"Exported {records} records of {filename} to data/{output}, {replaced} edited")
+    return jsonify({"path": os.path.join('data', output), "records": records, "replaced": replaced})
+
+
+@app.route('/steps', methods=['GET'])
+def steps():
+    """
+    A page of sanitized steps (the shape /chat sends to the model) of a session
+    (`doc_id`) or of a trajectory file under data/ (`file`). Plain files are
+    not parsed as a whole: the entries of a page are read through a byte-offset
+    index of the history array built on first access.
+    """
+    doc_id = request.args.get('doc_id')
+    filename = request.args.get('file')
+    try:
+        offset = int(request.args.get('offset', 0))
+        limit = min(int(request.args.get('limit', 50)), STEPS_MAX_LIMIT)
+    except ValueError:
+        return jsonify({"error": "offset and limit must be integers"}), 400
+    if offset < 0 or limit < 0:
+        return jsonify({"error": "offset and limit must not be negative"}), 400
+    if not doc_id and not filename:
+        return jsonify({"error": "Missing required fields: doc_id or file"}), 400
+
+    if doc_id:
+        session = sessions.get(doc_id)
+        if session is None:
+            return jsonify({"error": f"Unknown doc_id: {doc_id}"}), 404
+        with session.lock:
+            history = session.history
+            total = session.num_steps()
+            page = [sanitized_step(history, j) for j in range(offset, min(offset + limit, total))]
+        return jsonify({"steps": page, "offset": offset, "total": total})
+
+    # Prevent directory traversal
+    if ".." in filename or "/" in filename:
+        return jsonify({"error": "Invalid filename"}), 400
+    try:
+        filepath = os.path.join('data', filename)
+        if storage.is_compressed(filepath) or storage.has_journal(filepath):
+            # Compressed or journaled files cannot be indexed in place; read them whole
+            history = storage.load_document(filepath).get('history') or []
+            total = num_steps(history)
+            page = [sanitized_step(history, j) for j in range(offset, min(offset + limit, total))]
+        else:
+            with LazyHistory(_file_offsets(filename)) as history:
+                total = num_steps(history)
+                page = [sanitized_step(history, j) for j in range(offset, min(offset + limit, total))]
+    except FileNotFoundError:
+        return jsonify({"error": f"File not found: {filename}"}), 404
+    except ValueError as e:
+        return jsonify({"error": f"Cannot read history from {filename}: {e}"}), 400
+    return jsonify({"steps": page, "offset": offset, "total": total})
+
+
+@app.route('/corpus/stats', methods=['GET'])
+def corpus_stats():
+    """
+    Statistics over the trajectories saved under data/, answered from the
+    corpus index (see corpus.py): file and step counts, the step count
+    distribution, observation sizes and calls per tool. With `tool`, also the
+    files calling it at least `min_calls` times; `min_steps` / `max_steps`
+    restrict everything to files of that length. `refresh=1` rescans first.
+    """
+    try:
+        tool = request.args.get('tool')
+        min_calls = int(request.args.get('min_calls', 1))
+        min_steps = request.args.get('min_steps', type=int)
+        max_steps = request.args.get('max_steps', type=int)
+        limit = max(1, min(int(request.args.get('limit', 100)), 1000))
+    except ValueError:
+        return jsonify({"error": "min_calls and limit must be integers"}), 400
 
-        step_j = int(original_index)
-        if step_j <= 0:
-            return jsonify({"error": "original_index must refer to a step >= 1 (cannot remove step 0)"}), 400
+    corpus_index.start(CORPUS_SCAN_INTERVAL)
+    scanned = corpus_index.scan() if request.args.get('refresh') == '1' else None
+    with phase("query"):
+        result = corpus_index.stats(tool, min_calls, min_steps, max_steps, limit)
+    if scanned is not None:
+        result["scan"] = scanned
+    return jsonify(result)
 
-        assistant_idx = 2 * step_j
-        tool_idx = assistant_idx + 1
-        if assistant_idx < 0 or tool_idx >= len(history):
-            return jsonify({"error": f"original_index {original_index} is out of range for history pairs"}), 400
 
-        # Remove tool first, then assistant to keep indices valid
-        history.pop(tool_idx)
-        history.pop(assistant_idx)
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Request, phase, payload, prompt and upstream metrics in the Prometheus text format, see metrics.py."""
+    return Response(metrics.REGISTRY.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route('/llm_cache/stats', methods=['GET'])
+def llm_cache_stats():
+    return jsonify(llm_cache.stats())
 
-        modified_content = json.dumps({"history": history}, indent=2)
-        return jsonify({"modified_content": modified_content})
-    except Exception as e:
-        logging.error(f"Error in remove_step: {e}")
-        return jsonify({"error": str(e)}), 500
 
 def create_app():
     return app
 
+
 if __name__ == '__main__':
     app.run(debug=True, port=5001)
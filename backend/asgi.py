@@ -0,0 +1,281 @@
+"""
+ASGI entry point serving the LLM-bound routes natively async:
+
+    uvicorn asgi:application --port 5001
+
+/chat and /generate_thought run on the event loop with the async OpenAI
+client, so many slow completions can be outstanding without holding a thread
+each. Their CPU-heavy JSON work (parsing the body, building the prompt) runs in
+a thread pool, as does every other route, which is served by the Flask app from
+create_app(). The behaviour of each route matches the WSGI app, including the
+Server-Timing header, request log line and /metrics of metrics.py.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from werkzeug.test import EnvironBuilder, run_wsgi_app
+
+import app as flask_app
+import codec
+import metrics
+from llm_cache import request_key
+from streaming import StreamAccumulator, message_events, sse_event
+
+# One client for the whole process so its HTTP connection pool is reused
+async_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+
+executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("ASGI_WORKER_THREADS", "8")),
+    thread_name_prefix="asgi-worker",
+)
+
+_CORS_HEADERS = [(b"access-control-allow-origin", b"*")]
+
+
+async def _run(func, *args):
+    # In a copy of the current context, so the pool thread's phases count for the request
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(executor, context.run, func, *args)
+
+
+async def _read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            break
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body"):
+            break
+    return b"".join(chunks)
+
+
+async def _send_json(send, payload, status=200):
+    with metrics.phase("encode"):
+        body = (await _run(codec.dumps_compact, payload)).encode("utf-8")
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())] + _CORS_HEADERS,
+    })
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _send_events(send, events):
+    """Send an (async) iterable of Server-Sent Event strings as they are produced."""
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")] + _CORS_HEADERS,
+    })
+    if hasattr(events, "__aiter__"):
+        async for event in events:
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    else:
+        for event in events:
+            await send({"type": "http.response.body", "body": event.encode("utf-8"), "more_body": True})
+    await send({"type": "http.response.body", "body": b""})
+
+
+async def _create_completion(**request_kwargs):
+    """Async counterpart of app._create_completion(), counted in /metrics."""
+    try:
+        response = await async_client.chat.completions.create(**request_kwargs)
+    except Exception as e:
+        metrics.UPSTREAM_REQUESTS.inc(("error",))
+        metrics.UPSTREAM_ERRORS.inc((type(e).__name__,))
+        raise
+    metrics.UPSTREAM_REQUESTS.inc(("ok",))
+    return response
+
+
+async def _complete(request_kwargs, use_cache=True):
+    """Async counterpart of app._complete(): the completion's message as a dict, cached."""
+    async def call():
+        response = await _create_completion(**request_kwargs)
+        return response.choices[0].message.to_dict()
+
+    if not use_cache:
+        return await call()
+    return await flask_app.llm_cache.aget_or_compute(request_key(**request_kwargs), call, executor)
+
+
+async def _stream_events(request_kwargs, payload, use_cache):
+    """Async counterpart of app._completion_response() for streaming clients."""
+    key = request_key(**request_kwargs) if use_cache else None
+    cached = await _run(flask_app.llm_cache.get, key) if key else None
+    if cached is not None:
+        for event in message_events(cached, payload(cached)):
+            yield event
+        return
+
+    accumulator = StreamAccumulator()
+    try:
+        with metrics.phase("upstream"):
+            stream = await _create_completion(stream=True, **request_kwargs)
+        async for chunk in stream:
+            text = accumulator.add(chunk)
+            if text:
+                yield sse_event("delta", {"content": text})
+        for name, arguments in accumulator.parsed_tool_calls():
+            yield sse_event("tool_call", {"name": name, "arguments": arguments})
+        message = accumulator.message()
+        if key:
+            await _run(flask_app.llm_cache.put, key, message)
+        yield sse_event("done", payload(message))
+    except Exception as e:
+        logging.error(f"An error occurred while streaming from OpenAI: {e}")
+        yield sse_event("error", {"error": str(e)})
+
+
+async def _answer(send, plan, error_label):
+    payload = plan["payload"]
+    if plan["stream"]:
+        await _send_events(send, _stream_events(plan["request"], payload, plan["use_cache"]))
+        return
+    try:
+        with metrics.phase("upstream"):
+            message = await _complete(plan["request"], plan["use_cache"])
+    except Exception as e:
+        logging.error(f"{error_label}: {e}")
+        await _send_json(send, {"error": str(e)}, 500)
+        return
+    await _send_json(send, payload(message))
+
+
+async def chat(data, send):
+    plan, error = await _run(flask_app.prepare_chat, data)
+    if error is not None:
+        await _send_json(send, {"error": error[0]}, error[1])
+        return
+
+    if plan["chunked"]:
+        requests = await _run(flask_app.filter_window_requests, plan["sanitized_trajectory"], plan["messages"])
+        semaphore = asyncio.Semaphore(max(1, flask_app.CHAT_MAP_CONCURRENCY))
+
+        async def bounded(request_kwargs):
+            async with semaphore:
+                return await _complete(request_kwargs, plan["use_cache"])
+
+        try:
+            with metrics.phase("upstream"):
+                window_messages = await asyncio.gather(*(bounded(r) for r in requests))
+        except Exception as e:
+            logging.error(f"An error occurred during chunked filtering: {e}")
+            await _send_json(send, {"error": str(e)}, 500)
+            return
+        message = plan["payload"](flask_app.merge_filter_messages(window_messages))
+        if plan["stream"]:
+            await _send_events(send, message_events(message))
+        else:
+            await _send_json(send, message)
+        return
+
+    await _answer(send, plan, "An error occurred while communicating with OpenAI")
+
+
+async def generate_thought(data, send):
+    plan, error = await _run(flask_app.prepare_thought, data)
+    if error is not None:
+        await _send_json(send, {"error": error[0]}, error[1])
+        return
+    await _answer(send, plan, "An error occurred while generating thought")
+
+
+ASYNC_ROUTES = {
+    "/chat": chat,
+    "/generate_thought": generate_thought,
+}
+
+
+def _call_wsgi(scope, body):
+    """Run the Flask app for one buffered request. Returns (status, headers, body)."""
+    builder = EnvironBuilder(
+        path=scope["path"],
+        method=scope["method"],
+        query_string=scope.get("query_string", b"").decode("latin-1"),
+        headers=[(k.decode("latin-1"), v.decode("latin-1")) for k, v in scope.get("headers", [])],
+        data=body,
+    )
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    app_iter, status, headers = run_wsgi_app(wsgi_app, environ, buffered=True)
+    try:
+        return status, headers, b"".join(app_iter)
+    finally:
+        if hasattr(app_iter, "close"):
+            app_iter.close()
+
+
+async def _serve_async(handler, scope, body, send):
+    """Run an async route, timed and counted like the Flask routes are by metrics.init_app()."""
+    timer, token = metrics.start_timer(scope["path"])
+    # Filled in from the messages sent; response body bytes stay None for streams
+    response = {"status": None, "total": None, "bytes": 0}
+
+    async def timed_send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["total"] = total = time.perf_counter() - timer.started
+            if (b"content-type", b"text/event-stream") in message["headers"]:
+                response["bytes"] = None
+            if metrics.SERVER_TIMING:
+                server_timing = (b"server-timing", timer.server_timing(total).encode("latin-1"))
+                message = dict(message, headers=message["headers"] + [server_timing])
+        elif response["bytes"] is not None:
+            response["bytes"] += len(message.get("body", b""))
+        await send(message)
+
+    try:
+        try:
+            with metrics.phase("parse"):
+                data = await _run(codec.loads, body or b"{}")
+        except ValueError as e:
+            await _send_json(timed_send, {"error": f"Request body is not valid JSON: {e}"}, 400)
+            return
+        if not isinstance(data, dict):
+            await _send_json(timed_send, {"error": "Request body must be a JSON object"}, 400)
+            return
+        await handler(data, timed_send)
+    finally:
+        metrics.stop_timer(token)
+        total = response["total"] if response["total"] is not None else time.perf_counter() - timer.started
+        metrics.record(timer, scope["method"], response["status"] or 500, total, len(body), response["bytes"])
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "lifespan":
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await async_client.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+    if scope["type"] != "http":
+        return
+
+    body = await _read_body(receive)
+    handler = ASYNC_ROUTES.get(scope["path"]) if scope["method"] == "POST" else None
+    if handler is not None:
+        await _serve_async(handler, scope, body, send)
+        return
+
+    status, headers, response_body = await _run(_call_wsgi, scope, body)
+    await send({
+        "type": "http.response.start",
+        "status": int(status.split(" ", 1)[0]),
+        "headers": [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in headers.items()],
+    })
+    await send({"type": "http.response.body", "body": response_body})
+
+
+wsgi_app = flask_app.create_app()
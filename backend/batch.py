@@ -0,0 +1,287 @@
+"""
+Offline batch processing of trajectory files:
+
+    python batch.py 'runs/**/*.json' --replace 'old/path' 'new/path' --output-dir out/
+    python batch.py runs/ --remove-step 3 --in-place --manifest runs.manifest.jsonl
+    python batch.py runs/ --ops ops.json --dry-run
+    python batch.py runs/ --export-steps --output-dir steps/
+
+Each file's history is edited with the same operations as /batch_edit (see
+edits.apply_operations), applied across a process pool. A JSON line per file
+is written to stdout (or --results) as soon as it finishes, including per-file
+errors. --dry-run reports the counts without writing anything. With
+--manifest, finished files are appended to a checkpoint file and skipped on
+the next run as long as neither the file nor the operations have changed.
+"""
+import argparse
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import codec
+import edits
+import storage
+from edits import EditError
+from trajectory import build_sanitized_steps
+
+
+def _pattern_root(pattern):
+    """The directory a glob pattern's matches are named relative to: its parts before the first wildcard."""
+    parts = []
+    for part in os.path.normpath(pattern).split(os.sep)[:-1]:
+        if glob.has_magic(part):
+            break
+        parts.append(part)
+    return os.sep.join(parts) or ('/' if pattern.startswith('/') else '.')
+
+
+def find_files(patterns):
+    """
+    Trajectory files named by `patterns`: files, directories (searched
+    recursively for *.json only) or globs. Returns (path, name) pairs where
+    `name` is the file's path relative to the directory or glob it was found
+    through, which --output-dir mirrors.
+    """
+    files = []
+    seen = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            root = pattern
+            matches = glob.glob(os.path.join(pattern, '**', '*.json'), recursive=True)
+        else:
+            root = _pattern_root(pattern)
+            matches = glob.glob(pattern, recursive=True)
+        for path in sorted(matches):
+            path = os.path.abspath(path)
+            if os.path.isfile(path) and path not in seen:
+                seen.add(path)
+                files.append((path, os.path.relpath(path, os.path.abspath(root))))
+    return files
+
+
+def _file_state(path):
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
+
+def _write_atomic(path, text):
+    _write_atomic_bytes(path, text.encode('utf-8'))
+
+
+def _write_atomic_bytes(path, data):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    storage.write_atomic(path, data)
+
+
+def _output_path(path, name, options, suffix=''):
+    if options.get('in_place'):
+        return path
+    if suffix:
+        name = os.path.splitext(name)[0] + suffix
+    return os.path.join(options['output_dir'], name)
+
+
+def process_file(path, operations, options, name=None):
+    """
+    Apply `operations` to one trajectory file, written to `name` (default: its
+    basename) under the output directory. Returns the result record written to
+    the results stream; failures are reported in it rather than raised.
+    """
+    started = time.perf_counter()
+    record = {"file": path}
+    name = name or os.path.basename(path)
+    try:
+        journaled = storage.has_journal(path)
+        if journaled:
+            # Saved by the app: the journal's edits are part of the document
+            doc, raw = storage.load_document(path), None
+        else:
+            with open(path, 'rb') as f:
+                raw = f.read()
+            doc = codec.loads(raw)
+        history = doc.get('history') if isinstance(doc, dict) else None
+        if not isinstance(history, list):
+            raise EditError("No history array found in JSON")
+
+        if operations:
+            results = []
+            deadline = time.monotonic() + options['time_budget'] if options.get('time_budget') else None
+            new_history = edits.apply_operations(history, operations, results, deadline=deadline)
+            record["results"] = results
+            # Edits are copy-on-write, so changed entries are new objects
+            changed = len(new_history) != len(history) or any(a is not b for a, b in zip(new_history, history))
+            record["status"] = "ok" if changed else "unchanged"
+            if changed and not options.get('dry_run'):
+                doc['history'] = new_history
+                text = codec.dumps(doc, options.get('compact'))
+                if journaled and options.get('in_place'):
+                    # Replaces the snapshot and drops the journal now folded into it
+                    storage.write_snapshot(path, text)
+                else:
+                    _write_atomic(_output_path(path, name, options), text)
+            elif not options.get('in_place') and not options.get('dry_run'):
+                # Copied as-is, so --output-dir holds every input file
+                if raw is None:
+                    _write_atomic(_output_path(path, name, options), codec.dumps(doc, options.get('compact')))
+                else:
+                    _write_atomic_bytes(_output_path(path, name, options), raw)
+            history = new_history
+
+        if options.get('export_steps'):
+            steps = build_sanitized_steps(history)
+            record["steps"] = len(steps)
+            record.setdefault("status", "ok")
+            if not options.get('dry_run'):
+                _write_atomic(_output_path(path, name, dict(options, in_place=False), '.steps.json'),
+                              codec.dumps(steps, options.get('compact')))
+    except EditError as ee:
+        record["status"] = "error"
+        record["error"] = ee.message
+    except Exception as e:
+        record["status"] = "error"
+        record["error"] = f"{type(e).__name__}: {e}"
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    return record
+
+
+def operations_fingerprint(operations, options):
+    """Identifies the work a manifest entry was produced by."""
+    relevant = {k: options.get(k) for k in ('export_steps', 'in_place', 'output_dir', 'compact')}
+    encoded = json.dumps([operations, relevant], sort_keys=True)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()[:16]
+
+
+def load_manifest(path, fingerprint):
+    """{file: (mtime_ns, size)} of files a previous run with the same fingerprint finished."""
+    done = {}
+    if not path or not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                # A line cut short by an interrupted run
+                continue
+            if entry.get("fingerprint") == fingerprint and entry.get("status") != "error":
+                done[entry["file"]] = (entry["mtime_ns"], entry["size"])
+    return done
+
+
+def run(files, operations, options, out, manifest_path=None, workers=None):
+    """
+    Process `files` ((path, name) pairs from find_files()), writing one JSON
+    line per file to `out` as results arrive. Returns a summary dict.
+    """
+    fingerprint = operations_fingerprint(operations, options)
+    done = load_manifest(manifest_path, fingerprint) if not options.get('dry_run') else {}
+    pending = []
+    skipped = 0
+    for path, name in files:
+        if path in done and done[path] == _file_state(path):
+            skipped += 1
+        else:
+            pending.append((path, name))
+
+    summary = {"files": len(files), "skipped": skipped, "ok": 0, "unchanged": 0, "error": 0}
+    manifest = open(manifest_path, 'a') if manifest_path and not options.get('dry_run') else None
+
+    def emit(record):
+        summary[record["status"]] += 1
+        out.write(json.dumps(record) + "\n")
+        out.flush()
+        if manifest is not None:
+            # Stat after processing, so an in-place edit is recognized as done
+            mtime_ns, size = _file_state(record["file"])
+            manifest.write(json.dumps({
+                "file": record["file"], "status": record["status"], "fingerprint": fingerprint,
+                "mtime_ns": mtime_ns, "size": size,
+            }) + "\n")
+            manifest.flush()
+
+    try:
+        if workers == 1 or len(pending) <= 1:
+            for path, name in pending:
+                emit(process_file(path, operations, options, name))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(process_file, path, operations, options, name) for path, name in pending]
+                for future in as_completed(futures):
+                    emit(future.result())
+    finally:
+        if manifest is not None:
+            manifest.close()
+    return summary
+
+
+def build_operations(args):
+    operations = []
+    if args.ops:
+        with open(args.ops) as f:
+            operations.extend(json.load(f))
+    for search_term, replace_term in args.replace or []:
+        operations.append({"op": "replace", "search_term": search_term, "replace_term": replace_term})
+    for original_index in args.remove_step or []:
+        operations.append({"op": "remove_step", "original_index": original_index})
+    return operations
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Apply trajectory edits to many files at once.")
+    parser.add_argument('paths', nargs='+',
+                        help="trajectory files, directories (searched for *.json) or glob patterns")
+    parser.add_argument('--replace', nargs=2, action='append', metavar=('SEARCH', 'REPLACE'),
+                        help="search/replace over the history, as /replace (repeatable)")
+    parser.add_argument('--remove-step', type=int, action='append', metavar='N',
+                        help="remove step N, numbered as in the original file (repeatable)")
+    parser.add_argument('--ops', help="JSON file with a list of /batch_edit operations, applied first")
+    parser.add_argument('--export-steps', action='store_true',
+                        help="write the sanitized steps of each (edited) file as <name>.steps.json")
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument('--output-dir',
+                        help="directory for the output files, mirroring their paths under each input directory or glob")
+    target.add_argument('--in-place', action='store_true', help="overwrite the input files")
+    parser.add_argument('--compact', action='store_true', default=None,
+                        help="write compact JSON instead of the indent=2 format")
+    parser.add_argument('--dry-run', action='store_true', help="report counts without writing anything")
+    parser.add_argument('--manifest', help="checkpoint file; files finished by an earlier run are skipped")
+    parser.add_argument('--results', help="write result lines here instead of stdout")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="processes (default: all cores)")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="seconds of pattern matching allowed per file")
+    args = parser.parse_args(argv)
+
+    operations = build_operations(args)
+    if not operations and not args.export_steps:
+        parser.error("nothing to do: give --replace, --remove-step, --ops or --export-steps")
+    writes = not args.dry_run and (operations or args.export_steps)
+    if writes and not args.in_place and not args.output_dir:
+        parser.error("--output-dir or --in-place is required unless --dry-run is given")
+    if args.export_steps and not args.output_dir and not args.dry_run:
+        parser.error("--export-steps needs --output-dir")
+
+    options = {
+        "dry_run": args.dry_run,
+        "in_place": args.in_place,
+        "output_dir": os.path.abspath(args.output_dir) if args.output_dir else None,
+        "export_steps": args.export_steps,
+        "time_budget": args.time_budget,
+        "compact": args.compact,
+    }
+    files = find_files(args.paths)
+    out = open(args.results, 'a') if args.results else sys.stdout
+    try:
+        summary = run(files, operations, options, out, args.manifest, max(1, args.workers or 1))
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    print(json.dumps(summary), file=sys.stderr)
+    return 1 if summary["error"] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+"""
+Endpoint benchmarks on synthetic trajectories, see run.py:
+
+    python -m benchmarks.run --steps 10 1000 10000 --output results.json
+    python -m benchmarks.run --compare results.json
+"""
@@ -0,0 +1,258 @@
+"""
+Benchmark the edit endpoints and /chat (plain, streamed and with the prompt
+cached) on synthetic trajectories:
+
+    python -m benchmarks.run --steps 10 100 1000 10000 --output results.json
+    python -m benchmarks.run --steps 1000 --llm-delay 0.05 --compare results.json
+
+Every combination of step count, observation size and repeated-content
+fraction is generated (see trajectories.py) and each endpoint is called
+through Flask's test client with a pre-encoded body, so the numbers cover
+request parsing, the edit and response encoding but not the network. For each
+endpoint the results record the latency over --repeat calls, the peak memory
+allocated during one more call (tracemalloc) and the response size. The
+OpenAI client is replaced by stub_llm.StubOpenAI.
+
+--output writes the results as JSON; --compare reads an earlier file and
+reports scenarios whose median latency, peak memory or output size grew by
+more than --threshold (and latency by more than --noise-ms), exiting with
+status 1 if any did. A scenario whose endpoint answers with an error is
+recorded with its "error" instead of metrics, and also makes the exit status 1.
+"""
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from benchmarks.stub_llm import StubOpenAI
+from benchmarks.trajectories import generate_trajectory
+
+ENDPOINTS = ("replace", "replace_thought", "remove_step", "chat", "chat_stream", "chat_cached")
+# Compared by --compare; all of them grow when something gets worse
+COMPARED_METRICS = ("median_ms", "peak_memory_bytes", "output_bytes")
+
+
+class BenchmarkError(Exception):
+    """An endpoint answered a benchmark request with an error."""
+
+
+def _load_app(llm_delay):
+    os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+    import app as app_module
+    from llm_cache import ResponseCache
+
+    app_module.client = StubOpenAI(llm_delay)
+    app_module.llm_cache = ResponseCache(path=None)
+    # The stub has no context window: measure the single-prompt /chat at every size
+    app_module.CHAT_MAX_PROMPT_TOKENS = sys.maxsize
+    logging.getLogger().setLevel(logging.WARNING)
+    return app_module
+
+
+def _scenario_request(endpoint, doc, content):
+    """(path, body) of one benchmark call of `endpoint` on `doc` (`content` is its JSON text)."""
+    middle = max(1, (len(doc["history"]) - 2) // 4)
+    if endpoint == "replace":
+        return "/replace", {"content": content, "search_term": "return", "replace_term": "yield"}
+    if endpoint == "replace_thought":
+        return "/replace_thought", {"content": content, "original_index": middle, "new_thought": "Rewritten thought."}
+    if endpoint == "remove_step":
+        return "/remove_step", {"content": content, "original_index": middle}
+    return "/chat", {
+        "messages": [{"role": "user", "content": "Which steps edit the cache module?"}],
+        "history": doc["history"],
+        "cache": False,
+        "stream": endpoint == "chat_stream",
+    }
+
+
+def _latency_summary(seconds):
+    ordered = sorted(seconds)
+    p95 = ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))]
+    return {
+        "min_ms": round(ordered[0] * 1000, 3),
+        "median_ms": round(statistics.median(ordered) * 1000, 3),
+        "p95_ms": round(p95 * 1000, 3),
+        "mean_ms": round(statistics.fmean(ordered) * 1000, 3),
+    }
+
+
+def measure(client, path, body, repeat, setup=None):
+    """
+    Latency summary, peak memory and response size of POSTing `body` (bytes)
+    to `path`; `setup` runs before every call, outside the timing.
+    """
+    def call():
+        if setup is not None:
+            setup()
+        started = time.perf_counter()
+        resp = client.post(path, data=body, content_type="application/json")
+        elapsed = time.perf_counter() - started
+        if resp.status_code != 200:
+            raise BenchmarkError(f"{path} answered {resp.status_code}: {resp.get_data(as_text=True)[:200]}")
+        return resp, elapsed
+
+    call()  # warm-up
+    seconds = [call()[1] for _ in range(repeat)]
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        resp, _ = call()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {**_latency_summary(seconds), "peak_memory_bytes": peak, "output_bytes": len(resp.get_data())}
+
+
+def run(steps, observation_chars, repeat_fractions, endpoints=ENDPOINTS, repeat=5, llm_delay=0.0, seed=0, log=None):
+    """Benchmark every scenario; returns the results document written by --output."""
+    app_module = _load_app(llm_delay)
+    client = app_module.create_app().test_client()
+    results = []
+    for num_steps, chars, fraction in itertools.product(steps, observation_chars, repeat_fractions):
+        doc = generate_trajectory(num_steps, chars, fraction, seed)
+        content = json.dumps(doc)
+        for endpoint in endpoints:
+            path, body = _scenario_request(endpoint, doc, content)
+            if endpoint == "chat_cached":
+                setup = None
+            else:
+                # Rebuild the prompt on every call; edits never use it
+                setup = app_module.prompt_cache.clear
+            llm = app_module.client.chat.completions
+            calls_before = llm.calls
+            result = {
+                "endpoint": endpoint,
+                "steps": num_steps,
+                "observation_chars": chars,
+                "repeat_fraction": fraction,
+                "input_bytes": len(content),
+            }
+            scenario = f"{endpoint:16} steps={num_steps:<6} obs={chars:<6} repeat={fraction:<4}"
+            try:
+                result.update(measure(client, path, json.dumps(body).encode("utf-8"), repeat, setup))
+            except BenchmarkError as e:
+                # Recorded without metrics (compare() skips it) so the other scenarios still run
+                result["error"] = str(e)
+                results.append(result)
+                if log is not None:
+                    log.write(f"{scenario} error: {e}\n")
+                    log.flush()
+                continue
+            if endpoint.startswith("chat"):
+                result["llm_calls"] = (llm.calls - calls_before) // (repeat + 2)
+            results.append(result)
+            if log is not None:
+                log.write(f"{scenario} median={result['median_ms']:>10.3f}ms peak={result['peak_memory_bytes']:>12} "
+                          f"out={result['output_bytes']}\n")
+                log.flush()
+    return {"meta": _meta(llm_delay, repeat, seed), "results": results}
+
+
+def _meta(llm_delay, repeat, seed):
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    try:
+        import orjson  # noqa: F401
+        has_orjson = True
+    except ImportError:
+        has_orjson = False
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "orjson": has_orjson,
+        "llm_delay": llm_delay,
+        "repeat": repeat,
+        "seed": seed,
+    }
+
+
+def _scenario_key(result):
+    return result["endpoint"], result["steps"], result["observation_chars"], result["repeat_fraction"]
+
+
+def compare(baseline, current, threshold=0.2, noise_ms=1.0):
+    """
+    Regressions of `current` against `baseline` (results documents): one
+    {"scenario", "metric", "baseline", "current", "ratio"} per compared metric
+    that grew by more than `threshold`, ignoring latency changes below
+    `noise_ms`. Scenarios missing from either side are skipped.
+    """
+    before = {_scenario_key(r): r for r in baseline["results"]}
+    regressions = []
+    for result in current["results"]:
+        old = before.get(_scenario_key(result))
+        if old is None:
+            continue
+        for metric in COMPARED_METRICS:
+            if not old.get(metric) or metric not in result:
+                continue
+            ratio = result[metric] / old[metric]
+            if metric.endswith("_ms") and result[metric] - old[metric] < noise_ms:
+                continue
+            if ratio > 1 + threshold:
+                regressions.append({
+                    "scenario": dict(zip(("endpoint", "steps", "observation_chars", "repeat_fraction"), _scenario_key(result))),
+                    "metric": metric,
+                    "baseline": old[metric],
+                    "current": result[metric],
+                    "ratio": round(ratio, 3),
+                })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark trajectory endpoints on synthetic documents.")
+    parser.add_argument('--steps', type=int, nargs='+', default=[10, 100, 1000, 10000])
+    parser.add_argument('--observation-chars', type=int, nargs='+', default=[2000],
+                        help="typical observation size in characters")
+    parser.add_argument('--repeat-fraction', type=float, nargs='+', default=[0.0, 0.5],
+                        help="fraction of observations that repeat an earlier one")
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--repeat', type=int, default=5, help="timed calls per scenario")
+    parser.add_argument('--llm-delay', type=float, default=0.0, help="seconds the stub LLM takes per completion")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="write the results JSON here")
+    parser.add_argument('--compare', metavar='BASELINE', help="results JSON of an earlier run to compare against")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="relative growth of a metric reported as a regression (default 0.2)")
+    parser.add_argument('--noise-ms', type=float, default=1.0,
+                        help="latency differences below this are never regressions (default 1.0)")
+    args = parser.parse_args(argv)
+
+    current = run(args.steps, args.observation_chars, args.repeat_fraction, args.endpoints,
+                  max(1, args.repeat), args.llm_delay, args.seed, log=sys.stderr)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(current, f, indent=2)
+    failed = sum(1 for result in current["results"] if "error" in result)
+    if failed:
+        print(json.dumps({"failed_scenarios": failed}), file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold, args.noise_ms)
+        for regression in regressions:
+            print(json.dumps(regression))
+        print(json.dumps({"regressions": len(regressions)}), file=sys.stderr)
+        return 1 if regressions or failed else 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
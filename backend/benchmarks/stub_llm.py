@@ -0,0 +1,75 @@
+"""
+A local stand-in for the OpenAI client, so benchmarks measure the app rather
+than the network. Completions take `delay` seconds and answer with a short
+message, or with an empty apply_semantic_filter call when a tool is forced.
+Streamed completions deliver the same message as chunks shaped like the
+OpenAI client's, a word per chunk, after the same delay.
+"""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+
+class _Message:
+    def __init__(self, message):
+        self._message = message
+
+    def to_dict(self):
+        return dict(self._message)
+
+
+class _Completions:
+    def __init__(self, delay):
+        self.delay = delay
+        self.calls = 0
+        self.prompt_chars = 0
+        self._lock = threading.Lock()
+
+    def create(self, stream=False, **request):
+        with self._lock:
+            self.calls += 1
+            self.prompt_chars += sum(len(m.get("content") or "") for m in request.get("messages", []))
+        if self.delay:
+            time.sleep(self.delay)
+
+        tool_choice = request.get("tool_choice")
+        if isinstance(tool_choice, dict):
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": "call_stub",
+                    "type": "function",
+                    "function": {
+                        "name": tool_choice["function"]["name"],
+                        "arguments": json.dumps({"filtered_steps": []}),
+                    },
+                }],
+            }
+        else:
+            message = {"role": "assistant", "content": "Stub answer."}
+        if stream:
+            return _chunks(message)
+        return SimpleNamespace(choices=[SimpleNamespace(message=_Message(message))])
+
+
+def _chunk(**delta):
+    return SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(**delta))])
+
+
+def _chunks(message):
+    """`message` as streamed chat completion chunks."""
+    yield _chunk(role="assistant", content=None, tool_calls=None)
+    for word in (message["content"] or "").split(" "):
+        yield _chunk(content=word + " ", tool_calls=None)
+    for index, call in enumerate(message.get("tool_calls") or []):
+        function = SimpleNamespace(name=call["function"]["name"], arguments=call["function"]["arguments"])
+        yield _chunk(content=None, tool_calls=[SimpleNamespace(index=index, id=call["id"], type="function", function=function)])
+
+
+class StubOpenAI:
+    """Duck-types the `client.chat.completions.create` calls app.py makes."""
+
+    def __init__(self, delay=0.0):
+        self.chat = SimpleNamespace(completions=_Completions(delay))
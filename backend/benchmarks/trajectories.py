@@ -0,0 +1,122 @@
+"""
+Synthetic trajectories shaped like real agent runs.
+
+Every step is an assistant message (thought, action and a tool call) and a
+tool message whose text is "OBSERVATION:\\n" followed by command output: file
+listings, source code or test logs. Output is deterministic for a given seed,
+so benchmark runs on different machines or commits see the same documents.
+"""
+import json
+import random
+
+_WORDS = (
+    "the function returns value when input list is empty and config parser reads "
+    "settings from file but test fails because cache key ignores timezone offset so "
+    "we should check how module handles request path before raising error"
+).split()
+_IDENTIFIERS = (
+    "parse_config", "load_settings", "request", "response", "cache_key", "timezone",
+    "offset", "handler", "payload", "result", "items", "user_id", "session", "path",
+)
+_FILES = [f"src/pkg/{name}.py" for name in ("config", "cache", "handlers", "models", "utils", "views", "client", "io")]
+
+
+def _sentence(rng, words):
+    return " ".join(rng.choice(_WORDS) for _ in range(words)).capitalize() + "."
+
+
+def _code_line(rng, number):
+    name = rng.choice(_IDENTIFIERS)
+    other = rng.choice(_IDENTIFIERS)
+    templates = (
+        f"    {name} = {other}.get('{rng.choice(_IDENTIFIERS)}')",
+        f"def {name}_{number}({other}, *args, **kwargs):",
+        f"        return {name}({other}) if {other} is not None else None",
+        f"    # {_sentence(rng, 6)}",
+        f"    if not {name}:",
+        f"        raise ValueError('invalid {name}: %r' % ({other},))",
+    )
+    return f"{number:6d}\t{rng.choice(templates)}"
+
+
+def _observation(rng, kind, path, chars):
+    if kind == "view":
+        lines = [f"Here's the result of running `cat -n` on /repo/{path}:"]
+    elif kind == "test":
+        lines = ["============================= test session starts =============================="]
+    else:
+        lines = []
+    number = 1
+    size = sum(len(line) + 1 for line in lines)
+    while size < chars:
+        if kind == "test":
+            line = f"tests/test_{rng.choice(_IDENTIFIERS)}.py::test_{rng.choice(_IDENTIFIERS)}_{number} {rng.choice(('PASSED', 'PASSED', 'FAILED'))}"
+        elif kind == "find":
+            line = f"/repo/{rng.choice(_FILES)}:{number}: {rng.choice(_IDENTIFIERS)}"
+        else:
+            line = _code_line(rng, number)
+        lines.append(line)
+        size += len(line) + 1
+        number += 1
+    return "\n".join(lines)[:chars]
+
+
+def generate_trajectory(num_steps, observation_chars=2000, repeat_fraction=0.0, seed=0):
+    """
+    A {"history": [...]} document with `num_steps` steps after the instructions.
+
+    Observations are around `observation_chars` characters (half to one and a
+    half times that); a `repeat_fraction` of them repeat an earlier observation
+    verbatim, as when an agent views the same file or reruns the same tests.
+    """
+    rng = random.Random(seed)
+    history = [
+        {"role": "system", "content": "You are a helpful assistant that can interact with a computer to solve tasks.",
+         "agent": "main", "message_type": "system_prompt"},
+        {"role": "user", "content": [{"type": "text", "text": (
+            "<uploaded_files>\n/repo\n</uploaded_files>\n"
+            "I've uploaded a python code repository in the directory /repo. " + " ".join(_sentence(rng, 12) for _ in range(8))
+        )}], "agent": "main", "message_type": "observation"},
+    ]
+    earlier = []
+    for step in range(1, num_steps + 1):
+        path = rng.choice(_FILES)
+        kind = rng.choice(("view", "view", "test", "find"))
+        if kind == "view":
+            tool, arguments = "str_replace_editor", {"command": "view", "path": f"/repo/{path}"}
+        elif kind == "test":
+            tool, arguments = "bash", {"command": f"cd /repo && python -m pytest tests/ -q -k {rng.choice(_IDENTIFIERS)}"}
+        else:
+            tool, arguments = "bash", {"command": f"grep -rn {rng.choice(_IDENTIFIERS)} /repo/src"}
+        action = f"{tool} {' '.join(str(v) for v in arguments.values())}"
+        thought = " ".join(_sentence(rng, rng.randint(8, 20)) for _ in range(rng.randint(1, 4)))
+
+        if earlier and rng.random() < repeat_fraction:
+            observation = rng.choice(earlier)
+        else:
+            observation = _observation(rng, kind, path, rng.randint(observation_chars // 2, observation_chars * 3 // 2))
+            earlier.append(observation)
+
+        call_id = f"call_{step}"
+        history.append({
+            "role": "assistant",
+            "content": thought,
+            "thought": thought,
+            "action": action,
+            "agent": "main",
+            "tool_calls": [{
+                "index": 0,
+                "function": {"arguments": json.dumps(arguments), "name": tool},
+                "id": call_id,
+                "type": "function",
+            }],
+            "message_type": "action",
+        })
+        history.append({
+            "role": "tool",
+            "content": [{"type": "text", "text": "OBSERVATION:\n" + observation}],
+            "agent": "main",
+            "message_type": "observation",
+            "tool_call_ids": [call_id],
+        })
+    return {"history": history}
@@ -0,0 +1,73 @@
+"""
+Splitting a sanitized step list into token-budgeted windows for map-reduce
+semantic filtering, and merging the per-window filter results.
+"""
+import json
+import os
+
+# Rough characters-per-token ratio for English text and code
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "4"))
+
+
+def estimate_tokens(text):
+    """Cheap token estimate for `text` (a string or any JSON-serializable value)."""
+    if not isinstance(text, str):
+        text = json.dumps(text, indent=2)
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def split_steps(steps, token_budget):
+    """
+    Split sanitized steps into windows of at most ~`token_budget` tokens each.
+
+    Step 0 (the user instructions) is repeated at the head of every window so
+    each window keeps the task context, unless it would take more than a
+    quarter of the budget. A single step larger than the budget gets a window
+    of its own.
+    """
+    if not steps:
+        return []
+
+    head = []
+    body = steps
+    if steps[0].get("step") == 0:
+        body = steps[1:]
+        if estimate_tokens(steps[0]) <= token_budget // 4:
+            head = [steps[0]]
+    if not body:
+        return [list(steps)]
+
+    head_tokens = sum(estimate_tokens(s) for s in head)
+    windows = []
+    current = []
+    current_tokens = head_tokens
+    for step in body:
+        tokens = estimate_tokens(step)
+        if current and current_tokens + tokens > token_budget:
+            windows.append(head + current)
+            current = []
+            current_tokens = head_tokens
+        current.append(step)
+        current_tokens += tokens
+    if current:
+        windows.append(head + current)
+    return windows
+
+
+def merge_filtered_steps(results):
+    """
+    Merge `filtered_steps` lists from several windows: one entry per
+    originalIndex (the first reasoning wins), ordered by originalIndex.
+    """
+    merged = {}
+    for filtered_steps in results:
+        for entry in filtered_steps or []:
+            if not isinstance(entry, dict):
+                continue
+            try:
+                index = int(entry.get("originalIndex"))
+            except (TypeError, ValueError):
+                continue
+            if index not in merged:
+                merged[index] = {"originalIndex": index, "reasoning": entry.get("reasoning", "")}
+    return [merged[index] for index in sorted(merged)]
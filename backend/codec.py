@@ -0,0 +1,104 @@
+"""
+JSON encoding and decoding for documents and responses.
+
+orjson is used when it is installed and the stdlib json module otherwise;
+anything orjson refuses (NaN, integers beyond 64 bits, non-string keys) falls
+back to json, so both paths accept and produce the same data. orjson writes
+NaN and infinities as null instead of refusing them, so data holding them is
+encoded by json too.
+
+Documents are written pretty (``json.dumps(indent=2)``, always through the
+stdlib so the bytes are exactly what the app has always written) or compact (no
+whitespace, non-ASCII kept as-is), per call or by default with COMPACT_JSON=1.
+"""
+import json
+import math
+import os
+
+from flask.json.provider import DefaultJSONProvider
+
+from metrics import phase
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+COMPACT_JSON = os.getenv("COMPACT_JSON", "0") == "1"
+
+
+def loads(data):
+    """Parse JSON text or UTF-8 bytes."""
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # Let json accept what it can (NaN, huge integers) and word the error
+            pass
+    return json.loads(data)
+
+
+def _has_non_finite(obj):
+    """Whether `obj` holds a NaN or infinite float anywhere."""
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                return True
+        elif isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+def dumps_compact(obj, sort_keys=False):
+    """Compact JSON text: no whitespace, non-ASCII characters kept as-is."""
+    if orjson is not None:
+        try:
+            encoded = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except orjson.JSONEncodeError:
+            encoded = None
+        # Only output with a null can hide a NaN orjson wrote as null
+        if encoded is not None and (b"null" not in encoded or not _has_non_finite(obj)):
+            return encoded.decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':'), sort_keys=sort_keys)
+
+
+def dumps(obj, compact=None):
+    """A document as JSON text: compact, or the indent=2 format (default unless COMPACT_JSON)."""
+    if compact is None:
+        compact = COMPACT_JSON
+    if compact:
+        return dumps_compact(obj)
+    return json.dumps(obj, indent=2)
+
+
+def compact_option(value):
+    """A request's `json_format` ("compact" / "pretty") as a dumps() `compact` argument."""
+    if value == "compact":
+        return True
+    if value == "pretty":
+        return False
+    return None
+
+
+class JSONProvider(DefaultJSONProvider):
+    """Flask JSON provider parsing request bodies and encoding compact responses with the fast codec."""
+
+    def loads(self, s, **kwargs):
+        with phase("parse"):
+            if kwargs:
+                return super().loads(s, **kwargs)
+            return loads(s)
+
+    def dumps(self, obj, **kwargs):
+        # Flask asks for exactly these separators for compact (non-debug) responses
+        with phase("encode"):
+            if kwargs == {"separators": (",", ":")}:
+                try:
+                    return dumps_compact(obj, sort_keys=self.sort_keys)
+                except TypeError:
+                    pass
+            return super().dumps(obj, **kwargs)
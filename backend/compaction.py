@@ -0,0 +1,135 @@
+"""
+Compaction of step observations before they are sent to the model.
+
+Three stages, applied in order and each optional:
+
+1. Repeated observations (an agent cat-ing the same file again) are replaced
+   by a back-reference to the first step that produced the same text.
+2. Observations longer than `max_observation_chars` keep only their head and
+   tail.
+3. If the steps are still estimated above `token_budget` tokens, every
+   observation is capped at the largest common length that fits the budget.
+"""
+import hashlib
+
+from chunking import CHARS_PER_TOKEN
+
+# Observations shorter than this are never replaced by a back-reference
+MIN_DEDUPE_CHARS = 200
+# The token budget never truncates an observation below this many characters
+MIN_BUDGET_CHARS = 200
+# Upper bound on the length of truncate_middle()'s "characters omitted" marker
+TRUNCATION_MARKER_CHARS = 48
+
+
+def truncate_middle(text, max_chars):
+    """Keep the head and tail of `text` within about `max_chars` characters."""
+    if len(text) <= max_chars:
+        return text
+    head = max_chars // 2
+    tail = max_chars - head
+    omitted = len(text) - head - tail
+    return f"{text[:head]}\n[... {omitted} characters omitted ...]\n{text[-tail:] if tail else ''}"
+
+
+def _capped_total(lengths, cap):
+    return sum(n if n <= cap else cap + TRUNCATION_MARKER_CHARS for n in lengths)
+
+
+def _budget_cap(lengths, available_chars):
+    """Largest per-observation cap with _capped_total() <= available_chars, or None if none is needed."""
+    if sum(lengths) <= available_chars:
+        return None
+    lo, hi = MIN_BUDGET_CHARS, max(lengths)
+    if _capped_total(lengths, lo) > available_chars:
+        return lo
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _capped_total(lengths, mid) <= available_chars:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def compact_steps(steps, index_key="step", dedupe=True, max_observation_chars=None, token_budget=None):
+    """
+    Return (compacted_steps, stats) for a list of step dicts with an
+    "observation" field, labelled by `index_key`. Input dicts are not modified.
+    """
+    observations = [s.get("observation") for s in steps]
+    before_chars = sum(len(o) for o in observations if isinstance(o, str))
+    new_observations = list(observations)
+    deduplicated = 0
+    truncated = set()
+
+    if dedupe:
+        first_seen = {}
+        for i, (step, text) in enumerate(zip(steps, observations)):
+            if not isinstance(text, str) or len(text) < MIN_DEDUPE_CHARS:
+                continue
+            digest = hashlib.sha1(text.encode("utf-8", "surrogatepass")).digest()
+            if digest in first_seen:
+                new_observations[i] = f"[same observation as step {first_seen[digest]}]"
+                deduplicated += 1
+            else:
+                first_seen[digest] = step.get(index_key, i)
+
+    if max_observation_chars:
+        for i, text in enumerate(new_observations):
+            if isinstance(text, str) and len(text) > max_observation_chars:
+                new_observations[i] = truncate_middle(text, max_observation_chars)
+                truncated.add(i)
+
+    over_budget = False
+    if token_budget:
+        other_chars = sum(
+            len(str(v)) for s in steps for k, v in s.items() if k != "observation"
+        )
+        available = int(token_budget * CHARS_PER_TOKEN) - other_chars
+        lengths = [len(t) if isinstance(t, str) else 0 for t in new_observations]
+        cap = _budget_cap(lengths, max(available, 0))
+        if cap is not None:
+            for i, text in enumerate(new_observations):
+                if isinstance(text, str) and len(text) > cap:
+                    new_observations[i] = truncate_middle(text, cap)
+                    truncated.add(i)
+            over_budget = _capped_total(lengths, cap) > available
+
+    compacted = []
+    for step, old, new in zip(steps, observations, new_observations):
+        compacted.append(step if new is old else {**step, "observation": new})
+
+    after_chars = sum(len(o) for o in new_observations if isinstance(o, str))
+    stats = {
+        "deduplicated": deduplicated,
+        "truncated": len(truncated),
+        "tokens_saved": int((before_chars - after_chars) / CHARS_PER_TOKEN),
+    }
+    if token_budget:
+        stats["over_budget"] = over_budget
+    return compacted, stats
+
+
+def compaction_options(value, defaults):
+    """
+    Normalize a request's `compact` field: false/None disables compaction,
+    true uses `defaults`, and a dict overrides individual defaults.
+    Returns a dict of compact_steps() keyword arguments, or None. Raises
+    ValueError naming the first option of the wrong type.
+    """
+    if not value:
+        return None
+    options = dict(defaults)
+    if isinstance(value, dict):
+        if "dedupe" in value:
+            if not isinstance(value["dedupe"], bool):
+                raise ValueError("compact.dedupe must be true or false")
+            options["dedupe"] = value["dedupe"]
+        for key in ("max_observation_chars", "token_budget"):
+            if key in value:
+                limit = value[key]
+                if limit is not None and (isinstance(limit, bool) or not isinstance(limit, int) or limit < 0):
+                    raise ValueError(f"compact.{key} must be a non-negative integer or null")
+                options[key] = limit
+    return options
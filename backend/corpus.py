@@ -0,0 +1,284 @@
+"""
+Index of the trajectories saved under data/, for corpus-wide statistics.
+
+A scan walks the directory and compares every trajectory file (plain, gzip or
+zstd, with its edit journal, see storage.py) against the SQLite index by
+modification time and size first and by content hash second, so only files
+that really changed are parsed again. Each file is summarized as its step
+count, observation sizes and the number of calls per tool name (from the
+assistant messages' ``tool_calls[].function.name``); stats() answers from
+these summaries with SQL aggregates alone.
+
+The index is kept current by a background thread that rescans every
+`interval` seconds, or as soon as wake() is called after a save.
+"""
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import storage
+from trajectory import iter_steps, num_steps
+
+TRAJECTORY_SUFFIXES = (".json", ".json.gz", ".json.zst")
+# Upper bounds of the step count distribution reported by stats()
+STEP_BUCKETS = (10, 25, 50, 100, 200, 500, 1000)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS files ("
+    " path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, journal TEXT, sha256 TEXT,"
+    " indexed REAL, steps INTEGER, observation_chars INTEGER, max_observation_chars INTEGER,"
+    " tool_calls INTEGER, error TEXT)",
+    "CREATE TABLE IF NOT EXISTS tool_calls ("
+    " path TEXT, name TEXT, count INTEGER, PRIMARY KEY (path, name))",
+    "CREATE INDEX IF NOT EXISTS tool_calls_by_name ON tool_calls (name, count)",
+    "CREATE INDEX IF NOT EXISTS files_by_steps ON files (steps)",
+)
+
+
+def summarize(history):
+    """Step count, observation sizes and calls per tool name of a history."""
+    tools = {}
+    for message in history:
+        if not isinstance(message, dict) or message.get('role') != 'assistant':
+            continue
+        for call in message.get('tool_calls') or []:
+            function = call.get('function') if isinstance(call, dict) else None
+            name = function.get('name') if isinstance(function, dict) else None
+            if name:
+                tools[name] = tools.get(name, 0) + 1
+    sizes = [len(step.observation) for step in iter_steps(history, 1)]
+    return {
+        "steps": num_steps(history),
+        "observation_chars": sum(sizes),
+        "max_observation_chars": max(sizes, default=0),
+        "tools": tools,
+    }
+
+
+def _journal_state(path):
+    try:
+        st = os.stat(storage.journal_path(path))
+    except FileNotFoundError:
+        return ""
+    return f"{st.st_mtime_ns}:{st.st_size}"
+
+
+def _content_hash(path):
+    digest = hashlib.sha256()
+    for name in (path, storage.journal_path(path)):
+        try:
+            with open(name, 'rb') as f:
+                for block in iter(lambda: f.read(1 << 20), b''):
+                    digest.update(block)
+        except FileNotFoundError:
+            pass
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+class CorpusIndex:
+    def __init__(self, directory, path):
+        self.directory = directory
+        self.path = path
+        self.last_scan = None
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._scan_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+
+    def _connect(self):
+        with self._db_lock:
+            if self._db is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                db = sqlite3.connect(self.path, check_same_thread=False)
+                for statement in _SCHEMA:
+                    db.execute(statement)
+                db.commit()
+                self._db = db
+            return self._db
+
+    def _files(self):
+        found = []
+        for root, dirs, names in os.walk(self.directory):
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            for name in sorted(names):
+                if name.endswith(TRAJECTORY_SUFFIXES) and not name.startswith('.'):
+                    found.append(os.path.join(root, name))
+        return found
+
+    def scan(self):
+        """
+        Bring the index up to date with the directory. Returns counts of the
+        files "indexed" (parsed), "unchanged", "removed" and "errors".
+        """
+        with self._scan_lock:
+            db = self._connect()
+            with self._db_lock:
+                known = {row[0]: row[1:] for row in db.execute("SELECT path, mtime_ns, size, journal, sha256 FROM files")}
+            counts = {"indexed": 0, "unchanged": 0, "removed": 0, "errors": 0}
+            present = set()
+            for path in self._files():
+                key = os.path.relpath(path, self.directory)
+                present.add(key)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                state = (st.st_mtime_ns, st.st_size, _journal_state(path))
+                previous = known.get(key)
+                if previous is not None and previous[:3] == state:
+                    counts["unchanged"] += 1
+                    continue
+                content_hash = _content_hash(path)
+                if previous is not None and previous[3] == content_hash:
+                    # Touched or rewritten with the same bytes
+                    with self._db_lock:
+                        db.execute("UPDATE files SET mtime_ns = ?, size = ?, journal = ? WHERE path = ?", (*state, key))
+                        db.commit()
+                    counts["unchanged"] += 1
+                    continue
+                if not self._index_file(db, key, path, state, content_hash):
+                    counts["errors"] += 1
+                counts["indexed"] += 1
+
+            removed = [key for key in known if key not in present]
+            with self._db_lock:
+                for key in removed:
+                    db.execute("DELETE FROM files WHERE path = ?", (key,))
+                    db.execute("DELETE FROM tool_calls WHERE path = ?", (key,))
+                db.commit()
+            counts["removed"] = len(removed)
+            self.last_scan = time.time()
+            return counts
+
+    def _index_file(self, db, key, path, state, content_hash):
+        summary, error = None, None
+        try:
+            doc = storage.load_document(path)
+            history = doc.get('history') if isinstance(doc, dict) else None
+            if not isinstance(history, list):
+                raise ValueError("No history array found in JSON")
+            summary = summarize(history)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+
+        row = (key, *state, content_hash, time.time())
+        with self._db_lock:
+            db.execute("DELETE FROM tool_calls WHERE path = ?", (key,))
+            if summary is None:
+                db.execute(
+                    "INSERT OR REPLACE INTO files (path, mtime_ns, size, journal, sha256, indexed, error)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)", row + (error,))
+            else:
+                db.execute(
+                    "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)",
+                    row + (summary["steps"], summary["observation_chars"], summary["max_observation_chars"],
+                           sum(summary["tools"].values())))
+                db.executemany("INSERT INTO tool_calls VALUES (?, ?, ?)",
+                               [(key, name, count) for name, count in summary["tools"].items()])
+            db.commit()
+        return summary is not None
+
+    def stats(self, tool=None, min_calls=1, min_steps=None, max_steps=None, limit=100):
+        """
+        Corpus statistics over the indexed files, optionally restricted to
+        files with `min_steps`..`max_steps` steps. With `tool`, also lists the
+        files calling it at least `min_calls` times, most calls first.
+        """
+        db = self._connect()
+        where, params = ["error IS NULL"], []
+        if min_steps is not None:
+            where.append("steps >= ?")
+            params.append(min_steps)
+        if max_steps is not None:
+            where.append("steps <= ?")
+            params.append(max_steps)
+        condition = " AND ".join(where)
+
+        with self._db_lock:
+            files, steps, max_file_steps, observation_chars, max_observation, calls = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(steps), 0), COALESCE(MAX(steps), 0),"
+                " COALESCE(SUM(observation_chars), 0), COALESCE(MAX(max_observation_chars), 0),"
+                f" COALESCE(SUM(tool_calls), 0) FROM files WHERE {condition}", params).fetchone()
+            errors = db.execute("SELECT COUNT(*) FROM files WHERE error IS NOT NULL").fetchone()[0]
+            bucket_case = " ".join(f"WHEN steps <= {bound} THEN {bound}" for bound in STEP_BUCKETS)
+            buckets = dict(db.execute(
+                f"SELECT CASE {bucket_case} ELSE NULL END AS bucket, COUNT(*) FROM files"
+                f" WHERE {condition} GROUP BY bucket", params).fetchall())
+            median = db.execute(
+                f"SELECT steps FROM files WHERE {condition} ORDER BY steps LIMIT 1 OFFSET ?",
+                params + [max(files - 1, 0) // 2]).fetchone()
+            tools = db.execute(
+                "SELECT name, SUM(count), COUNT(*) FROM tool_calls WHERE path IN"
+                f" (SELECT path FROM files WHERE {condition}) GROUP BY name ORDER BY SUM(count) DESC",
+                params).fetchall()
+            matches = None
+            if tool is not None:
+                matches = db.execute(
+                    "SELECT files.path, files.steps, tool_calls.count FROM tool_calls"
+                    " JOIN files ON files.path = tool_calls.path"
+                    f" WHERE tool_calls.name = ? AND tool_calls.count >= ? AND {condition}"
+                    " ORDER BY tool_calls.count DESC, files.path LIMIT ?",
+                    [tool, min_calls] + params + [limit]).fetchall()
+
+        distribution = [{"max_steps": bound, "files": buckets.get(bound, 0)} for bound in STEP_BUCKETS]
+        distribution.append({"max_steps": None, "files": buckets.get(None, 0)})
+        result = {
+            "files": files,
+            "unreadable_files": errors,
+            "steps": {
+                "total": steps,
+                "mean": round(steps / files, 2) if files else 0,
+                "median": median[0] if median else 0,
+                "max": max_file_steps,
+                "distribution": distribution,
+            },
+            "observation_chars": {
+                "total": observation_chars,
+                "mean_per_step": round(observation_chars / max(steps - files, 1), 1) if files else 0,
+                "max": max_observation,
+            },
+            "tool_calls": calls,
+            "tools": [{"name": name, "calls": count, "files": in_files} for name, count, in_files in tools],
+            "last_scan": self.last_scan,
+        }
+        if matches is not None:
+            result["matches"] = [{"file": path, "steps": n, "calls": count} for path, n, count in matches]
+        return result
+
+    def start(self, interval):
+        """
+        Index the directory now, then keep rescanning it in a background
+        thread every `interval` seconds or when woken. Does nothing if running;
+        without an interval, only scans.
+        """
+        if not interval or interval <= 0:
+            self.scan()
+            return
+        with self._scan_lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, args=(interval,), name="corpus-indexer", daemon=True)
+        self.scan()
+        self._thread.start()
+
+    def wake(self):
+        """Rescan soon, e.g. after a file was saved."""
+        self._wake.set()
+
+    def _run(self, interval):
+        while True:
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                counts = self.scan()
+                if counts["indexed"] or counts["removed"]:
+                    logging.info(f"Corpus index updated: {counts}")
+            except Exception as e:
+                logging.error(f"Corpus scan of {self.directory} failed: {e}")
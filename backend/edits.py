@@ -0,0 +1,409 @@
+"""
+Editing operations on a trajectory's ``history`` list.
+
+Step j (j >= 1) is the pair history[2j] (assistant) and history[2j+1] (tool);
+history[1] is step 0, the user instructions. The operations below mutate the
+history list itself (assigning or removing slots) but never mutate the message
+objects inside it, so callers holding a shallow copy of the list are unaffected.
+
+Each operation optionally records what it changed as RFC 6902 JSON Patch
+operations (relative to the ``{"history": ...}`` document) into an `ops` list.
+"""
+import bisect
+import decimal
+import hashlib
+import json
+import math
+import re
+
+from matching import PatternTimeout, Replacer, check_deadline
+from trajectory import history_step, step_indices
+
+
+class EditError(Exception):
+    """An edit that cannot be applied; carries the HTTP status to answer with."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def json_pointer(*parts):
+    """Build an RFC 6901 JSON Pointer such as "/history/4/thought"."""
+    return "".join("/" + str(p).replace("~", "~0").replace("/", "~1") for p in parts)
+
+
+def _js_number(value):
+    """A float as JSON.stringify writes it: shortest digits, JavaScript's exponent rules."""
+    if not math.isfinite(value):
+        return "null"
+    if value == 0:
+        return "0"
+    sign, digits, exponent = decimal.Decimal(repr(value)).normalize().as_tuple()
+    digits = "".join(map(str, digits))
+    # The decimal point sits after `point` digits
+    point = exponent + len(digits)
+    if len(digits) <= point <= 21:
+        text = digits + "0" * (point - len(digits))
+    elif 0 < point <= 21:
+        text = digits[:point] + "." + digits[point:]
+    elif -6 < point <= 0:
+        text = "0." + "0" * -point + digits
+    else:
+        mantissa = digits[0] + ("." + digits[1:] if len(digits) > 1 else "")
+        text = f"{mantissa}e{'+' if point > 0 else '-'}{abs(point - 1)}"
+    return ("-" if sign else "") + text
+
+
+def _has_float(obj):
+    stack = [obj]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, float):
+            return True
+        if isinstance(value, dict):
+            stack.extend(value.values())
+        elif isinstance(value, (list, tuple)):
+            stack.extend(value)
+    return False
+
+
+def _js_json(obj):
+    """Compact JSON of `obj` with floats written by _js_number()."""
+    if isinstance(obj, float):
+        return _js_number(obj)
+    if isinstance(obj, dict):
+        return "{" + ",".join(
+            json.dumps(str(key), ensure_ascii=False) + ":" + _js_json(value) for key, value in obj.items()) + "}"
+    if isinstance(obj, (list, tuple)):
+        return "[" + ",".join(_js_json(value) for value in obj) + "]"
+    return json.dumps(obj, ensure_ascii=False)
+
+
+def history_hash(history):
+    """
+    SHA-256 of the compact ``{"history": ...}`` document.
+
+    The encoding matches JavaScript's JSON.stringify (no whitespace, non-ASCII
+    kept as-is, numbers in JavaScript's format), so a client can hash its own
+    copy to check it is in sync. Python's encoder writes floats differently
+    (1.0, 1e-05), so histories holding any are encoded by _js_json().
+    """
+    if _has_float(history):
+        encoded = _js_json({"history": history})
+    else:
+        encoded = json.dumps({"history": history}, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+def apply_patch(history, ops):
+    """
+    Apply JSON Patch `ops` as recorded by the operations in this module
+    ("add", "replace" and "remove" relative to the ``{"history": ...}``
+    document) to a copy of `history`. Containers along each path are copied
+    once, so untouched messages stay shared with the input.
+    """
+    root = {"history": list(history)}
+    # id -> copy; holding the copies keeps their ids from being reused
+    copied = {id(root): root, id(root["history"]): root["history"]}
+    for op in ops:
+        parts = [p.replace("~1", "/").replace("~0", "~") for p in op["path"].split("/")[1:]]
+        target = root
+        for part in parts[:-1]:
+            key = int(part) if isinstance(target, list) else part
+            child = target[key]
+            if id(child) not in copied:
+                child = list(child) if isinstance(child, list) else dict(child)
+                copied[id(child)] = child
+                target[key] = child
+            target = child
+        last = parts[-1]
+        if isinstance(target, list):
+            index = len(target) if last == "-" else int(last)
+            if op["op"] == "remove":
+                del target[index]
+            elif op["op"] == "add":
+                target.insert(index, op["value"])
+            else:
+                target[index] = op["value"]
+        elif op["op"] == "remove":
+            del target[last]
+        else:
+            target[last] = op["value"]
+    return root["history"]
+
+
+def diff_histories(old, new):
+    """
+    JSON Patch ops turning history `old` into `new`, comparing entries by
+    identity. Versions produced by the copy-on-write operations in this module
+    share their unchanged messages, so only the replaced, added or removed
+    entries appear in the patch.
+    """
+    start = 0
+    end_old, end_new = len(old), len(new)
+    while start < end_old and start < end_new and old[start] is new[start]:
+        start += 1
+    while end_old > start and end_new > start and old[end_old - 1] is new[end_new - 1]:
+        end_old -= 1
+        end_new -= 1
+    common = min(end_old, end_new)
+    ops = [
+        {"op": "replace", "path": json_pointer("history", i), "value": new[i]}
+        for i in range(start, common) if old[i] is not new[i]
+    ]
+    ops.extend({"op": "remove", "path": json_pointer("history", i)} for i in range(end_old - 1, common - 1, -1))
+    ops.extend({"op": "add", "path": json_pointer("history", i), "value": new[i]} for i in range(common, end_new))
+    return ops
+
+
+def _walk_strings(value, path):
+    """Yield (path, string) for every string inside `value`, depth first."""
+    if isinstance(value, str):
+        yield path, value
+    elif isinstance(value, list):
+        for i, v in enumerate(value):
+            yield from _walk_strings(v, path + [i])
+    elif isinstance(value, dict):
+        for k, v in value.items():
+            yield from _walk_strings(v, path + [k])
+
+
+def _timeout_error():
+    return EditError("Search pattern exceeded the time budget; simplify the pattern or narrow the search")
+
+
+def replacement_pairs(data, require_replace_term=True):
+    """
+    The (search_term, replace_term) pairs of a replace request: either a single
+    search_term/replace_term or a "replacements" list of such objects.
+    """
+    if data.get('replacements') is not None:
+        items = data['replacements']
+        if not isinstance(items, list) or not items:
+            raise EditError("replacements must be a non-empty list")
+    else:
+        items = [{'search_term': data.get('search_term'), 'replace_term': data.get('replace_term')}]
+
+    pairs = []
+    for item in items:
+        search_term = item.get('search_term') if isinstance(item, dict) else None
+        replace_term = item.get('replace_term') if isinstance(item, dict) else None
+        if not search_term or (replace_term is None and require_replace_term):
+            raise EditError("Missing data: search_term and replace_term are required")
+        pairs.append((search_term, replace_term or ''))
+    return pairs
+
+
+def compile_replacements(pairs):
+    """Replacer for `pairs`; raises EditError for an invalid pattern."""
+    try:
+        return Replacer(pairs)
+    except re.error as rex:
+        raise EditError(f"Invalid regex: {rex}")
+
+
+def replace_in_history(history, replacer, ops=None, deadline=None):
+    """
+    Apply `replacer.subn(...)` (a matching.Replacer) to every string inside
+    `history`; all of its search/replace pairs are applied in one traversal.
+
+    Returns (new_history, replacements). Containers without matches are returned
+    as-is rather than copied, so unchanged messages stay shared with the input.
+    Raises EditError once `deadline` (a time.monotonic() value) has passed.
+    """
+    replacements = 0
+    path = ["history"]
+
+    def replace_in_value(value):
+        nonlocal replacements
+        if isinstance(value, str):
+            new_value, count = replacer.subn(value, deadline)
+            check_deadline(deadline)
+            if count:
+                replacements += count
+                if ops is not None:
+                    ops.append({"op": "replace", "path": json_pointer(*path), "value": new_value})
+                return new_value
+            return value
+        if isinstance(value, list):
+            new_items = []
+            for i, v in enumerate(value):
+                path.append(i)
+                new_items.append(replace_in_value(v))
+                path.pop()
+            if any(n is not o for n, o in zip(new_items, value)):
+                return new_items
+            return value
+        if isinstance(value, dict):
+            new_items = {}
+            for k, v in value.items():
+                path.append(k)
+                new_items[k] = replace_in_value(v)
+                path.pop()
+            if any(new_items[k] is not v for k, v in value.items()):
+                return new_items
+            return value
+        return value
+
+    try:
+        new_history = replace_in_value(history)
+    except PatternTimeout:
+        raise _timeout_error()
+    return new_history, replacements
+
+
+def find_in_history(history, pattern, max_matches=1000, context_chars=40, deadline=None):
+    """
+    Locate matches of `pattern` without rewriting anything.
+
+    Returns (matches, total). Each match reports the step it belongs to (None
+    for history[0]), its history index, the field within that message, the
+    JSON Pointer of the string, character offsets and a snippet with up to
+    `context_chars` characters of context. At most `max_matches` are listed;
+    `total` counts them all.
+    """
+    matches = []
+    total = 0
+    try:
+        for history_index, message in enumerate(history):
+            step = history_step(history_index)
+            for path, text in _walk_strings(message, ["history", history_index]):
+                for start, end in pattern.spans(text, deadline):
+                    total += 1
+                    if len(matches) < max_matches:
+                        matches.append({
+                            "step": step,
+                            "history_index": history_index,
+                            "field": path[2] if len(path) > 2 else None,
+                            "path": json_pointer(*path),
+                            "start": start,
+                            "end": end,
+                            "snippet": text[max(0, start - context_chars):end + context_chars],
+                        })
+                check_deadline(deadline)
+    except PatternTimeout:
+        raise _timeout_error()
+    return matches, total
+
+
+def step_pair_indices(history, original_index, step_zero_error):
+    """Validate a 1-based step index and return its (assistant_idx, tool_idx)."""
+    step_j = int(original_index)
+    if step_j <= 0:
+        raise EditError(step_zero_error)
+
+    assistant_idx, tool_idx = step_indices(step_j)
+    if assistant_idx < 0 or tool_idx >= len(history):
+        raise EditError(f"original_index {original_index} is out of range for history pairs")
+    return assistant_idx, tool_idx
+
+
+def replace_thought(history, original_index, new_thought, old_thought='', ops=None):
+    """Set the thought (and content) of step `original_index`. Returns the assistant index."""
+    assistant_idx, _ = step_pair_indices(
+        history, original_index,
+        "original_index must refer to a step >= 1 (step 0 is user instructions)",
+    )
+
+    assistant_msg = history[assistant_idx]
+    if not isinstance(assistant_msg, dict):
+        raise EditError(f"history[{assistant_idx}] is not an object")
+
+    current_thought = assistant_msg.get('thought', '')
+    if old_thought and current_thought.replace('\r\n', '\n') != str(old_thought).replace('\r\n', '\n'):
+        raise EditError("Current thought does not match the provided old_thought. Edit may be outdated.", 409)
+
+    # Update assistant message's thought and content on a copy of the message
+    updated = dict(assistant_msg)
+    updated['thought'] = new_thought
+    updated['content'] = new_thought
+    history[assistant_idx] = updated
+
+    if ops is not None:
+        for key in ('thought', 'content'):
+            ops.append({
+                "op": "replace" if key in assistant_msg else "add",
+                "path": json_pointer("history", assistant_idx, key),
+                "value": new_thought,
+            })
+    return assistant_idx
+
+
+def remove_step(history, original_index, ops=None):
+    """Remove the assistant/tool pair of step `original_index`. Returns the assistant index."""
+    assistant_idx, tool_idx = step_pair_indices(
+        history, original_index,
+        "original_index must refer to a step >= 1 (cannot remove step 0)",
+    )
+
+    # Remove tool first, then assistant to keep indices valid
+    history.pop(tool_idx)
+    history.pop(assistant_idx)
+
+    if ops is not None:
+        ops.append({"op": "remove", "path": json_pointer("history", tool_idx)})
+        ops.append({"op": "remove", "path": json_pointer("history", assistant_idx)})
+    return assistant_idx
+
+
+def apply_operations(history, operations, results, ops=None, deadline=None):
+    """
+    Apply an ordered list of edit operations to a copy of `history`.
+
+    Each operation is a dict with an "op" of "replace" (search_term and
+    replace_term, or a "replacements" list of them), "replace_thought" (original_index, new_thought, optional
+    old_thought) or "remove_step" (original_index). Step indices always refer to
+    the document as it was before the batch; shifts caused by earlier removals
+    are resolved here. One result dict per applied operation is appended to
+    `results`.
+
+    Returns the new history. The input list is left untouched, so a failing
+    operation (EditError naming the operation) leaves the caller's document as
+    it was.
+    """
+    working = list(history)
+    removed = []  # original step indices removed so far, sorted
+
+    def current_index(i, original_index):
+        try:
+            step_j = int(original_index)
+        except (TypeError, ValueError):
+            raise EditError(f"Operation {i}: original_index must be an integer")
+        pos = bisect.bisect_left(removed, step_j)
+        if pos < len(removed) and removed[pos] == step_j:
+            raise EditError(f"Operation {i}: step {step_j} was removed by an earlier operation")
+        return step_j, step_j - pos
+
+    for i, operation in enumerate(operations):
+        kind = operation.get('op') if isinstance(operation, dict) else None
+        try:
+            if kind == 'replace':
+                replacer = compile_replacements(replacement_pairs(operation))
+                working, count = replace_in_history(working, replacer, ops, deadline)
+                result = {"op": kind, "replacements": count}
+                if 'replacements' in operation:
+                    result["counts"] = replacer.counts
+                results.append(result)
+            elif kind in ('replace_thought', 'remove_step'):
+                if operation.get('original_index') is None:
+                    raise EditError(f"{kind} requires original_index")
+                step_j, step = current_index(i, operation['original_index'])
+                if kind == 'replace_thought':
+                    new_thought = operation.get('new_thought')
+                    if new_thought is None:
+                        raise EditError("replace_thought requires new_thought")
+                    replace_thought(working, step, new_thought, operation.get('old_thought', ''), ops)
+                else:
+                    remove_step(working, step, ops)
+                    bisect.insort(removed, step_j)
+                results.append({"op": kind, "original_index": step_j, "step": step})
+            else:
+                raise EditError(f"unknown op {kind!r}")
+        except EditError as ee:
+            if ee.message.startswith(f"Operation {i}"):
+                raise
+            raise EditError(f"Operation {i} ({kind}): {ee.message}", ee.status)
+
+    return working
@@ -0,0 +1,152 @@
+"""
+Random access to the ``history`` entries of a trajectory file without parsing
+the whole document.
+
+build_offsets() scans the file once, memory-mapped, with a regex tokenizer
+that yields only JSON strings and structural characters, and records the byte
+range of every element of the top-level ``history`` array. LazyHistory then
+parses individual entries on demand, so reading a page of steps costs memory
+proportional to the page rather than the file.
+"""
+import mmap
+import os
+import re
+from array import array
+from collections.abc import Sequence
+
+import codec
+
+# A whole JSON string (escapes included) or one structural character
+_TOKEN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[\[\]{},:]')
+
+
+class HistoryOffsets:
+    """Byte ranges of the history entries of one version of a file."""
+
+    def __init__(self, path, mtime, size, starts, ends):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.starts = starts
+        self.ends = ends
+
+    def __len__(self):
+        return len(self.starts)
+
+    def is_current(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_mtime_ns, st.st_size) == (self.mtime, self.size)
+
+    @property
+    def nbytes(self):
+        return self.starts.itemsize * len(self.starts) + self.ends.itemsize * len(self.ends)
+
+
+def _scan_history(buf):
+    """(starts, ends) of the elements of buf's top-level "history" array. Raises ValueError."""
+    starts = array('Q')
+    ends = array('Q')
+    depth = 0
+    pending_key = None  # a string just seen at depth 1, waiting for its ':'
+    expect_history = False  # after '"history":', waiting for '['
+    array_depth = None
+    element_start = None
+
+    for match in _TOKEN.finditer(buf):
+        token = match.group()
+        start = match.start()
+        if array_depth is not None:
+            if token == b'[' or token == b'{':
+                depth += 1
+            elif token == b']' or token == b'}':
+                depth -= 1
+                if depth < array_depth:
+                    _close_element(buf, element_start, start, starts, ends)
+                    return starts, ends
+            elif token == b',' and depth == array_depth:
+                _close_element(buf, element_start, start, starts, ends)
+                element_start = start + 1
+            continue
+
+        if expect_history:
+            if token != b'[':
+                raise ValueError("history is not an array")
+            depth += 1
+            array_depth = depth
+            element_start = start + 1
+            continue
+        if token == b'{' or token == b'[':
+            depth += 1
+        elif token == b'}' or token == b']':
+            depth -= 1
+        elif token == b':':
+            expect_history = depth == 1 and pending_key == b'"history"'
+        if depth == 1 and token[:1] == b'"':
+            pending_key = token
+        elif token != b':':
+            pending_key = None
+
+    raise ValueError("No history array found in JSON")
+
+
+def _close_element(buf, element_start, end, starts, ends):
+    # Strip the whitespace around an element; an empty range is "[]"
+    while element_start < end and buf[element_start:element_start + 1].isspace():
+        element_start += 1
+    last = end
+    while last > element_start and buf[last - 1:last].isspace():
+        last -= 1
+    if last > element_start:
+        starts.append(element_start)
+        ends.append(last)
+
+
+def build_offsets(path):
+    """Scan `path` and return its HistoryOffsets. Raises ValueError if it has no history array."""
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        if st.st_size == 0:
+            raise ValueError("File is empty")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            starts, ends = _scan_history(buf)
+    return HistoryOffsets(path, st.st_mtime_ns, st.st_size, starts, ends)
+
+
+class LazyHistory(Sequence):
+    """
+    Read-only sequence over the history entries of a file, parsing each entry
+    when it is first accessed. Use as a context manager to keep the file
+    mapped for a batch of reads.
+    """
+
+    def __init__(self, offsets):
+        self.offsets = offsets
+        self._file = None
+        self._buf = None
+        self._parsed = {}
+
+    def __enter__(self):
+        self._file = open(self.offsets.path, 'rb')
+        self._buf = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self
+
+    def __exit__(self, *exc):
+        self._buf.close()
+        self._file.close()
+        self._buf = self._file = None
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        if index not in self._parsed:
+            raw = self._buf[self.offsets.starts[index]:self.offsets.ends[index]]
+            self._parsed[index] = codec.loads(raw)
+        return self._parsed[index]
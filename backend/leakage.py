@@ -0,0 +1,151 @@
+"""
+Deterministic pre-scan of a trajectory for gold patch leakage.
+
+The gold patch (a unified diff) is indexed per hunk: its added and removed
+lines, whitespace-normalized, for exact line matches, and the token n-gram
+shingles of those lines for fuzzy matches (code quoted inside a sentence,
+reformatted, or partially changed). Every field of every step is then checked
+against the index with set operations only, so a whole trajectory is scanned in
+well under a second. Matches point reviewers (or a follow-up LLM check) at the
+steps worth a closer look; they are not a verdict.
+"""
+import re
+
+from trajectory import iter_steps
+
+# Lines shorter than this after normalization (braces, "else:", "return") are not indexed
+MIN_LINE_CHARS = 12
+# Tokens per shingle
+SHINGLE_SIZE = 5
+# A fuzzy match needs this many shared shingles and this fraction of the hunk side's shingles
+MIN_SHARED_SHINGLES = 3
+MIN_FUZZY_SCORE = 0.5
+
+_HUNK_HEADER = re.compile(r'^@@ -\d+(?:,(\d+))? \+\d+(?:,(\d+))? @@')
+_TOKEN = re.compile(r'\w+|[^\w\s]')
+
+
+def normalize_line(line):
+    """Collapse whitespace so indentation and spacing differences still match exactly."""
+    return ' '.join(line.split())
+
+
+def shingles(text):
+    """The set of SHINGLE_SIZE-token tuples of `text`."""
+    tokens = _TOKEN.findall(text)
+    return set(zip(*(tokens[i:] for i in range(SHINGLE_SIZE))))
+
+
+def parse_unified_diff(diff):
+    """
+    Hunks of a unified diff as dicts with "index", "file", "header", "added"
+    and "removed" (lists of line texts without their +/- prefix).
+    """
+    hunks = []
+    current_file = None
+    hunk = None
+    old_left = new_left = 0
+    for line in diff.splitlines():
+        if hunk is not None and (old_left > 0 or new_left > 0):
+            # Inside a hunk, counted by its header, so "--- " / "+++ " lines are content
+            if line.startswith('+'):
+                hunk["added"].append(line[1:])
+                new_left -= 1
+            elif line.startswith('-'):
+                hunk["removed"].append(line[1:])
+                old_left -= 1
+            elif not line.startswith('\\'):
+                old_left -= 1
+                new_left -= 1
+            continue
+        header = _HUNK_HEADER.match(line)
+        if header:
+            old_left = int(header.group(1) or 1)
+            new_left = int(header.group(2) or 1)
+            hunk = {"index": len(hunks), "file": current_file, "header": line, "added": [], "removed": []}
+            hunks.append(hunk)
+        elif line.startswith('+++ '):
+            path = line[4:].split('\t', 1)[0].strip()
+            current_file = path[2:] if path.startswith('b/') else path
+    return hunks
+
+
+class PatchIndex:
+    """Exact-line and shingle index of the added / removed lines of a gold patch."""
+
+    def __init__(self, diff):
+        self.hunks = parse_unified_diff(diff)
+        # normalized line -> [(hunk index, "added" | "removed")]
+        self.lines = {}
+        # shingle -> {(hunk index, kind)}
+        self.shingles = {}
+        # (hunk index, kind) -> number of distinct shingles
+        self.shingle_counts = {}
+        for hunk in self.hunks:
+            for kind in ("added", "removed"):
+                key = (hunk["index"], kind)
+                kept = []
+                for line in hunk[kind]:
+                    normalized = normalize_line(line)
+                    if len(normalized) < MIN_LINE_CHARS:
+                        continue
+                    self.lines.setdefault(normalized, []).append(key)
+                    kept.append(normalized)
+                side = shingles("\n".join(kept))
+                for shingle in side:
+                    self.shingles.setdefault(shingle, set()).add(key)
+                if side:
+                    self.shingle_counts[key] = len(side)
+
+    def scan_text(self, text):
+        """
+        Matches of one text: {(hunk index, kind): {"lines": [...], "score": float}}
+        with the exact lines found and the fraction of the side's shingles present.
+        """
+        found = {}
+        normalized = {normalize_line(line) for line in text.splitlines()}
+        for line in normalized.intersection(self.lines):
+            for key in self.lines[line]:
+                found.setdefault(key, {"lines": [], "score": 0.0})["lines"].append(line)
+
+        shared = {}
+        for shingle in shingles(text).intersection(self.shingles):
+            for key in self.shingles[shingle]:
+                shared[key] = shared.get(key, 0) + 1
+        for key, count in shared.items():
+            score = count / self.shingle_counts[key]
+            if count >= min(MIN_SHARED_SHINGLES, self.shingle_counts[key]) and score >= MIN_FUZZY_SCORE:
+                found.setdefault(key, {"lines": [], "score": 0.0})["score"] = round(score, 3)
+        return found
+
+
+def scan_history(history, diff, kinds=("added", "removed")):
+    """
+    Scan every step of `history` for lines of the gold patch `diff`.
+
+    Returns (matches, hunks): one match per step, field, hunk and side
+    ("added" / "removed") with the exact lines found ("lines", sorted) and the
+    fuzzy shingle score, ordered by step; and the parsed hunks.
+    """
+    index = PatchIndex(diff)
+    matches = []
+    for step in iter_steps(history):
+        for field, text in step.fields():
+            if not isinstance(text, str) or not text:
+                continue
+            for (hunk_index, kind), found in sorted(index.scan_text(text).items()):
+                if kind not in kinds:
+                    continue
+                hunk = index.hunks[hunk_index]
+                matches.append({
+                    "step": step.number,
+                    "field": field,
+                    "hunk": hunk_index,
+                    "file": hunk["file"],
+                    "header": hunk["header"],
+                    "kind": kind,
+                    "match": "exact" if found["lines"] else "fuzzy",
+                    "lines": sorted(found["lines"]),
+                    "score": found["score"],
+                })
+    return matches, index.hunks
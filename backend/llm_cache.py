@@ -0,0 +1,259 @@
+"""
+Cache of LLM responses keyed by the full upstream request.
+
+Responses live in an in-memory LRU in front of an optional SQLite table, both
+subject to a TTL; the table is additionally capped by entry count. Concurrent
+identical requests are coalesced so that only one of them calls upstream while
+the others wait for its result.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+import codec
+from lru import LRUCache
+
+
+def request_key(**request):
+    """Stable key for an upstream request (model, messages, tools, ...)."""
+    encoded = json.dumps(request, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+
+class _Flight:
+    def __init__(self):
+        self.event = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class ResponseCache:
+    def __init__(self, path=None, ttl=7 * 24 * 3600, max_entries=10000, memory_entries=256):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._memory = LRUCache(max_entries=memory_entries)
+        self._lock = threading.Lock()
+        self._db = None
+        self._db_lock = threading.Lock()
+        self._inflight = {}
+        # key -> asyncio.Future, only touched from the event loop (see aget_or_compute)
+        self._ainflight = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, key, compute):
+        """
+        Return the cached value for `key`, or call `compute()` to produce it.
+
+        While one caller computes a key, other callers asking for the same key
+        block and receive its result (or its exception).
+        """
+        with self._lock:
+            value = self._get_memory(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+
+        if not leader:
+            flight.event.wait()
+            with self._lock:
+                self.coalesced += 1
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            value = self._get_disk(key)
+            with self._lock:
+                if value is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if value is None:
+                value = compute()
+                self.put(key, value)
+            else:
+                self._memory.put(key, (time.time(), value))
+            flight.value = value
+            return value
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.event.set()
+
+    async def aget_or_compute(self, key, compute, executor=None):
+        """
+        Async variant of get_or_compute(): `compute` is a coroutine function and
+        disk access runs in `executor`. Coalesces concurrent callers on the same
+        event loop without tying up a thread per waiting request.
+        """
+        loop = asyncio.get_running_loop()
+        value = self._get_memory(key)
+        if value is not None:
+            with self._lock:
+                self.hits += 1
+            return value
+
+        flight = self._ainflight.get(key)
+        if flight is not None:
+            with self._lock:
+                self.coalesced += 1
+            try:
+                return await asyncio.shield(flight)
+            except asyncio.CancelledError:
+                if not flight.cancelled():
+                    raise
+                # The leader was cancelled, not this caller: compute it here
+                return await self.aget_or_compute(key, compute, executor)
+
+        flight = self._ainflight[key] = loop.create_future()
+        try:
+            value = await loop.run_in_executor(executor, self._get_disk, key)
+            with self._lock:
+                if value is not None:
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if value is None:
+                value = await compute()
+                await loop.run_in_executor(executor, self.put, key, value)
+            else:
+                self._memory.put(key, (time.time(), value))
+            flight.set_result(value)
+            return value
+        except Exception as e:
+            flight.set_exception(e)
+            # Mark retrieved so an un-awaited flight does not log a warning
+            flight.exception()
+            raise
+        finally:
+            self._ainflight.pop(key, None)
+            if not flight.done():
+                # Cancelled, e.g. on a client disconnect: wake the followers
+                flight.cancel()
+
+    def get(self, key):
+        """Cached value for `key` or None, without computing or coalescing."""
+        value = self._get_memory(key)
+        if value is None:
+            value = self._get_disk(key)
+            if value is not None:
+                self._memory.put(key, (time.time(), value))
+        with self._lock:
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return value
+
+    def put(self, key, value):
+        now = time.time()
+        self._memory.put(key, (now, value))
+        db = self._connect()
+        if db is None:
+            return
+        with self._db_lock:
+            db.execute(
+                "INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                (key, codec.dumps_compact(value), now, now),
+            )
+            self._evict_disk(db, now)
+            db.commit()
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                "in_flight": len(self._inflight) + len(self._ainflight),
+                "memory_entries": len(self._memory),
+            }
+        db = self._connect()
+        if db is not None:
+            with self._db_lock:
+                stats["disk_entries"] = db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        return stats
+
+    def clear(self):
+        self._memory.clear()
+        db = self._connect()
+        if db is not None:
+            with self._db_lock:
+                db.execute("DELETE FROM responses")
+                db.commit()
+
+    def _get_memory(self, key):
+        entry = self._memory.get(key)
+        if entry is None:
+            return None
+        created, value = entry
+        if self.ttl is not None and time.time() - created > self.ttl:
+            self._memory.pop(key)
+            return None
+        return value
+
+    def _get_disk(self, key):
+        db = self._connect()
+        if db is None:
+            return None
+        now = time.time()
+        with self._db_lock:
+            row = db.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if self.ttl is not None and now - row[1] > self.ttl:
+                db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                db.commit()
+                return None
+            db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            db.commit()
+        return codec.loads(row[0])
+
+    def _evict_disk(self, db, now):
+        # Caller holds _db_lock
+        if self.ttl is not None:
+            db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+        if self.max_entries is not None:
+            db.execute(
+                "DELETE FROM responses WHERE key IN ("
+                " SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+
+    def _connect(self):
+        if not self.path:
+            return None
+        with self._db_lock:
+            if self._db is None:
+                try:
+                    directory = os.path.dirname(self.path)
+                    if directory:
+                        os.makedirs(directory, exist_ok=True)
+                    db = sqlite3.connect(self.path, check_same_thread=False)
+                    db.execute(
+                        "CREATE TABLE IF NOT EXISTS responses ("
+                        " key TEXT PRIMARY KEY, value TEXT NOT NULL,"
+                        " created REAL NOT NULL, accessed REAL NOT NULL)"
+                    )
+                    db.commit()
+                    self._db = db
+                except sqlite3.Error as e:
+                    logging.error(f"LLM response cache disabled, cannot open {self.path}: {e}")
+                    self.path = None
+                    return None
+            return self._db
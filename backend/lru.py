@@ -0,0 +1,110 @@
+"""
+Size-bounded least-recently-used cache shared by the sessions, the prompt and
+search index caches and the file index caches of app.py.
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread-safe least-recently-used mapping bounded by entry count and by an
+    approximate byte budget.
+
+    Every entry carries a caller-supplied size. Inserting past either limit
+    evicts the least recently used entries until the cache fits again. An entry
+    larger than the whole byte budget is rejected by put().
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value, size=0):
+        """Insert or refresh an entry. Returns False if it can never fit."""
+        if self.max_bytes is not None and size > self.max_bytes:
+            return False
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.total_bytes += size
+            self._evict()
+        return True
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return default
+            self.total_bytes -= entry[1]
+            return entry[0]
+
+    def resize(self, key, size):
+        """Update the recorded size of an existing entry."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self.total_bytes += size - entry[1]
+            self._entries[key] = (entry[0], size)
+            self._evict(keep=key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def values(self):
+        """A snapshot of the cached values, without marking them as used."""
+        with self._lock:
+            return [value for value, _ in self._entries.values()]
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _evict(self, keep=None):
+        # Caller holds the lock. The most recent entry (or `keep`) is never evicted.
+        while len(self._entries) > 1 and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.total_bytes > self.max_bytes)
+        ):
+            key, (_, size) = next(iter(self._entries.items()))
+            if key == keep:
+                self._entries.move_to_end(key)
+                continue
+            del self._entries[key]
+            self.total_bytes -= size
+            self.evictions += 1
@@ -0,0 +1,235 @@
+"""
+Pattern matchers used by /replace.
+
+compile_pattern() turns a search term into a matcher:
+
+- LiteralMatcher for terms without regex syntax (including terms whose
+  metacharacters are all backslash-escaped, as the frontend sends them), which
+  uses plain str.count / str.replace;
+- RegexMatcher otherwise, compiled with DOTALL.
+
+Replacer applies a list of search/replace pairs to a string in order, in one
+call.
+
+Compiled matchers are kept in an LRU. Every matcher operation takes an optional
+`deadline` (a time.monotonic() value). Regex terms are compiled with the
+`regex` package rather than the stdlib `re` because its matching can be
+interrupted, so even a single catastrophically backtracking match stops at the
+deadline.
+"""
+import functools
+import os
+import re
+import time
+
+import regex as _regex
+
+REGEX_CACHE_SIZE = int(os.getenv("REGEX_CACHE_SIZE", "128"))
+
+# Characters with a meaning in a regular expression
+_REGEX_META = frozenset('.^$*+?{}[]\\|()')
+
+
+class PatternTimeout(Exception):
+    """A match ran past its deadline."""
+
+
+def check_deadline(deadline):
+    """Raise PatternTimeout once `deadline` has passed."""
+    if deadline is not None and time.monotonic() > deadline:
+        raise PatternTimeout()
+
+
+def normalize_pattern(search_term):
+    """
+    Interpret common escaped newline sequences in the pattern to match actual text
+    so users can search for "\\n" and match real newlines.
+    """
+    return (
+        search_term
+        .replace('\\r\\n', '\r\n')
+        .replace('\\n', '\n')
+        .replace('\\r', '\r')
+    )
+
+
+def literal_text(pattern):
+    """The text a pattern matches if it is a plain literal, else None."""
+    chars = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 >= len(pattern):
+                return None
+            escaped = pattern[i + 1]
+            # \d, \w, \1, \b ... are regex syntax; escaped punctuation is literal
+            if escaped.isalnum() or escaped == '_':
+                return None
+            chars.append(escaped)
+            i += 2
+            continue
+        if c in _REGEX_META:
+            return None
+        chars.append(c)
+        i += 1
+    return ''.join(chars)
+
+
+class LiteralMatcher:
+    def __init__(self, pattern, literal):
+        self.pattern = pattern
+        self.literal = literal
+
+    def subn(self, repl, text, deadline=None):
+        # A replacement with backslashes needs re.sub's escape processing
+        if '\\' in repl:
+            return re.compile(re.escape(self.literal)).subn(repl, text)
+        count = text.count(self.literal)
+        if not count:
+            return text, 0
+        return text.replace(self.literal, repl), count
+
+    def spans(self, text, deadline=None):
+        start = text.find(self.literal)
+        while start != -1:
+            end = start + len(self.literal)
+            yield start, end
+            start = text.find(self.literal, end)
+
+
+class RegexMatcher:
+    def __init__(self, pattern, compiled):
+        self.pattern = pattern
+        self.compiled = compiled
+
+    def _timeout(self, deadline):
+        if deadline is None:
+            return {}
+        return {"timeout": max(deadline - time.monotonic(), 0.001)}
+
+    def subn(self, repl, text, deadline=None):
+        try:
+            return self.compiled.subn(repl, text, **self._timeout(deadline))
+        except TimeoutError:
+            raise PatternTimeout()
+
+    def spans(self, text, deadline=None):
+        try:
+            for match in self.compiled.finditer(text, **self._timeout(deadline)):
+                yield match.span()
+        except TimeoutError:
+            raise PatternTimeout()
+
+
+@functools.lru_cache(maxsize=REGEX_CACHE_SIZE)
+def _compile(normalized):
+    literal = literal_text(normalized)
+    if literal:
+        return LiteralMatcher(normalized, literal)
+    try:
+        return RegexMatcher(normalized, _regex.compile(normalized, _regex.DOTALL | _regex.VERSION0))
+    except _regex.error as e:
+        raise re.error(str(e))
+
+
+def compile_pattern(search_term):
+    """Matcher for a /replace search term. Raises re.error for invalid patterns."""
+    return _compile(normalize_pattern(search_term))
+
+
+def _can_overlap(a, b):
+    """Whether occurrences of the strings `a` and `b` can overlap, or one contain the other."""
+    if a in b or b in a:
+        return True
+    return any(a.endswith(b[:n]) or a.startswith(b[-n:]) for n in range(1, len(b)))
+
+
+class MultiLiteralMatcher:
+    """
+    Several literal terms matched together in one scan. At each position the
+    longest term wins, and replaced text is never re-scanned, so the terms are
+    replaced simultaneously rather than one after another.
+    """
+
+    def __init__(self, literals):
+        # Longest first: alternation is leftmost-first, so this is leftmost-longest
+        ordered = sorted(set(literals), key=len, reverse=True)
+        self.compiled = re.compile("|".join(re.escape(lit) for lit in ordered))
+
+    def subn_many(self, replacements, text):
+        """Replace every term with `replacements[term]`. Returns (text, {term: count})."""
+        counts = {}
+
+        def substitute(match):
+            term = match.group(0)
+            counts[term] = counts.get(term, 0) + 1
+            return replacements[term]
+
+        return self.compiled.sub(substitute, text), counts
+
+
+class Replacer:
+    """
+    An ordered list of (search_term, replace_term) pairs applied to a string
+    one after another, in order, in one call. Runs of consecutive literal terms
+    (with backslash-free replacements) share a single MultiLiteralMatcher scan
+    when that gives the same result: no two terms of the run can overlap, and
+    no replacement can contain or form (with the text around it) a later term.
+    Per-pair match counts accumulate in `counts`.
+    """
+
+    def __init__(self, pairs):
+        self.counts = [0] * len(pairs)
+        self.matchers = []
+        # ("single", index, matcher, repl) or ("multi", matcher, {literal: repl}, {literal: index})
+        self.stages = []
+        run = []
+
+        def flush():
+            if len(run) == 1:
+                index, matcher, repl = run[0]
+                self.stages.append(("single", index, matcher, repl))
+            elif run:
+                replacements, indices = {}, {}
+                for index, matcher, repl in run:
+                    replacements[matcher.literal] = repl
+                    indices[matcher.literal] = index
+                self.stages.append(("multi", MultiLiteralMatcher(replacements), replacements, indices))
+            run.clear()
+
+        for index, (search_term, replace_term) in enumerate(pairs):
+            matcher = compile_pattern(search_term)
+            self.matchers.append(matcher)
+            if isinstance(matcher, LiteralMatcher) and '\\' not in replace_term:
+                literal = matcher.literal
+                if any(_can_overlap(earlier.literal, literal) or _can_overlap(repl, literal)
+                       for _, earlier, repl in run):
+                    # Scanning together would not see what the earlier pairs produce
+                    flush()
+                run.append((index, matcher, replace_term))
+                continue
+            flush()
+            self.stages.append(("single", index, matcher, replace_term))
+        flush()
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def subn(self, text, deadline=None):
+        """Apply every pair to `text`. Returns (new_text, replacements made)."""
+        total = 0
+        for stage in self.stages:
+            if stage[0] == "single":
+                _, index, matcher, repl = stage
+                text, count = matcher.subn(repl, text, deadline)
+                self.counts[index] += count
+                total += count
+            else:
+                _, matcher, replacements, indices = stage
+                text, counts = matcher.subn_many(replacements, text)
+                for literal, count in counts.items():
+                    self.counts[indices[literal]] += count
+                    total += count
+        return text, total
@@ -0,0 +1,320 @@
+"""
+Per-request instrumentation: phase timers, Prometheus metrics and an
+on-demand sampling profiler.
+
+Code anywhere in a request wraps its expensive parts in ``with phase("name"):``.
+The durations are collected for the current request (a context variable, so
+phase() is a no-op outside one, e.g. in batch.py or pool threads) and, once the
+response is ready, reported three ways: a ``Server-Timing`` header, one JSON
+log line on the ``traj_reviewer.requests`` logger, and the histograms rendered
+by /metrics in the Prometheus text format. Streamed responses are measured up
+to their first byte. init_app() installs this on the Flask app; asgi.py uses
+start_timer() and record() for the routes it serves natively.
+
+With PROFILE_REQUESTS=1, a request sent with ``X-Profile: 1`` (or
+``?profile=1``) is sampled by a background thread every PROFILE_INTERVAL
+seconds; the collapsed stacks (flamegraph.pl / speedscope format) are written
+under PROFILE_DIR and named in the ``X-Profile-File`` response header.
+"""
+import contextvars
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "1") == "1"
+REQUEST_LOG = os.getenv("REQUEST_LOG", "1") == "1"
+PROFILE_REQUESTS = os.getenv("PROFILE_REQUESTS", "0") == "1"
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("data", "profiles"))
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# 256 bytes to 256 MiB
+BYTES_BUCKETS = tuple(256 * 4 ** i for i in range(11))
+TOKEN_BUCKETS = (1000, 5000, 10000, 25000, 50000, 100000, 200000, 500000, 1000000)
+
+logger = logging.getLogger("traj_reviewer.requests")
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # labels -> [per-bucket counts (last is +Inf), sum]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = next((i for i, bound in enumerate(self.buckets) if value <= bound), len(self.buckets))
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+
+    def count(self, labels=()):
+        series = self._series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), counts):
+                    cumulative += count
+                    le = bound if bound == "+Inf" else f"{bound:g}"
+                    lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, ('le', le))} {cumulative}")
+                lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {total:.6g}")
+                lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def counter(self, name, help, labelnames=()):
+        metric = Counter(name, help, labelnames)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        metric = Histogram(name, help, labelnames, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+REQUESTS = REGISTRY.counter(
+    "traj_http_requests_total", "HTTP requests by route, method and status.", ("route", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram(
+    "traj_http_request_duration_seconds", "Time to the first byte of the response.", ("route",))
+PHASE_SECONDS = REGISTRY.histogram(
+    "traj_phase_duration_seconds", "Time spent in each phase of a request.", ("route", "phase"))
+REQUEST_BYTES = REGISTRY.histogram(
+    "traj_http_request_bytes", "Request body sizes.", ("route",), BYTES_BUCKETS)
+RESPONSE_BYTES = REGISTRY.histogram(
+    "traj_http_response_bytes", "Response body sizes (not measured for streamed responses).", ("route",), BYTES_BUCKETS)
+PROMPT_TOKENS = REGISTRY.histogram(
+    "traj_prompt_tokens", "Estimated tokens of the system prompts sent upstream.", ("route",), TOKEN_BUCKETS)
+UPSTREAM_REQUESTS = REGISTRY.counter(
+    "traj_upstream_requests_total", "Chat completion requests sent to the LLM provider by outcome.", ("outcome",))
+UPSTREAM_ERRORS = REGISTRY.counter(
+    "traj_upstream_errors_total", "Failed chat completion requests by exception type.", ("error",))
+UPSTREAM_RETRIES = REGISTRY.counter(
+    "traj_upstream_retries_total", "Chat completion requests retried after a rate limit.")
+
+
+class RequestTimer:
+    """Phase durations of one request."""
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        # phase -> seconds, in the order phases first ran
+        self.phases = {}
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def server_timing(self, total):
+        entries = [f"{name};dur={seconds * 1000:.2f}" for name, seconds in self.phases.items()]
+        entries.append(f"total;dur={total * 1000:.2f}")
+        return ", ".join(entries)
+
+
+_current_timer = contextvars.ContextVar("request_timer", default=None)
+
+
+@contextmanager
+def phase(name):
+    """Time the enclosed block as phase `name` of the current request, if any."""
+    timer = _current_timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def start_timer(route):
+    """Time a request to `route` in the current context. Returns the timer and the token for stop_timer()."""
+    timer = RequestTimer(route)
+    return timer, _current_timer.set(timer)
+
+
+def stop_timer(token):
+    _current_timer.reset(token)
+
+
+def record(timer, method, status, total, request_bytes, response_bytes):
+    """Count a request answered `total` seconds after it started in /metrics and log it."""
+    route = timer.route
+    REQUESTS.inc((route, method, str(status)))
+    REQUEST_SECONDS.observe(total, (route,))
+    for name, seconds in timer.phases.items():
+        PHASE_SECONDS.observe(seconds, (route, name))
+    REQUEST_BYTES.observe(request_bytes, (route,))
+    if response_bytes is not None:
+        RESPONSE_BYTES.observe(response_bytes, (route,))
+    if REQUEST_LOG:
+        logger.info(json.dumps({
+            "route": route,
+            "method": method,
+            "status": status,
+            "duration_ms": round(total * 1000, 3),
+            "phases_ms": {name: round(seconds * 1000, 3) for name, seconds in timer.phases.items()},
+            "request_bytes": request_bytes,
+            "response_bytes": response_bytes,
+        }))
+
+
+def current_route():
+    timer = _current_timer.get()
+    return timer.route if timer is not None else ""
+
+
+def observe_prompt_tokens(tokens):
+    PROMPT_TOKENS.observe(tokens, (current_route(),))
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread every `interval` seconds from a background thread."""
+
+    def __init__(self, thread_id, interval=PROFILE_INTERVAL):
+        self.thread_id = thread_id
+        self.interval = interval
+        # collapsed stack ("outer;...;inner") -> samples
+        self.stacks = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        return self.stacks
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                key = ";".join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+
+
+def write_profile(stacks, route):
+    """Write collapsed stacks under PROFILE_DIR. Returns the file's path."""
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    slug = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{uuid.uuid4().hex[:6]}.folded")
+    with open(path, 'w') as f:
+        for stack, count in sorted(stacks.items(), key=lambda item: -item[1]):
+            f.write(f"{stack} {count}\n")
+    return path
+
+
+def init_app(app):
+    """Install the request hooks on a Flask app."""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        g.metrics_timer, g.metrics_token = start_timer(route)
+        g.metrics_profiler = None
+        if PROFILE_REQUESTS and (request.headers.get("X-Profile") == "1" or request.args.get("profile") == "1"):
+            g.metrics_profiler = SamplingProfiler(threading.get_ident()).start()
+
+    @app.after_request
+    def _record(response):
+        timer = g.pop("metrics_timer", None)
+        if timer is None:
+            return response
+        total = time.perf_counter() - timer.started
+        response_bytes = None if response.is_streamed else response.calculate_content_length()
+        record(timer, request.method, response.status_code, total, request.content_length or 0, response_bytes)
+
+        if SERVER_TIMING:
+            response.headers["Server-Timing"] = timer.server_timing(total)
+        profiler = g.pop("metrics_profiler", None)
+        if profiler is not None:
+            response.headers["X-Profile-File"] = write_profile(profiler.stop(), timer.route)
+        return response
+
+    @app.teardown_request
+    def _reset_timer(exc):
+        timer = g.pop("metrics_timer", None)
+        if timer is not None:
+            # after_request never saw a response: the view raised past Flask's error handling
+            total = time.perf_counter() - timer.started
+            record(timer, request.method, 500, total, request.content_length or 0, None)
+        token = g.pop("metrics_token", None)
+        if token is not None:
+            stop_timer(token)
+        profiler = g.pop("metrics_profiler", None)
+        if profiler is not None:
+            profiler.stop()
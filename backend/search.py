@@ -0,0 +1,266 @@
+"""
+Inverted index and ranked search over the steps of a trajectory.
+
+Steps are read as trajectory.Step records, so a step's fields are exactly
+what /chat sends to the model: step 0's "content" and every later step's
+"thought", "action" and "observation". Words (``\\w+``, lowercased) are indexed
+with their positions; character offsets are only computed for the highlights of
+returned results.
+
+A query is a list of clauses separated by whitespace:
+
+- ``word``: the word anywhere in a step; ``word*`` for any word with that prefix
+- ``"some phrase"``: consecutive words; a bare term that tokenizes to several
+  words (``setup.py``) is a phrase too
+- ``field:word`` / ``field:"some phrase"``: restricted to one field
+
+Steps matching any clause are returned ranked by BM25 (steps matching all
+clauses with ``require_all``), each with the character offsets to highlight.
+"""
+import math
+import re
+
+from trajectory import get_step, history_step, iter_steps
+
+FIELDS = ("content", "thought", "action", "observation")
+
+_WORD = re.compile(r"\w+")
+_CLAUSE = re.compile(r'(?:(\w+):)?(?:"([^"]*)"?|(\S+))')
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """The words of `text`, lowercased."""
+    return [word.lower() for word in _WORD.findall(text)]
+
+
+def parse_query(query):
+    """
+    Parse a query into clauses (field or None, words, prefix). Raises
+    ValueError for an unknown field.
+    """
+    clauses = []
+    for match in _CLAUSE.finditer(query):
+        field, phrase, term = match.groups()
+        text = phrase if phrase is not None else term
+        prefix = phrase is None and text.endswith("*")
+        if field is not None and field not in FIELDS:
+            # Not a field scope, e.g. "http://..."; search the whole term
+            if phrase is None:
+                text, field = match.group(0), None
+            else:
+                raise ValueError(f"Unknown field {field!r}; expected one of {', '.join(FIELDS)}")
+        words = tokenize(text)
+        if words:
+            clauses.append((field, words, prefix and len(words) == 1))
+    return clauses
+
+
+class StepIndex:
+    """
+    Positional inverted index of one history's steps.
+
+    Edits to the history are reported with invalidate(); the affected steps are
+    re-indexed by the next refresh() rather than rebuilding the whole index.
+    """
+
+    def __init__(self, history):
+        # word -> {(step, field): [positions]}
+        self.postings = {}
+        # (step, field) -> indexed text, re-tokenized for the highlights of results
+        self.texts = {}
+        # (step, field) -> the distinct words indexed for it
+        self.words = {}
+        # step -> number of words over all fields
+        self.lengths = {}
+        self._total_length = 0
+        self._dirty = set()
+        self._rebuild = False
+        self._build(history)
+
+    def _build(self, history):
+        self.postings.clear()
+        self.texts.clear()
+        self.words.clear()
+        self.lengths.clear()
+        self._total_length = 0
+        for step in iter_steps(history):
+            self._add_step(step)
+
+    def _add_step(self, step):
+        step_number = step.number
+        length = 0
+        for field, text in step.fields():
+            if not isinstance(text, str) or not text:
+                continue
+            key = (step_number, field)
+            words = tokenize(text)
+            if not words:
+                continue
+            positions = {}
+            for position, word in enumerate(words):
+                found = positions.get(word)
+                if found is None:
+                    positions[word] = [position]
+                else:
+                    found.append(position)
+            postings = self.postings
+            for word, found in positions.items():
+                entries = postings.get(word)
+                if entries is None:
+                    postings[word] = {key: found}
+                else:
+                    entries[key] = found
+            self.texts[key] = text
+            self.words[key] = positions.keys()
+            length += len(words)
+        self.lengths[step_number] = length
+        self._total_length += length
+
+    def _remove_step(self, step_number):
+        if step_number not in self.lengths:
+            return
+        self._total_length -= self.lengths.pop(step_number)
+        for field in FIELDS:
+            key = (step_number, field)
+            self.texts.pop(key, None)
+            for word in self.words.pop(key, ()):
+                entries = self.postings[word]
+                del entries[key]
+                if not entries:
+                    del self.postings[word]
+
+    @property
+    def num_steps(self):
+        return len(self.lengths)
+
+    def invalidate(self, ops=None):
+        """
+        Mark the steps touched by JSON Patch `ops` (see edits) for re-indexing.
+        Without ops, or when whole messages were added or removed (which
+        renumbers the following steps), the next refresh() rebuilds everything;
+        a replaced message only dirties its step.
+        """
+        if ops is None:
+            self._rebuild = True
+            return
+        for op in ops:
+            parts = op.get("path", "").split("/")
+            if len(parts) < 3 or parts[1] != "history":
+                continue
+            if len(parts) == 3 and op.get("op") != "replace":
+                self._rebuild = True
+                return
+            try:
+                history_index = int(parts[2])
+            except ValueError:
+                continue
+            step_number = history_step(history_index)
+            if step_number is not None:
+                self._dirty.add(step_number)
+
+    def refresh(self, history):
+        """Bring the index up to date with `history` after invalidate()."""
+        if self._rebuild:
+            self._rebuild = False
+            self._dirty.clear()
+            self._build(history)
+            return
+        for step_number in sorted(self._dirty):
+            self._remove_step(step_number)
+            step = get_step(history, step_number)
+            if step is not None:
+                self._add_step(step)
+        self._dirty.clear()
+
+    def _word_matches(self, word, prefix):
+        if not prefix:
+            return self.postings.get(word, {})
+        merged = {}
+        for candidate, entries in self.postings.items():
+            if candidate.startswith(word):
+                for key, positions in entries.items():
+                    merged.setdefault(key, []).extend(positions)
+        return merged
+
+    def _clause_matches(self, field, words, prefix):
+        """{(step, field): [(first_position, last_position)]} for one clause."""
+        first = self._word_matches(words[0], prefix)
+        matches = {}
+        for key, positions in first.items():
+            if field is not None and key[1] != field:
+                continue
+            if len(words) == 1:
+                matches[key] = [(p, p) for p in sorted(positions)]
+                continue
+            following = []
+            for word in words[1:]:
+                entries = self.postings.get(word, {})
+                if key not in entries:
+                    break
+                following.append(set(entries[key]))
+            else:
+                hits = [
+                    (p, p + len(following)) for p in sorted(positions)
+                    if all(p + k + 1 in s for k, s in enumerate(following))
+                ]
+                if hits:
+                    matches[key] = hits
+        return matches
+
+    def search(self, query, limit=50, require_all=False):
+        """
+        Rank steps against `query`. Returns (results, total) where each result
+        is {"step", "score", "highlights": [{"field", "start", "end"}]},
+        best first, at most `limit` of them.
+        """
+        clauses = parse_query(query)
+        num_steps = self.num_steps
+        if not clauses or not num_steps:
+            return [], 0
+        average_length = self._total_length / num_steps or 1
+
+        scores = {}
+        highlights = {}
+        matched_clauses = {}
+        for clause in clauses:
+            per_step = {}
+            for (step_number, field), hits in self._clause_matches(*clause).items():
+                per_step.setdefault(step_number, []).append((field, hits))
+            if not per_step:
+                continue
+            idf = math.log(1 + (num_steps - len(per_step) + 0.5) / (len(per_step) + 0.5))
+            for step_number, fields in per_step.items():
+                tf = sum(len(hits) for _, hits in fields)
+                norm = K1 * (1 - B + B * self.lengths[step_number] / average_length)
+                scores[step_number] = scores.get(step_number, 0.0) + idf * tf * (K1 + 1) / (tf + norm)
+                matched_clauses[step_number] = matched_clauses.get(step_number, 0) + 1
+                highlights.setdefault(step_number, []).extend(fields)
+
+        if require_all:
+            matching = [s for s, n in matched_clauses.items() if n == len(clauses)]
+        else:
+            matching = list(scores)
+        matching.sort(key=lambda s: (-scores[s], s))
+        results = [
+            {"step": s, "score": round(scores[s], 4), "highlights": self._highlights(s, highlights[s])}
+            for s in matching[:limit]
+        ]
+        return results, len(matching)
+
+    def _highlights(self, step_number, fields):
+        """Character offsets of the (first, last) word position ranges in `fields`."""
+        by_field = {}
+        for field, hits in fields:
+            by_field.setdefault(field, []).extend(hits)
+        highlights = []
+        for field in FIELDS:
+            if field not in by_field:
+                continue
+            spans = [m.span() for m in _WORD.finditer(self.texts[(step_number, field)])]
+            ranges = {(spans[first][0], spans[last][1]) for first, last in by_field[field]}
+            highlights.extend({"field": field, "start": start, "end": end} for start, end in sorted(ranges))
+        return highlights
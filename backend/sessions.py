@@ -0,0 +1,208 @@
+"""
+In-memory trajectory sessions.
+
+A session holds the parsed ``history`` of an uploaded trajectory so that edits
+can address it by document id instead of re-sending and re-parsing the whole
+JSON document on every request.
+
+Edits replace ``session.history`` with a new list rather than changing it in
+place, and the messages an edit does not touch are shared between the two
+lists. A session keeps up to UNDO_DEPTH earlier versions this way for undo and
+redo, at the cost of one list of references plus the edited messages each.
+That cost is estimated per version and counted with the session's size
+against the store's memory cap; past the cap, the oldest versions are dropped.
+"""
+import collections
+import functools
+import os
+import threading
+import uuid
+
+import codec
+from edits import diff_histories, history_hash
+from lru import LRUCache
+from trajectory import num_steps
+
+
+# Recent edits a session remembers for journaled saves, see storage.save_session()
+EDIT_LOG_SIZE = 100
+# Earlier versions a session keeps for undo
+UNDO_DEPTH = int(os.getenv("UNDO_DEPTH", "100"))
+
+
+def _version_cost(history, current):
+    """Approximate bytes `history` keeps alive beyond the messages it shares with `current`."""
+    shared = {id(message) for message in current}
+    return 8 * len(history) + sum(len(codec.dumps_compact(m)) for m in history if id(m) not in shared)
+
+
+class Session:
+    def __init__(self, doc_id, history, size, max_bytes=None, on_resize=None):
+        self.doc_id = doc_id
+        self.history = history
+        # Approximate footprint, measured as the size of the uploaded JSON text
+        self.size = size
+        # Budget for the size plus the undo and redo versions, and the callback
+        # told the new footprint() after every edit
+        self.max_bytes = max_bytes
+        self.on_resize = on_resize
+        # Incremented on every successful edit
+        self.version = 0
+        # Serializes edits to the same document
+        self.lock = threading.RLock()
+        # search.StepIndex, built by the first /search and kept up to date by record_edit()
+        self.search_index = None
+        # (version, JSON Patch ops or None) of the latest edits
+        self._edit_log = collections.deque(maxlen=EDIT_LOG_SIZE)
+        # path -> {"version", "snapshot", "journal_entries", "size"} of files this session was saved to
+        self.saved = {}
+        # {"shard", "record", "id", "sha256"} of a session opened from a JSONL shard record, see shards.py
+        self.origin = None
+        # (history, cost) of the versions before the latest edits, and of the
+        # ones undo went back from; version_bytes is the sum of their costs
+        self._undo = collections.deque()
+        self._redo = collections.deque()
+        self.version_bytes = 0
+        # The history list of the current version, to tell a replaced list from one edited in place
+        self._current = history
+        self._hash = None
+        self._hash_version = None
+
+    def record_edit(self, ops):
+        """Bump the version after an edit that made the JSON Patch `ops` (None if unknown)."""
+        previous, self._current = self._current, self.history
+        if ops != []:
+            if previous is self.history:
+                # Edited in place: the previous version is gone
+                self._clear(self._undo)
+            else:
+                self._push(self._undo, previous)
+            self._clear(self._redo)
+        self._log_edit(ops)
+        self._trim()
+
+    def undo(self):
+        """
+        Go back to the version before the latest edit. Returns the JSON Patch
+        ops that did so, or None if there is nothing to undo.
+        """
+        if not self._undo:
+            return None
+        return self._switch(self._undo, self._redo)
+
+    def redo(self):
+        """Return to the version the latest undo went back from, see undo()."""
+        if not self._redo:
+            return None
+        return self._switch(self._redo, self._undo)
+
+    def _switch(self, source, target):
+        previous = self.history
+        history = self._pop(source)
+        ops = diff_histories(previous, history)
+        self.history = self._current = history
+        self._push(target, previous)
+        self._log_edit(ops)
+        self._trim()
+        return ops
+
+    def _push(self, stack, history):
+        cost = _version_cost(history, self.history)
+        stack.append((history, cost))
+        self.version_bytes += cost
+
+    def _pop(self, stack, oldest=False):
+        history, cost = stack.popleft() if oldest else stack.pop()
+        self.version_bytes -= cost
+        return history
+
+    def _clear(self, stack):
+        self.version_bytes -= sum(cost for _, cost in stack)
+        stack.clear()
+
+    def _trim(self):
+        """Drop the oldest versions past UNDO_DEPTH or the memory budget, then report the footprint."""
+        for stack in (self._undo, self._redo):
+            while len(stack) > UNDO_DEPTH:
+                self._pop(stack, oldest=True)
+        while self.max_bytes is not None and self.footprint() > self.max_bytes and (self._undo or self._redo):
+            self._pop(self._undo if self._undo else self._redo, oldest=True)
+        if self.on_resize is not None:
+            self.on_resize(self.footprint())
+
+    def footprint(self):
+        """Approximate bytes held by the session: its size plus its undo and redo versions."""
+        return self.size + self.version_bytes
+
+    def _log_edit(self, ops):
+        self.version += 1
+        self._edit_log.append((self.version, ops))
+        if self.search_index is not None:
+            self.search_index.invalidate(ops)
+
+    def edits_since(self, version):
+        """
+        [{"version", "ops"}] of the edits after `version`, or None if some of
+        them are no longer (or were never) known as patch ops.
+        """
+        entries = [{"version": v, "ops": ops} for v, ops in self._edit_log if v > version]
+        if len(entries) != self.version - version or any(e["ops"] is None for e in entries):
+            return None
+        return entries
+
+    def num_steps(self):
+        return num_steps(self.history)
+
+    def content_hash(self):
+        """history_hash() of the current version, computed at most once per version."""
+        with self.lock:
+            if self._hash_version != self.version:
+                self._hash = history_hash(self.history)
+                self._hash_version = self.version
+            return self._hash
+
+    def describe(self):
+        return {
+            "doc_id": self.doc_id,
+            "version": self.version,
+            "num_steps": self.num_steps(),
+            "size": self.size,
+            "undo": len(self._undo),
+            "redo": len(self._redo),
+            "undo_bytes": self.version_bytes,
+            **({"origin": self.origin} if self.origin is not None else {}),
+        }
+
+
+class SessionStore:
+    """
+    Sessions keyed by doc_id, evicted least-recently-used past the memory cap.
+    Each session is charged its footprint(), updated as it edits.
+    """
+
+    def __init__(self, max_entries=16, max_bytes=512 * 1024 * 1024):
+        self._cache = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    @property
+    def max_bytes(self):
+        return self._cache.max_bytes
+
+    def create(self, history, size):
+        """Store a parsed history. Returns the new Session, or None if it exceeds the cap."""
+        session = Session(uuid.uuid4().hex, history, size, max_bytes=self.max_bytes)
+        if not self._cache.put(session.doc_id, session, size):
+            return None
+        session.on_resize = functools.partial(self._cache.resize, session.doc_id)
+        return session
+
+    def get(self, doc_id):
+        return self._cache.get(doc_id)
+
+    def values(self):
+        return self._cache.values()
+
+    def delete(self, doc_id):
+        return self._cache.pop(doc_id) is not None
+
+    def stats(self):
+        return self._cache.stats()
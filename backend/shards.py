@@ -0,0 +1,169 @@
+"""
+JSONL shards of trajectory records.
+
+A shard holds one JSON record per line, optionally gzip- or zstd-compressed.
+A record's history is its ``history`` list or, for chat-format records, its
+``messages`` list. Shards are only ever read as a stream, one record at a
+time: build_index() validates every record (see trajectory.pairing_errors)
+and remembers where each starts, read_record() fetches one record by number,
+and export_shard() copies a shard to a new file record by record, re-encoding
+only the records whose history was replaced. A record is replaced only if its
+line still hashes to the line_hash() it had when it was read.
+"""
+import hashlib
+import os
+from array import array
+
+import codec
+import storage
+from trajectory import pairing_errors
+
+SHARD_SUFFIXES = (".jsonl", ".jsonl.gz", ".jsonl.zst")
+
+
+class ShardError(Exception):
+    """A shard record that cannot be read or used as a trajectory."""
+
+
+def record_history(record):
+    """(key, history) of a shard record: its "history" or, failing that, its "messages" list."""
+    if not isinstance(record, dict):
+        raise ShardError("Record is not a JSON object")
+    for key in ("history", "messages"):
+        if isinstance(record.get(key), list):
+            return key, record[key]
+    raise ShardError("Record has no history or messages array")
+
+
+def record_id(record):
+    """The identifier a record carries ("instance_id" or "id"), if any."""
+    if not isinstance(record, dict):
+        return None
+    value = record.get("instance_id", record.get("id"))
+    return str(value) if value is not None else None
+
+
+class ShardIndex:
+    """Where the records of one version of a shard start, their ids and their validation problems."""
+
+    def __init__(self, path, mtime_ns, size, offsets, length, ids, errors):
+        self.path = path
+        self.mtime_ns = mtime_ns
+        self.size = size
+        # Offset of each record's line in the decompressed stream, and its length
+        self.offsets = offsets
+        self.length = length
+        self.ids = ids
+        # record number -> [problem, ...] for records that cannot be opened
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def is_current(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        return (st.st_mtime_ns, st.st_size) == (self.mtime_ns, self.size)
+
+    def record_size(self, number):
+        """Decompressed bytes of record `number`'s line."""
+        end = self.offsets[number + 1] if number + 1 < len(self) else self.length
+        return end - self.offsets[number]
+
+    def find(self, record=None, identifier=None):
+        """The number of a record given by number or id. Raises ShardError."""
+        if identifier is not None:
+            try:
+                return self.ids.index(str(identifier))
+            except ValueError:
+                raise ShardError(f"No record with id {identifier!r}")
+        if not isinstance(record, int) or not 0 <= record < len(self):
+            raise ShardError(f"record must be a number from 0 to {len(self) - 1}")
+        return record
+
+
+def build_index(path):
+    """Read the shard at `path` record by record and return its ShardIndex."""
+    st = os.stat(path)
+    offsets = array('Q')
+    ids = []
+    errors = {}
+    offset = 0
+    with storage.open_decompressed(path) as f:
+        for line in f:
+            start = offset
+            offset += len(line)
+            if not line.strip():
+                continue
+            number = len(offsets)
+            offsets.append(start)
+            try:
+                record = codec.loads(line)
+                problems = pairing_errors(record_history(record)[1])
+            except (ValueError, ShardError) as e:
+                record, problems = None, [str(e)]
+            ids.append(record_id(record))
+            if problems:
+                errors[number] = problems
+    return ShardIndex(path, st.st_mtime_ns, st.st_size, offsets, offset, ids, errors)
+
+
+def line_hash(line):
+    """SHA-256 of a record's line, without its line ending."""
+    return hashlib.sha256(line.rstrip(b"\r\n")).hexdigest()
+
+
+def read_record(index, number):
+    """Record `number` of the shard of `index`, read without decoding the records before it."""
+    return codec.loads(read_line(index, number))
+
+
+def read_line(index, number):
+    """The undecoded line of record `number`, see read_record()."""
+    with storage.open_decompressed(index.path) as f:
+        if storage.is_compressed(index.path):
+            # Compressed streams can only be skipped through
+            remaining = index.offsets[number]
+            while remaining:
+                skipped = len(f.read(min(remaining, 1 << 20)))
+                if not skipped:
+                    raise ShardError("Shard is shorter than its index")
+                remaining -= skipped
+        else:
+            f.seek(index.offsets[number])
+        return f.readline()
+
+
+def export_shard(src, dst, histories, compression=None, origins=None):
+    """
+    Stream the shard `src` to `dst`, written atomically and compressed as
+    asked, with the history of the records numbered in `histories` replaced.
+    Every other line is copied as-is. `origins` maps record numbers to the
+    line_hash() the records had when read; a record whose line no longer
+    matches raises ShardError and leaves `dst` untouched. Returns (records,
+    replaced, written), `written` mapping the replaced records' numbers to the
+    line_hash() of their new lines.
+    """
+    origins = origins or {}
+    number = 0
+    written = {}
+    with storage.open_decompressed(src) as f, storage.atomic_writer(dst, compression) as out:
+        for line in f:
+            if not line.strip():
+                out.write(line)
+                continue
+            if number in histories:
+                if number in origins and line_hash(line) != origins[number]:
+                    raise ShardError(f"Record {number} changed since it was opened")
+                record = codec.loads(line)
+                key, _ = record_history(record)
+                record[key] = histories[number]
+                line = codec.dumps_compact(record).encode('utf-8') + b"\n"
+                written[number] = line_hash(line)
+            elif not line.endswith(b"\n"):
+                line += b"\n"
+            out.write(line)
+            number += 1
+    return number, len(written), written
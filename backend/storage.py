@@ -0,0 +1,335 @@
+"""
+Saved trajectory files: atomic writes, optional compression and edit journals.
+
+A saved document is a snapshot file, written atomically (temporary file,
+fsync, rename), optionally gzip- or zstd-compressed; compression is detected
+from the file's magic bytes when it is read back. Saves of a session whose
+previous version is already on disk append the JSON Patch ops of the edits
+made since then to ``<file>.journal`` instead of rewriting the snapshot. The
+journal's first line identifies the snapshot it applies to by the sha256 of
+the snapshot file, so a journal left behind by another snapshot is never
+applied, while touching or copying the files keeps it valid. Once the journal
+holds too many entries or grows past a fraction of the snapshot, the next save
+writes a full snapshot and drops it.
+"""
+import gzip
+import hashlib
+import io
+import json
+import os
+import tempfile
+from contextlib import contextmanager
+
+import codec
+from edits import apply_patch
+
+try:
+    import zstandard
+except ImportError:  # optional dependency
+    zstandard = None
+
+JOURNAL_MAX_ENTRIES = int(os.getenv("JOURNAL_MAX_ENTRIES", "100"))
+# Compact into a snapshot once the journal exceeds this fraction of the snapshot's size
+JOURNAL_MAX_RATIO = float(os.getenv("JOURNAL_MAX_RATIO", "0.5"))
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+_GZIP_MAGIC = b"\x1f\x8b"
+_ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+
+
+class StorageError(Exception):
+    """A save or load that cannot be performed as requested."""
+
+
+def journal_path(path):
+    return path + ".journal"
+
+
+def compressed_path(path, compression):
+    """`path` with the suffix of `compression` ("gzip", "zstd" or None) appended if missing."""
+    if not compression:
+        return path
+    if compression not in COMPRESSION_SUFFIXES:
+        raise StorageError(f"Unknown compression {compression!r}; expected gzip or zstd")
+    suffix = COMPRESSION_SUFFIXES[compression]
+    return path if path.endswith(suffix) else path + suffix
+
+
+def compress(data, compression):
+    if not compression:
+        return data
+    if compression == "gzip":
+        return gzip.compress(data, compresslevel=6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise StorageError("zstd compression needs the zstandard package")
+        return zstandard.ZstdCompressor().compress(data)
+    raise StorageError(f"Unknown compression {compression!r}; expected gzip or zstd")
+
+
+def decompress(data):
+    """The content of `data`, decompressed if it starts with a gzip or zstd header."""
+    if data.startswith(_GZIP_MAGIC):
+        return gzip.decompress(data)
+    if data.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise StorageError("Reading zstd files needs the zstandard package")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+    return data
+
+
+def is_compressed(path):
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    return head.startswith(_GZIP_MAGIC) or head.startswith(_ZSTD_MAGIC)
+
+
+def compression_of(path):
+    """The compression a file name asks for by its suffix: "gzip", "zstd" or None."""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if path.endswith(suffix):
+            return compression
+    return None
+
+
+def open_decompressed(path):
+    """`path` opened for streaming binary reads, decompressed if it starts with a gzip or zstd header."""
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    if head.startswith(_GZIP_MAGIC):
+        return gzip.open(path, 'rb')
+    if head.startswith(_ZSTD_MAGIC):
+        if zstandard is None:
+            raise StorageError("Reading zstd files needs the zstandard package")
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'), closefd=True))
+    return open(path, 'rb')
+
+
+def _fsync_directory(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+@contextmanager
+def atomic_writer(path, compression=None):
+    """
+    A binary file whose content replaces `path` when the block exits without
+    an error, compressed on the fly; readers see either the old or the new file.
+    """
+    if compression and compression not in COMPRESSION_SUFFIXES:
+        raise StorageError(f"Unknown compression {compression!r}; expected gzip or zstd")
+    if compression == "zstd" and zstandard is None:
+        raise StorageError("zstd compression needs the zstandard package")
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            if compression == "gzip":
+                with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=6) as out:
+                    yield out
+            elif compression == "zstd":
+                with zstandard.ZstdCompressor().stream_writer(f, closefd=False) as out:
+                    yield out
+            else:
+                yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    _fsync_directory(directory)
+
+
+def write_atomic(path, data):
+    """Replace `path` with `data` (bytes) so that readers see either the old or the new file."""
+    with atomic_writer(path) as f:
+        f.write(data)
+
+
+def _file_state(path):
+    st = os.stat(path)
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def _file_state_of(f):
+    st = os.fstat(f.fileno())
+    return {"mtime_ns": st.st_mtime_ns, "size": st.st_size}
+
+
+def _content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def write_snapshot(path, text, compression=None):
+    """
+    Atomically write a full document and drop its journal. Returns the
+    snapshot's state: its file's "mtime_ns", "size" and content "sha256".
+    """
+    data = compress(text.encode('utf-8'), compression)
+    write_atomic(path, data)
+    try:
+        os.unlink(journal_path(path))
+    except FileNotFoundError:
+        pass
+    return {**_file_state(path), "sha256": _content_hash(data)}
+
+
+def _journal_header(path):
+    """The first line of the journal of `path`, or None if there is no readable one."""
+    try:
+        with open(journal_path(path)) as f:
+            return json.loads(f.readline())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _read_journal(path, sha256):
+    """
+    (entries, intact) of the journal of the snapshot whose content hash is
+    `sha256`. A journal belonging to another snapshot is ignored; `intact` is
+    False if it ends in a line cut short by a crash, after which nothing is read.
+    """
+    try:
+        f = open(journal_path(path))
+    except FileNotFoundError:
+        return [], True
+    entries = []
+    with f:
+        header = None
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                return entries, False
+            if header is None:
+                header = record
+                if header.get("sha256") != sha256:
+                    return [], True
+                continue
+            entries.append(record)
+    return entries, True
+
+
+def append_journal(path, entries, sha256, start=False):
+    """
+    Append edit entries ({"version", "ops"}) to the journal of the snapshot
+    at `path`, whose content hash is `sha256`. With `start`, a new journal is
+    begun, replacing any left behind by another snapshot.
+    """
+    jpath = journal_path(path)
+    with open(jpath, 'w' if start else 'a') as f:
+        if start:
+            f.write(json.dumps({"sha256": sha256}) + "\n")
+        for entry in entries:
+            f.write(codec.dumps_compact(entry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    if start:
+        _fsync_directory(os.path.dirname(jpath) or '.')
+
+
+def read_saved(path):
+    """
+    The document saved at `path`: its snapshot, decompressed if needed, with
+    any journaled edits applied to its history. Returns (doc, info) where info
+    has the "snapshot" state (as returned by write_snapshot()), the
+    decompressed "size" and the number of "journal_entries" applied (None if
+    the journal was damaged, in which case the next save must write a snapshot).
+    """
+    with open(path, 'rb') as f:
+        state = _file_state_of(f)
+        data = f.read()
+    state["sha256"] = _content_hash(data)
+    raw = decompress(data)
+    doc = codec.loads(raw)
+    entries, intact = _read_journal(path, state["sha256"])
+    if entries and isinstance(doc, dict) and isinstance(doc.get('history'), list):
+        history = doc['history']
+        for entry in entries:
+            history = apply_patch(history, entry["ops"])
+        doc['history'] = history
+    return doc, {"snapshot": state, "size": len(raw), "journal_entries": len(entries) if intact else None}
+
+
+def load_document(path):
+    """The document saved at `path`, see read_saved()."""
+    return read_saved(path)[0]
+
+
+def has_journal(path):
+    return os.path.exists(journal_path(path))
+
+
+def save_session(session, path, compression=None, compact=None):
+    """
+    Save a session's history to `path`, appending to the file's journal when
+    the session saved it before and every edit since then is known; otherwise,
+    or when the journal is due for compaction, write a full snapshot.
+
+    Returns (path written, "journal", "snapshot" or "unchanged"). Caller
+    holds session.lock.
+    """
+    path = compressed_path(path, compression)
+    saved = session.saved.get(path)
+    entries = session.edits_since(saved["version"]) if saved is not None else None
+    snapshot = _current_snapshot(path, saved["snapshot"]) if entries is not None else None
+    if snapshot is not None:
+        if not entries:
+            return path, "unchanged"
+        header = _journal_header(path)
+        # A journal of another snapshot (e.g. left by a crash) is started over,
+        # unless this session's earlier entries are in it and would be lost
+        start = header is None or header.get("sha256") != snapshot["sha256"]
+        journal_bytes = 0 if start else os.path.getsize(journal_path(path))
+        pending_bytes = sum(len(codec.dumps_compact(e)) for e in entries)
+        journal_entries = (0 if start else saved["journal_entries"]) + len(entries)
+        if ((not start or not saved["journal_entries"])
+                and journal_entries <= JOURNAL_MAX_ENTRIES
+                and journal_bytes + pending_bytes <= JOURNAL_MAX_RATIO * saved["size"]):
+            try:
+                append_journal(path, entries, snapshot["sha256"], start)
+            except BaseException:
+                # The journal may end in a partial line now; start over with a snapshot
+                del session.saved[path]
+                raise
+            session.saved[path] = {**saved, "version": session.version, "snapshot": snapshot,
+                                   "journal_entries": journal_entries}
+            return path, "journal"
+
+    text = codec.dumps({"history": session.history}, compact)
+    state = write_snapshot(path, text, compression)
+    # Journals are measured against the decompressed document, not the file
+    session.saved[path] = {"version": session.version, "snapshot": state, "journal_entries": 0,
+                           "size": len(text.encode('utf-8'))}
+    return path, "snapshot"
+
+
+def _current_snapshot(path, snapshot):
+    """
+    `snapshot` (as returned by write_snapshot()) with the current file state
+    if `path` still holds it, even if touched or copied over; else None.
+    """
+    try:
+        state = _file_state(path)
+    except FileNotFoundError:
+        return None
+    if state == {"mtime_ns": snapshot["mtime_ns"], "size": snapshot["size"]}:
+        return snapshot
+    if state["size"] != snapshot["size"]:
+        return None
+    with open(path, 'rb') as f:
+        if _content_hash(f.read()) != snapshot["sha256"]:
+            return None
+    return {**snapshot, **state}
@@ -0,0 +1,97 @@
+"""
+Server-Sent Events helpers for forwarding streamed OpenAI completions.
+
+A streamed answer is sent as a sequence of events:
+
+- ``delta``: ``{"content": "<text>"}`` for every content token chunk
+- ``tool_call``: ``{"name": ..., "arguments": {...}}`` once per tool call,
+  after its argument deltas have been accumulated and parsed
+- ``done``: the final payload, shaped like the non-streaming response
+- ``error``: ``{"error": "<message>"}`` if the upstream stream fails
+"""
+import json
+
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def message_events(message, done=None):
+    """
+    Events for an already complete message: its content as one delta, its
+    parsed tool calls, then `done` carrying `done` (default: the message).
+    """
+    if message.get("content"):
+        yield sse_event("delta", {"content": message["content"]})
+    for tool_call in message.get("tool_calls") or []:
+        arguments = tool_call["function"]["arguments"]
+        try:
+            arguments = json.loads(arguments) if arguments else {}
+        except ValueError:
+            pass
+        yield sse_event("tool_call", {"name": tool_call["function"]["name"], "arguments": arguments})
+    yield sse_event("done", message if done is None else done)
+
+
+class StreamAccumulator:
+    """Rebuilds a complete assistant message from streamed chat completion chunks."""
+
+    def __init__(self):
+        self.role = "assistant"
+        self.content_parts = []
+        # tool call index -> {"id", "type", "function": {"name", "arguments"}}
+        self.tool_calls = {}
+
+    def add(self, chunk):
+        """Consume one chunk. Returns its content delta, or None if it has none."""
+        if not getattr(chunk, "choices", None):
+            return None
+        delta = chunk.choices[0].delta
+        if delta is None:
+            return None
+        if getattr(delta, "role", None):
+            self.role = delta.role
+
+        for tc in getattr(delta, "tool_calls", None) or []:
+            entry = self.tool_calls.setdefault(tc.index, {
+                "id": None,
+                "type": "function",
+                "function": {"name": "", "arguments": ""},
+            })
+            if getattr(tc, "id", None):
+                entry["id"] = tc.id
+            if getattr(tc, "type", None):
+                entry["type"] = tc.type
+            fn = getattr(tc, "function", None)
+            if fn is not None:
+                if getattr(fn, "name", None):
+                    entry["function"]["name"] += fn.name
+                if getattr(fn, "arguments", None):
+                    entry["function"]["arguments"] += fn.arguments
+
+        text = getattr(delta, "content", None)
+        if text:
+            self.content_parts.append(text)
+            return text
+        return None
+
+    @property
+    def content(self):
+        return "".join(self.content_parts)
+
+    def parsed_tool_calls(self):
+        """Yield (name, arguments) per tool call, arguments parsed from JSON when possible."""
+        for _, entry in sorted(self.tool_calls.items()):
+            arguments = entry["function"]["arguments"]
+            try:
+                arguments = json.loads(arguments) if arguments else {}
+            except ValueError:
+                pass
+            yield entry["function"]["name"], arguments
+
+    def message(self):
+        """The accumulated message in the shape of `ChatCompletionMessage.to_dict()`."""
+        message = {"role": self.role, "content": self.content if self.content_parts else None}
+        if self.tool_calls:
+            message["tool_calls"] = [entry for _, entry in sorted(self.tool_calls.items())]
+        return message
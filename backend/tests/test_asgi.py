@@ -0,0 +1,147 @@
+import asyncio
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import asgi  # noqa: E402
+import app as app_module  # noqa: E402
+from llm_cache import ResponseCache  # noqa: E402
+from test_endpoints import build_mock_trajectory  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def memory_cache(monkeypatch):
+    monkeypatch.setattr(app_module, "llm_cache", ResponseCache(path=None))
+
+
+def call(method, path, payload):
+    """Drive the ASGI app for one request; returns (status, headers, body)."""
+    body = json.dumps(payload).encode()
+    sent = []
+
+    async def receive():
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http",
+        "method": method,
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"content-type", b"application/json")],
+    }
+    asyncio.run(asgi.application(scope, receive, send))
+    start = sent[0]
+    return start["status"], dict(start["headers"]), b"".join(m.get("body", b"") for m in sent[1:])
+
+
+class StubCompletions:
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.calls = 0
+
+    async def create(self, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": "Because"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+
+def test_generate_thought_runs_on_async_client(monkeypatch):
+    stub = StubCompletions()
+    monkeypatch.setattr(asgi, "async_client", SimpleNamespace(chat=SimpleNamespace(completions=stub)))
+
+    payload = {"current_step": {"originalIndex": 1}, "tool_call": "view", "previous_steps": []}
+    status, _, body = call("POST", "/generate_thought", payload)
+    assert status == 200
+    assert json.loads(body) == {"generated_thought": "Because"}
+
+    status, _, body = call("POST", "/generate_thought", {"previous_steps": []})
+    assert status == 400
+    for not_an_object in ([], "x"):
+        status, _, body = call("POST", "/chat", not_an_object)
+        assert status == 400
+        assert json.loads(body) == {"error": "Request body must be a JSON object"}
+    assert stub.calls == 1
+
+
+def test_async_routes_are_timed_and_counted(monkeypatch):
+    stub = StubCompletions()
+    monkeypatch.setattr(asgi, "async_client", SimpleNamespace(chat=SimpleNamespace(completions=stub)))
+    labels = ("/generate_thought", "POST", "200")
+    before = asgi.metrics.REQUESTS.value(labels)
+    upstream_before = asgi.metrics.PHASE_SECONDS.count(("/generate_thought", "upstream"))
+
+    payload = {"current_step": {"originalIndex": 1}, "tool_call": "view", "previous_steps": [], "cache": False}
+    status, headers, _ = call("POST", "/generate_thought", payload)
+    assert status == 200
+    timing = headers[b"server-timing"].decode()
+    assert "parse;dur=" in timing and "upstream;dur=" in timing and "total;dur=" in timing
+    assert asgi.metrics.REQUESTS.value(labels) == before + 1
+    assert asgi.metrics.PHASE_SECONDS.count(("/generate_thought", "upstream")) == upstream_before + 1
+
+
+def test_concurrent_chats_do_not_wait_on_each_other(monkeypatch):
+    stub = StubCompletions(delay=0.3)
+    monkeypatch.setattr(asgi, "async_client", SimpleNamespace(chat=SimpleNamespace(completions=stub)))
+    history = build_mock_trajectory(num_steps=2)["history"]
+
+    async def many():
+        async def one(i):
+            sent = []
+            body = json.dumps({"messages": [{"role": "user", "content": f"q{i}"}], "history": history}).encode()
+
+            async def receive():
+                return {"type": "http.request", "body": body}
+
+            async def send(message):
+                sent.append(message)
+
+            scope = {"type": "http", "method": "POST", "path": "/chat", "query_string": b"", "headers": []}
+            await asgi.application(scope, receive, send)
+            return sent[0]["status"]
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        statuses = await asyncio.gather(*(one(i) for i in range(20)))
+        return statuses, loop.time() - started
+
+    statuses, elapsed = asyncio.run(many())
+    assert statuses == [200] * 20
+    assert stub.calls == 20
+    assert elapsed < 3
+
+
+def test_other_routes_are_served_by_flask_app():
+    doc = build_mock_trajectory(num_steps=3)
+    status, headers, body = call("POST", "/remove_step", {"content": json.dumps(doc), "original_index": 1})
+    assert status == 200
+    assert headers[b"content-type"] == b"application/json"
+    assert len(json.loads(json.loads(body)["modified_content"])["history"]) == len(doc["history"]) - 2
+
+
+def test_coalesced_callers_survive_a_cancelled_leader():
+    cache = ResponseCache(path=None)
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.1)
+        return {"content": "done"}
+
+    async def scenario():
+        leader = asyncio.ensure_future(cache.aget_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        follower = asyncio.ensure_future(cache.aget_or_compute("k", compute))
+        await asyncio.sleep(0.01)
+        leader.cancel()
+        return await asyncio.wait_for(follower, 2)
+
+    assert asyncio.run(scenario()) == {"content": "done"}
+    assert len(calls) == 2
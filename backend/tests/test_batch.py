@@ -0,0 +1,90 @@
+import io
+import json
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+import batch  # noqa: E402
+from test_endpoints import build_mock_trajectory  # noqa: E402
+
+
+def _write_corpus(directory, count):
+    directory.mkdir()
+    for i in range(count):
+        (directory / f"traj_{i}.json").write_text(json.dumps(build_mock_trajectory(num_steps=3)))
+    (directory / "broken.json").write_text("{not json")
+
+
+def test_batch_dry_run_reports_counts_without_writing(tmp_path):
+    _write_corpus(tmp_path / "runs", 3)
+    before = {p.name: p.read_text() for p in (tmp_path / "runs").iterdir()}
+    out = io.StringIO()
+    summary = batch.run(
+        batch.find_files([str(tmp_path / "runs")]),
+        [{"op": "replace", "search_term": "action_1", "replace_term": "ACTION"}],
+        {"dry_run": True}, out, workers=2,
+    )
+    assert summary == {"files": 4, "skipped": 0, "ok": 3, "unchanged": 0, "error": 1}
+    records = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert sorted(r["results"][0]["replacements"] for r in records if r["status"] == "ok") == [2, 2, 2]
+    assert "JSONDecodeError" in next(r["error"] for r in records if r["status"] == "error")
+    assert {p.name: p.read_text() for p in (tmp_path / "runs").iterdir()} == before
+
+
+def test_batch_in_place_resumes_from_manifest(tmp_path):
+    _write_corpus(tmp_path / "runs", 3)
+    manifest = tmp_path / "manifest.jsonl"
+    argv = [str(tmp_path / "runs" / "traj_*.json"), "--remove-step", "1", "--in-place",
+            "--manifest", str(manifest), "--workers", "1", "--results", str(tmp_path / "results.jsonl")]
+
+    assert batch.main(argv) == 0
+    for path in (tmp_path / "runs").glob("traj_*.json"):
+        assert len(json.loads(path.read_text())["history"]) == 6
+    # Files already processed with the same operations are skipped
+    assert batch.main(argv) == 0
+    assert len((tmp_path / "results.jsonl").read_text().splitlines()) == 3
+
+    # A changed file is processed again
+    (tmp_path / "runs" / "traj_0.json").write_text(json.dumps(build_mock_trajectory(num_steps=3)))
+    batch.main(argv)
+    assert len((tmp_path / "results.jsonl").read_text().splitlines()) == 4
+    assert len(json.loads((tmp_path / "runs" / "traj_0.json").read_text())["history"]) == 6
+
+
+def test_batch_output_dir_mirrors_relative_paths(tmp_path):
+    for sub in ("a", "b"):
+        (tmp_path / "runs" / sub).mkdir(parents=True)
+        (tmp_path / "runs" / sub / "x.json").write_text(json.dumps(build_mock_trajectory(num_steps=3)))
+    untouched = json.dumps(build_mock_trajectory(num_steps=1))
+    (tmp_path / "runs" / "a" / "y.json").write_text(untouched)
+
+    argv = [str(tmp_path / "runs" / "**" / "*.json"), "--replace", "action_3", "ACTION",
+            "--output-dir", str(tmp_path / "out"), "--workers", "1", "--results", str(tmp_path / "results.jsonl")]
+    assert batch.main(argv) == 0
+    for sub in ("a", "b"):
+        assert "ACTION" in (tmp_path / "out" / sub / "x.json").read_text()
+    # Files the operations did not change are copied unchanged
+    assert (tmp_path / "out" / "a" / "y.json").read_text() == untouched
+
+
+def test_batch_applies_and_folds_in_journaled_edits(tmp_path):
+    import storage
+
+    _write_corpus(tmp_path / "runs", 1)
+    path = tmp_path / "runs" / "traj_0.json"
+    doc = json.loads(path.read_text())
+    snapshot = storage.write_snapshot(str(path), path.read_text())
+    message = dict(doc["history"][4], thought="JOURNALED")
+    storage.append_journal(str(path), [{"version": 1, "ops": [{"op": "replace", "path": "/history/4", "value": message}]}],
+                           snapshot["sha256"], start=True)
+
+    out = io.StringIO()
+    batch.run(batch.find_files([str(path)]), [{"op": "replace", "search_term": "missing", "replace_term": "x"}],
+              {"output_dir": str(tmp_path / "out")}, out, workers=1)
+    assert json.loads((tmp_path / "out" / "traj_0.json").read_text())["history"][4]["thought"] == "JOURNALED"
+
+    batch.run(batch.find_files([str(path)]), [{"op": "replace", "search_term": "action_1", "replace_term": "ACTION"}],
+              {"in_place": True}, out, workers=1)
+    assert not storage.has_journal(str(path))
+    history = json.loads(path.read_text())["history"]
+    assert history[4]["thought"] == "JOURNALED" and "ACTION" in json.dumps(history)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(__file__)))
+from benchmarks import run as bench  # noqa: E402
+from benchmarks.trajectories import generate_trajectory  # noqa: E402
+from trajectory import build_sanitized_steps  # noqa: E402
+
+
+def test_generated_trajectories_are_deterministic_and_repeat_observations():
+    doc = generate_trajectory(40, observation_chars=300, repeat_fraction=0.5, seed=7)
+    assert doc == generate_trajectory(40, observation_chars=300, repeat_fraction=0.5, seed=7)
+    steps = build_sanitized_steps(doc["history"])
+    assert len(steps) == 41
+    observations = [step["observation"] for step in steps[1:]]
+    assert all(150 <= len(o) <= 450 for o in observations)
+    assert len(set(observations)) < len(observations)
+
+
+def test_benchmark_run_records_metrics_and_compares_runs():
+    baseline = bench.run([5], [200], [0.0], repeat=1)
+    assert [r["endpoint"] for r in baseline["results"]] == list(bench.ENDPOINTS)
+    for result in baseline["results"]:
+        assert result["median_ms"] > 0 and result["peak_memory_bytes"] > 0 and result["output_bytes"] > 0
+    assert baseline["results"][3]["llm_calls"] == 1
+    streamed = baseline["results"][4]
+    assert streamed["endpoint"] == "chat_stream" and streamed["llm_calls"] == 1
+
+    assert bench.compare(baseline, baseline) == []
+    slower = {"results": [dict(r, output_bytes=r["output_bytes"] * 2) for r in baseline["results"]]}
+    regressions = bench.compare(baseline, slower)
+    assert len(regressions) == len(bench.ENDPOINTS)
+    assert regressions[0]["metric"] == "output_bytes" and regressions[0]["ratio"] == 2.0
+
+
+def test_benchmark_run_records_failing_scenarios_and_continues(monkeypatch):
+    scenario_request = bench._scenario_request
+
+    def failing_replace(endpoint, doc, content):
+        path, body = scenario_request(endpoint, doc, content)
+        return ("/no_such_route", body) if endpoint == "replace" else (path, body)
+
+    monkeypatch.setattr(bench, "_scenario_request", failing_replace)
+    results = bench.run([5], [200], [0.0], endpoints=("replace", "chat"), repeat=1)["results"]
+    assert results[0]["error"].startswith("/no_such_route answered 404") and "median_ms" not in results[0]
+    assert results[1]["median_ms"] > 0
+    assert bench.compare({"results": results}, {"results": results}) == []
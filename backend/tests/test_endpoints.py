@@ -9,7 +9,13 @@ from app import create_app  # noqa: E402
 
 
 @pytest.fixture()
-def client():
+def client(monkeypatch):
+    import app as app_module
+    from llm_cache import ResponseCache
+
+    # Keep LLM responses in memory only so tests never share a cache
+    monkeypatch.setattr(app_module, "llm_cache", ResponseCache(path=None))
+
     app = create_app()
     app.config.update({
         "TESTING": True,
@@ -204,3 +210,1098 @@ def test_remove_step_history_pair(client):
         assert removed_tool.get("content", "") not in serialized
 
 
+def test_session_edits_and_save(client, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    doc = build_mock_trajectory(num_steps=4)
+
+    resp = client.post('/sessions', json={"content": json.dumps(doc)})
+    assert resp.status_code == 200, resp.get_json()
+    session = resp.get_json()
+    doc_id = session["doc_id"]
+    assert session["num_steps"] == 5
+
+    resp = client.post('/replace_thought', json={
+        "doc_id": doc_id,
+        "original_index": 1,
+        "old_thought": "thought_1",
+        "new_thought": "NEW_THOUGHT",
+    })
+    assert resp.status_code == 200, resp.get_json()
+    assert "modified_content" not in resp.get_json()
+
+    resp = client.post('/remove_step', json={"doc_id": doc_id, "original_index": 2})
+    assert resp.status_code == 200, resp.get_json()
+
+    resp = client.post('/replace', json={"doc_id": doc_id, "search_term": "action_4", "replace_term": "ACTION_4"})
+    assert resp.status_code == 200, resp.get_json()
+    assert resp.get_json()["replacements"] == 2
+    assert resp.get_json()["version"] == 3
+
+    resp = client.post('/save', json={"doc_id": doc_id, "filename": "out.json"})
+    assert resp.status_code == 200, resp.get_json()
+    saved = json.loads((tmp_path / "data" / "out.json").read_text())
+    hist = saved["history"]
+    assert len(hist) == len(doc["history"]) - 2
+    assert hist[2]["thought"] == "NEW_THOUGHT"
+    assert "thought_2" not in json.dumps(hist)
+    assert hist[6]["action"] == "ACTION_4"
+
+    assert client.delete(f'/sessions/{doc_id}').status_code == 200
+    resp = client.post('/remove_step', json={"doc_id": doc_id, "original_index": 1})
+    assert resp.status_code == 404
+
+
+def test_session_store_evicts_least_recently_used():
+    from sessions import SessionStore
+
+    store = SessionStore(max_entries=10, max_bytes=100)
+    first = store.create([], 60)
+    second = store.create([], 30)
+    assert store.get(first.doc_id) is first
+    # 60 + 30 + 40 exceeds the cap; `second` is the least recently used
+    third = store.create([], 40)
+    assert store.get(second.doc_id) is None
+    assert store.get(first.doc_id) is first
+    assert store.get(third.doc_id) is third
+    assert store.create([], 101) is None
+
+
+def apply_json_patch(doc, ops):
+    # Minimal RFC 6902 applier covering the operations the edit endpoints emit
+    for op in ops:
+        *parents, last = [p.replace("~1", "/").replace("~0", "~") for p in op["path"].split("/")[1:]]
+        target = doc
+        for part in parents:
+            target = target[int(part)] if isinstance(target, list) else target[part]
+        key = int(last) if isinstance(target, list) else last
+        if op["op"] == "remove":
+            del target[key]
+        elif op["op"] == "add" and isinstance(target, list):
+            target.insert(key, op["value"])
+        else:
+            target[key] = op["value"]
+    return doc
+
+
+def test_patch_responses_match_full_content(client):
+    from edits import history_hash
+
+    doc = build_mock_trajectory(num_steps=4)
+    content = json.dumps(doc)
+    local = {"history": json.loads(content)["history"]}
+
+    requests = [
+        ('/replace', {"search_term": "action_3", "replace_term": "ACTION_3"}),
+        ('/replace_thought', {"original_index": 1, "new_thought": "NEW_THOUGHT"}),
+        ('/remove_step', {"original_index": 2}),
+    ]
+    for route, payload in requests:
+        full = client.post(route, json={"content": content, **payload})
+        assert full.status_code == 200, full.get_json()
+        patched = client.post(route, json={"content": content, "response_format": "patch", **payload})
+        assert patched.status_code == 200, patched.get_json()
+        body = patched.get_json()
+        assert "modified_content" not in body
+
+        content = full.get_json()["modified_content"]
+        expected = json.loads(content)
+        apply_json_patch(local, body["patch"])
+        assert local == expected
+        assert body["content_hash"] == history_hash(expected["history"])
+
+
+def test_history_hash_encodes_numbers_like_json_stringify():
+    import hashlib
+
+    from edits import history_hash
+
+    history = [{"content": "naïve", "score": 1.0, "values": [1e-05, 1.5e-07, 2.5, 1e21, 3, float("nan")]}]
+    # JSON.stringify({history}) in a browser
+    expected = '{"history":[{"content":"naïve","score":1,"values":[0.00001,1.5e-7,2.5,1e+21,3,null]}]}'
+    assert history_hash(history) == hashlib.sha256(expected.encode()).hexdigest()
+
+
+def test_batch_edit_resolves_removed_step_shifts(client):
+    doc = build_mock_trajectory(num_steps=5)
+    operations = [
+        {"op": "replace", "search_term": "OBSERVATION for", "replace_term": "OBS"},
+        {"op": "remove_step", "original_index": 2},
+        {"op": "replace_thought", "original_index": 4, "old_thought": "thought_4", "new_thought": "NEW_4"},
+        {"op": "remove_step", "original_index": 3},
+    ]
+    resp = client.post('/batch_edit', json={"content": json.dumps(doc), "operations": operations})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert body["results"] == [
+        {"op": "replace", "replacements": 5},
+        {"op": "remove_step", "original_index": 2, "step": 2},
+        {"op": "replace_thought", "original_index": 4, "step": 3},
+        {"op": "remove_step", "original_index": 3, "step": 2},
+    ]
+    hist = json.loads(body["modified_content"])["history"]
+    assert [h.get("thought") for h in hist[2::2]] == ["thought_1", "NEW_4", "thought_5"]
+    assert hist[3]["content"] == "OBS action_1"
+
+
+def test_batch_edit_is_all_or_nothing(client):
+    doc = build_mock_trajectory(num_steps=3)
+    resp = client.post('/sessions', json={"content": json.dumps(doc)})
+    doc_id = resp.get_json()["doc_id"]
+
+    operations = [
+        {"op": "remove_step", "original_index": 1},
+        {"op": "replace_thought", "original_index": 1, "new_thought": "X"},
+    ]
+    resp = client.post('/batch_edit', json={"doc_id": doc_id, "operations": operations})
+    assert resp.status_code == 400
+    body = resp.get_json()
+    assert body["failed_operation"] == 1
+    assert "removed by an earlier operation" in body["error"]
+
+    resp = client.get(f'/sessions/{doc_id}')
+    assert resp.get_json()["version"] == 0
+    assert resp.get_json()["num_steps"] == 4
+
+
+def _chunk(content=None, tool_calls=None):
+    from types import SimpleNamespace
+
+    delta = SimpleNamespace(role=None, content=content, tool_calls=tool_calls)
+    return SimpleNamespace(choices=[SimpleNamespace(delta=delta)])
+
+
+def _tool_delta(index, id=None, name=None, arguments=None):
+    from types import SimpleNamespace
+
+    return SimpleNamespace(
+        index=index, id=id, type="function" if id else None,
+        function=SimpleNamespace(name=name, arguments=arguments),
+    )
+
+
+def _sse_events(body):
+    events = []
+    for block in body.strip().split("\n\n"):
+        lines = dict(line.split(": ", 1) for line in block.split("\n"))
+        events.append((lines["event"], json.loads(lines["data"])))
+    return events
+
+
+def test_chat_stream_accumulates_tool_calls(client, monkeypatch):
+    import app as app_module
+
+    chunks = [
+        _chunk(content="Filtering"),
+        _chunk(tool_calls=[_tool_delta(0, id="call_1", name="apply_semantic_filter", arguments='{"filtered_')]),
+        _chunk(tool_calls=[_tool_delta(0, arguments='steps": [{"originalIndex": 2, ')]),
+        _chunk(tool_calls=[_tool_delta(0, arguments='"reasoning": "reads a file"}]}')]),
+    ]
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        return iter(chunks)
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    doc = build_mock_trajectory(num_steps=2)
+    resp = client.post('/chat', json={
+        "messages": [{"role": "user", "content": "steps that read files"}],
+        "history": doc["history"],
+        "stream": True,
+    })
+    assert resp.status_code == 200
+    assert resp.mimetype == "text/event-stream"
+    assert calls[0]["stream"] is True
+
+    events = _sse_events(resp.get_data(as_text=True))
+    assert events[0] == ("delta", {"content": "Filtering"})
+    assert events[1] == ("tool_call", {
+        "name": "apply_semantic_filter",
+        "arguments": {"filtered_steps": [{"originalIndex": 2, "reasoning": "reads a file"}]},
+    })
+    kind, message = events[2]
+    assert kind == "done"
+    assert message["tool_calls"][0]["id"] == "call_1"
+    assert json.loads(message["tool_calls"][0]["function"]["arguments"])["filtered_steps"][0]["originalIndex"] == 2
+
+
+def test_chat_prompt_is_cached_per_history(client, monkeypatch):
+    from types import SimpleNamespace
+
+    import app as app_module
+
+    prompts = []
+
+    def create(**kwargs):
+        prompts.append(kwargs["messages"][0]["content"])
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": "ok"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    builds = []
+    real_build = app_module.build_sanitized_steps
+
+    def counting_build(history):
+        builds.append(len(history))
+        return real_build(history)
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    monkeypatch.setattr(app_module, "build_sanitized_steps", counting_build)
+    app_module.prompt_cache.clear()
+
+    doc = build_mock_trajectory(num_steps=3)
+    for turn in range(3):
+        resp = client.post('/chat', json={
+            "messages": [{"role": "user", "content": f"question {turn}"}],
+            "history": doc["history"],
+        })
+        assert resp.status_code == 200, resp.get_json()
+
+    assert len(builds) == 1
+    assert prompts[0] == prompts[1] == prompts[2]
+    assert '"thought": "thought_3"' in prompts[0]
+
+    doc["history"][2]["thought"] = "edited"
+    client.post('/chat', json={"messages": [{"role": "user", "content": "again"}], "history": doc["history"]})
+    assert len(builds) == 2
+    assert prompts[3] != prompts[0]
+
+
+def test_chat_filter_is_map_reduced_over_windows(client, monkeypatch):
+    import re
+    from types import SimpleNamespace
+
+    import app as app_module
+
+    def create(**kwargs):
+        assert kwargs["tool_choice"]["function"]["name"] == "apply_semantic_filter"
+        prompt = kwargs["messages"][0]["content"]
+        steps = [int(n) for n in re.findall(r'"step": (\d+)', prompt) if n != "0"]
+        # Every window reports its steps, plus a duplicate of the first one
+        filtered = [{"originalIndex": n, "reasoning": f"r{n}"} for n in steps + steps[:1]]
+        tool_call = {"function": {"name": "apply_semantic_filter", "arguments": json.dumps({"filtered_steps": filtered})}}
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": None, "tool_calls": [tool_call]})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    monkeypatch.setattr(app_module, "CHAT_CHUNK_TOKENS", 120)
+
+    doc = build_mock_trajectory(num_steps=8)
+    resp = client.post('/chat', json={
+        "messages": [{"role": "user", "content": "all steps"}],
+        "history": doc["history"],
+        "mode": "filter",
+    })
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert body["chunks"] > 1
+    arguments = json.loads(body["tool_calls"][0]["function"]["arguments"])
+    assert [s["originalIndex"] for s in arguments["filtered_steps"]] == list(range(1, 9))
+
+
+def test_chat_panel_requests_are_map_reduced_only_past_the_prompt_limit(client, monkeypatch):
+    from types import SimpleNamespace
+
+    import app as app_module
+
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs["tool_choice"])
+        tool_call = {"function": {"name": "apply_semantic_filter", "arguments": json.dumps({"filtered_steps": []})}}
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": "ok", "tool_calls": [tool_call]})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    monkeypatch.setattr(app_module, "CHAT_CHUNK_TOKENS", 120)
+    doc = build_mock_trajectory(num_steps=8)
+    # What Chat.js sends: no mode
+    body = {"messages": [{"role": "user", "content": "help me understand the issue"}], "history": doc["history"], "cache": False}
+
+    # Above the window size but within one prompt: answered whole
+    resp = client.post('/chat', json=body)
+    assert resp.status_code == 200 and "chunks" not in resp.get_json()
+    assert calls == ["auto"]
+
+    # Too large for one prompt: map-reduced as a filter instead of refused
+    monkeypatch.setattr(app_module, "CHAT_MAX_PROMPT_TOKENS", 200)
+    calls.clear()
+    resp = client.post('/chat', json=body)
+    assert resp.status_code == 200, resp.get_json()
+    assert resp.get_json()["chunks"] == len(calls) > 1
+
+    calls.clear()
+    resp = client.post('/chat', json={**body, "mode": "chat"})
+    assert resp.status_code == 413
+    assert resp.get_json()["error"].startswith("Trajectory too large")
+    assert calls == []
+
+
+def test_llm_responses_are_cached_and_coalesced(client, monkeypatch):
+    import threading
+    import time
+    from types import SimpleNamespace
+
+    import app as app_module
+
+    calls = []
+
+    def create(**kwargs):
+        calls.append(kwargs)
+        time.sleep(0.2)
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": "Because"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    payload = {"current_step": {"originalIndex": 1}, "tool_call": "view", "previous_steps": [], "cache": True}
+
+    results = []
+
+    def post():
+        with app_module.app.test_client() as c:
+            results.append(c.post('/generate_thought', json=payload).get_json())
+
+    threads = [threading.Thread(target=post) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [{"generated_thought": "Because"}] * 4
+    assert len(calls) == 1
+
+    resp = client.post('/generate_thought', json=payload)
+    assert resp.get_json() == {"generated_thought": "Because"}
+    assert len(calls) == 1
+    resp = client.post('/generate_thought', json={**payload, "cache": False})
+    assert len(calls) == 2
+    # Regenerating a thought samples a new one unless the cache is asked for
+    del payload["cache"]
+    client.post('/generate_thought', json=payload)
+    assert len(calls) == 3
+
+    stats = client.get('/llm_cache/stats').get_json()
+    assert stats["misses"] == 1
+    assert stats["coalesced"] == 3
+    assert stats["hits"] == 1
+
+
+def test_llm_cache_persists_to_sqlite(tmp_path):
+    from llm_cache import ResponseCache, request_key
+
+    path = str(tmp_path / "cache.sqlite")
+    key = request_key(model="gpt-5", messages=[{"role": "user", "content": "hi"}])
+    ResponseCache(path=path).get_or_compute(key, lambda: {"content": "hello"})
+
+    reopened = ResponseCache(path=path)
+    assert reopened.get_or_compute(key, lambda: pytest.fail("should be cached")) == {"content": "hello"}
+    assert ResponseCache(path=path, ttl=-1).get(key) is None
+
+
+def test_generate_thoughts_in_bulk_with_rate_limit_retry(client, monkeypatch):
+    import threading
+    from types import SimpleNamespace
+
+    import openai
+
+    import app as app_module
+
+    lock = threading.Lock()
+    calls = []
+
+    def create(**kwargs):
+        prompt = kwargs["messages"][1]["content"]
+        with lock:
+            calls.append(prompt)
+            first_for_step_3 = "action_3" in prompt.split("\n")[2] and sum("action_3" in p.split("\n")[2] for p in calls) == 1
+        if first_for_step_3:
+            raise openai.RateLimitError.__new__(openai.RateLimitError)
+        tool = prompt.split("\n")[2]
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": f"generated for {tool}"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    monkeypatch.setattr(app_module, "LLM_RETRY_BASE_DELAY", 0)
+
+    doc = build_mock_trajectory(num_steps=4)
+    resp = client.post('/generate_thoughts', json={"content": json.dumps(doc), "indices": [3, 1, 4], "concurrency": 2})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert [r["original_index"] for r in body["results"]] == [1, 3, 4]
+    assert len(calls) == 4
+
+    hist = json.loads(body["modified_content"])["history"]
+    assert hist[2]["thought"] == "generated for action_1"
+    assert hist[4]["thought"] == "thought_2"
+    assert hist[6]["content"] == "generated for action_3"
+    # Step 4's context holds steps 0-3 as the frontend would have sent them
+    step_4_prompt = next(p for p in calls if p.split("\n")[2] == "action_4")
+    assert "Step 0: Initial user instruction" in step_4_prompt
+    assert "Step 3:\nThought: thought_3\nAction: action_3\nObservation: OBSERVATION for action_3" in step_4_prompt
+    assert "Step 4:" not in step_4_prompt
+
+    resp = client.post('/generate_thoughts', json={"content": json.dumps(doc), "indices": [1], "concurrency": "many"})
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "concurrency must be an integer"
+
+
+def test_chat_compacts_repeated_and_large_observations(client, monkeypatch):
+    from types import SimpleNamespace
+
+    import app as app_module
+
+    prompts = []
+
+    def create(**kwargs):
+        prompts.append(kwargs["messages"][0]["content"])
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": "ok"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+
+    doc = build_mock_trajectory(num_steps=4)
+    hist = doc["history"]
+    file_body = "def f():\n    return 1\n" * 40
+    hist[3]["content"] = file_body
+    hist[7]["content"] = file_body
+    hist[9]["content"] = "FAILED " * 5000
+
+    resp = client.post('/chat', json={
+        "messages": [{"role": "user", "content": "summarize"}],
+        "history": hist,
+        "compact": {"max_observation_chars": 1000},
+    })
+    assert resp.status_code == 200, resp.get_json()
+    stats = resp.get_json()["compaction"]
+    assert stats["deduplicated"] == 1
+    assert stats["truncated"] == 1
+    assert stats["tokens_saved"] > (len(file_body) + 34000) // 4 - 100
+
+    prompt = prompts[0]
+    assert "[same observation as step 1]" in prompt
+    assert prompt.count("def f():") == 40
+    assert "characters omitted" in prompt
+
+
+def test_compaction_token_budget_caps_observations():
+    from chunking import estimate_tokens
+    from compaction import compact_steps
+
+    steps = [{"step": i, "thought": "t", "action": "a", "observation": str(i) * (1000 * i)} for i in range(1, 6)]
+    compacted, stats = compact_steps(steps, dedupe=False, token_budget=2000)
+    assert stats["over_budget"] is False
+    assert estimate_tokens("".join(s["observation"] for s in compacted)) <= 2000
+    # Short observations are kept whole, long ones keep their head and tail
+    assert compacted[0]["observation"] == steps[0]["observation"]
+    assert compacted[4]["observation"].startswith("55555") and compacted[4]["observation"].endswith("55555")
+    assert steps[4]["observation"] == "5" * 5000
+
+
+def test_malformed_compaction_options_are_rejected(client):
+    doc = build_mock_trajectory(num_steps=3)
+    resp = client.post('/generate_thought', json={
+        "current_step": {"originalIndex": 1}, "previous_steps": [], "compact": {"max_observation_chars": "x"},
+    })
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "compact.max_observation_chars must be a non-negative integer or null"
+    resp = client.post('/chat', json={
+        "messages": [{"role": "user", "content": "hi"}], "history": doc["history"], "compact": {"dedupe": "no"},
+    })
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "compact.dedupe must be true or false"
+    resp = client.post('/generate_thoughts', json={
+        "content": json.dumps(doc), "indices": [1], "compact": {"token_budget": -1},
+    })
+    assert resp.status_code == 400
+    assert resp.get_json()["error"].startswith("compact.token_budget")
+
+
+def test_replace_literal_fast_path_matches_regex_semantics():
+    from matching import LiteralMatcher, RegexMatcher, compile_pattern
+
+    assert isinstance(compile_pattern(r"setup\.py"), LiteralMatcher)
+    assert isinstance(compile_pattern(r"/repo/src"), LiteralMatcher)
+    assert isinstance(compile_pattern(r"line\nnext"), LiteralMatcher)
+    assert isinstance(compile_pattern(r"test_\d+"), RegexMatcher)
+    assert compile_pattern("a.b") is compile_pattern("a.b")
+
+    text = "see setup.py and setup.py\n"
+    assert compile_pattern(r"setup\.py").subn("pyproject.toml", text) == ("see pyproject.toml and pyproject.toml\n", 2)
+    assert compile_pattern(r"setup\.py").subn(r"x\ty", text)[0] == "see x\ty and x\ty\n"
+
+
+def test_replace_preview_reports_match_locations(client):
+    doc = build_mock_trajectory(num_steps=3)
+    content = json.dumps(doc)
+    resp = client.post('/replace', json={"content": content, "search_term": "action_2", "preview": True})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert "modified_content" not in body
+    assert body["total"] == 2
+    assert {(m["history_index"], m["field"]) for m in body["matches"]} == {(4, "action"), (5, "content")}
+    tool_match = next(m for m in body["matches"] if m["field"] == "content")
+    assert tool_match["step"] == 2
+    assert tool_match["path"] == "/history/5/content"
+    assert (tool_match["start"], tool_match["end"]) == (16, 24)
+    assert tool_match["snippet"] == "OBSERVATION for action_2"
+
+    resp = client.post('/replace', json={"content": content, "search_term": "action_2", "preview": True, "max_matches": 1})
+    assert len(resp.get_json()["matches"]) == 1
+    assert resp.get_json()["truncated"] is True
+    for bad in ("x", 0, 1.5):
+        resp = client.post('/replace', json={"content": content, "search_term": "action_2", "preview": True, "max_matches": bad})
+        assert resp.status_code == 400
+        assert resp.get_json()["error"] == "max_matches must be a positive integer"
+
+
+def test_replace_respects_time_budget(client, monkeypatch):
+    import app as app_module
+
+    monkeypatch.setattr(app_module, "REPLACE_TIME_BUDGET", -1)
+    doc = build_mock_trajectory(num_steps=3)
+    resp = client.post('/replace', json={"content": json.dumps(doc), "search_term": "(a|b)+c", "replace_term": "x"})
+    assert resp.status_code == 400
+    assert "time budget" in resp.get_json()["error"]
+
+
+def test_replace_time_budget_interrupts_a_runaway_match(client, monkeypatch):
+    import time
+
+    import app as app_module
+
+    monkeypatch.setattr(app_module, "REPLACE_TIME_BUDGET", 0.2)
+    doc = build_mock_trajectory(num_steps=1)
+    doc["history"][3]["content"] = "a" * 40 + "!"
+    started = time.monotonic()
+    # Exponential backtracking: would run for hours without the deadline
+    resp = client.post('/replace', json={"content": json.dumps(doc), "search_term": "(a|aa)+$", "replace_term": "x"})
+    assert time.monotonic() - started < 5
+    assert resp.status_code == 400
+    assert "time budget" in resp.get_json()["error"]
+
+
+def test_replace_multiple_patterns_in_one_pass(client):
+    doc = build_mock_trajectory(num_steps=3)
+    replacements = [
+        {"search_term": "action_1", "replace_term": "action_2"},
+        {"search_term": "action_2", "replace_term": "action_1"},
+        {"search_term": r"thought_(\d)", "replace_term": r"T\1"},
+    ]
+    resp = client.post('/replace', json={"content": json.dumps(doc), "replacements": replacements})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    history = json.loads(body["modified_content"])["history"]
+    # Pairs apply in order: the second one also sees what the first produced
+    assert history[2]["action"] == "action_1" and history[4]["action"] == "action_1"
+    assert history[5]["content"].endswith("for action_1")
+    assert history[2]["thought"] == "T1"
+    assert body["counts"] == [2, 4, 6]
+
+    resp = client.post('/replace', json={"content": json.dumps(doc), "replacements": replacements, "preview": True})
+    assert resp.get_json()["counts"] == [2, 2, 6]
+    assert {m["pattern"] for m in resp.get_json()["matches"]} == {0, 1, 2}
+
+    resp = client.post('/replace', json={"content": json.dumps(doc), "replacements": [{"search_term": "("}]})
+    assert resp.status_code == 400
+
+
+def test_replacement_pairs_chain_in_order():
+    from matching import Replacer
+
+    # The same chain whether the second term is a literal or a regex
+    for second in ("bar", "ba."):
+        replacer = Replacer([("foo", "bar"), (second, "baz")])
+        assert replacer.subn("foo bar") == ("baz baz", 3)
+        assert replacer.counts == [1, 2]
+
+    # Independent literals are still matched in one scan
+    replacer = Replacer([("foo", "1"), ("bar", "2"), ("qux", "")])
+    assert [stage[0] for stage in replacer.stages] == ["multi"]
+    assert replacer.subn("foo bar qux") == ("1 2 ", 3)
+    # A replacement forming a later term with the surrounding text ends the run
+    replacer = Replacer([("b", "a"), ("aa", "c")])
+    assert [stage[0] for stage in replacer.stages] == ["single", "single"]
+    assert replacer.subn("ab") == ("c", 2)
+
+
+def test_search_ranks_steps_and_follows_session_edits(client):
+    doc = build_mock_trajectory(num_steps=4)
+    doc["history"][7]["content"] = "OBSERVATION:\nRunning pytest tests/test_setup.py ... 3 failed"
+
+    resp = client.post('/search', json={"content": json.dumps(doc), "query": '"test_setup.py" action_1'})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert {r["step"] for r in body["results"]} == {1, 3}
+    step_three = next(r for r in body["results"] if r["step"] == 3)
+    # Offsets are relative to the observation after the OBSERVATION: delimiter
+    assert step_three["highlights"] == [{"field": "observation", "start": 21, "end": 34}]
+
+    resp = client.post('/search', json={"content": json.dumps(doc), "query": "thought:action_1"})
+    assert resp.get_json()["total"] == 0
+    resp = client.post('/search', json={"content": json.dumps(doc), "query": "observation:fail*"})
+    assert [r["step"] for r in resp.get_json()["results"]] == [3]
+    resp = client.post('/search', json={"content": json.dumps(doc), "query": 'nope:"x y"'})
+    assert resp.status_code == 400
+
+    doc_id = client.post('/sessions', json={"content": json.dumps(doc)}).get_json()["doc_id"]
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "thought_2 thought_3", "require_all": True})
+    assert resp.get_json()["total"] == 0
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "thought_2"})
+    assert [r["step"] for r in resp.get_json()["results"]] == [2]
+
+    client.post('/replace_thought', json={"doc_id": doc_id, "original_index": 2, "new_thought": "check the failing test"})
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "thought_2"})
+    assert resp.get_json()["total"] == 0
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "thought:failing"})
+    assert resp.get_json()["results"][0]["highlights"] == [{"field": "thought", "start": 10, "end": 17}]
+
+    # Removing a step renumbers the following ones
+    client.post('/remove_step', json={"doc_id": doc_id, "original_index": 1})
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "failing"})
+    assert [r["step"] for r in resp.get_json()["results"]] == [1]
+    resp = client.post('/search', json={"doc_id": doc_id, "query": '"3 failed"'})
+    assert [r["step"] for r in resp.get_json()["results"]] == [2]
+
+
+def test_steps_pages_from_file_and_session(client, tmp_path, monkeypatch):
+    from trajectory import build_sanitized_steps
+
+    monkeypatch.chdir(tmp_path)
+    doc = build_mock_trajectory(num_steps=6)
+    # Brackets, quotes and a nested "history" key must not confuse the offset scan
+    doc["history"][5]["content"] = 'OBSERVATION:\n{"history": [1, 2]} \\"] , [ é'
+    doc = {"info": {"history": []}, **doc}
+    (tmp_path / "data").mkdir()
+    (tmp_path / "data" / "traj.json").write_text(json.dumps(doc, indent=2))
+    expected = build_sanitized_steps(doc["history"])
+
+    resp = client.get('/steps?file=traj.json&offset=1&limit=3')
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert body["total"] == len(expected) == 7
+    assert body["steps"] == expected[1:4]
+    assert client.get('/steps?file=traj.json&offset=5&limit=10').get_json()["steps"] == expected[5:]
+
+    # The index is rebuilt once the file changes
+    doc["history"] = doc["history"][:4]
+    (tmp_path / "data" / "traj.json").write_text(json.dumps(doc))
+    os.utime(tmp_path / "data" / "traj.json", ns=(0, 0))
+    assert client.get('/steps?file=traj.json').get_json()["total"] == 2
+
+    doc_id = client.post('/sessions', json={"content": json.dumps({"history": doc["history"]})}).get_json()["doc_id"]
+    assert client.get(f'/steps?doc_id={doc_id}&offset=1').get_json()["steps"] == expected[1:2]
+
+    assert client.get('/steps?file=../traj.json').status_code == 400
+    assert client.get('/steps?file=missing.json').status_code == 404
+
+
+GOLD_PATCH = """diff --git a/pkg/util.py b/pkg/util.py
+--- a/pkg/util.py
++++ b/pkg/util.py
+@@ -10,4 +10,5 @@ def parse(value):
+     if value is None:
+-        return default_value
++        if strict_mode and value is None:
++            raise ValueError("value must not be None in strict mode")
++        return fallback_value(value)
+     return value
+"""
+
+
+def test_leakage_scan_flags_steps_quoting_the_gold_patch(client):
+    doc = build_mock_trajectory(num_steps=4)
+    # Step 1 views the original code, step 2 reasons with a rewrapped version of the fix
+    doc["history"][3]["content"] = "OBSERVATION:\n    if value is None:\n        return default_value\n"
+    doc["history"][4]["thought"] = (
+        "I think the fix is: if strict_mode and value is None: raise "
+        'ValueError("value must not be None in strict mode") and otherwise use the fallback.'
+    )
+
+    resp = client.post('/leakage', json={"content": json.dumps(doc), "gold_patch": GOLD_PATCH})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert body["steps"] == [1, 2] and body["hunks"] == 1
+    exact = next(m for m in body["matches"] if m["step"] == 1)
+    assert (exact["field"], exact["kind"], exact["match"]) == ("observation", "removed", "exact")
+    assert exact["lines"] == ["return default_value"]
+    assert exact["file"] == "pkg/util.py"
+    fuzzy = next(m for m in body["matches"] if m["step"] == 2)
+    assert (fuzzy["field"], fuzzy["kind"], fuzzy["match"]) == ("thought", "added", "fuzzy")
+    assert fuzzy["score"] >= 0.5
+
+    resp = client.post('/leakage', json={"content": json.dumps(doc), "gold_patch": GOLD_PATCH, "kinds": ["added"]})
+    assert resp.get_json()["steps"] == [2]
+    resp = client.post('/leakage', json={"content": json.dumps(doc), "gold_patch": "not a diff"})
+    assert resp.status_code == 400
+
+
+def test_step_model_reads_fields_lazily_from_history():
+    from trajectory import get_step, iter_steps, num_steps
+
+    doc = build_mock_trajectory(num_steps=3)
+    history = doc["history"]
+    history[3]["content"] = [{"type": "text", "text": "ran ls\nOBSERVATION:\nfile.py"}]
+
+    assert num_steps(history) == 4 and num_steps(history[:3]) == 1
+    step = get_step(history, 1)
+    assert step.assistant is history[2]
+    assert step.text[step.observation_start:] == step.observation == "file.py"
+    assert step.to_dict() == {"step": 1, "thought": "thought_1", "action": "action_1", "observation": "file.py"}
+    assert get_step(history, 0).to_dict() == {"step": 0, "content": "Initial user instruction"}
+    assert get_step(history, 4) is None
+    assert [s.number for s in iter_steps(history, 1, 3)] == [1, 2]
+
+
+def test_codec_compact_and_pretty_output(client):
+    import codec
+
+    doc = build_mock_trajectory(num_steps=2)
+    doc["history"][1]["content"] = "Instruction — naïve ✓  "
+    assert codec.dumps(doc, compact=False) == json.dumps(doc, indent=2)
+    assert codec.loads(codec.dumps(doc, compact=True)) == doc
+    assert codec.dumps_compact({"b": 1, "a": [1.5, None]}, sort_keys=True) == '{"a":[1.5,null],"b":1}'
+    # Values orjson rejects fall back to the stdlib
+    assert codec.loads('{"n": NaN, "big": 123456789012345678901234567890}')["big"] == 123456789012345678901234567890
+    # orjson would write NaN as null; both outputs must keep it
+    loaded = codec.loads('{"x": NaN, "y": [null, Infinity]}')
+    assert codec.dumps_compact(loaded) == '{"x":NaN,"y":[null,Infinity]}'
+    assert codec.dumps(loaded, compact=False) == json.dumps(loaded, indent=2)
+
+    payload = {"content": json.dumps(doc), "search_term": "thought_1", "replace_term": "T"}
+    pretty = client.post('/replace', json=payload).get_json()["modified_content"]
+    compact = client.post('/replace', json={**payload, "json_format": "compact"}).get_json()["modified_content"]
+    assert "\n" in pretty and "\n" not in compact
+    assert json.loads(pretty) == json.loads(compact)
+    assert "naïve" in compact
+
+
+def test_save_journals_session_edits_and_reads_them_back(client, tmp_path, monkeypatch):
+    import storage
+
+    monkeypatch.chdir(tmp_path)
+    # The mock document is tiny, so any journal would exceed the default size ratio
+    monkeypatch.setattr(storage, "JOURNAL_MAX_RATIO", 100)
+    doc = build_mock_trajectory(num_steps=4)
+    doc_id = client.post('/sessions', json={"content": json.dumps(doc)}).get_json()["doc_id"]
+
+    resp = client.post('/save', json={"doc_id": doc_id, "filename": "t.json", "compression": "gzip"})
+    assert resp.status_code == 200, resp.get_json()
+    assert resp.get_json()["path"] == "data/t.json.gz" and resp.get_json()["mode"] == "snapshot"
+    snapshot = (tmp_path / "data" / "t.json.gz").read_bytes()
+    assert snapshot[:2] == b"\x1f\x8b"
+
+    client.post('/replace_thought', json={"doc_id": doc_id, "original_index": 1, "new_thought": "NEW"})
+    client.post('/remove_step', json={"doc_id": doc_id, "original_index": 2})
+    resp = client.post('/save', json={"doc_id": doc_id, "filename": "t.json", "compression": "gzip"})
+    assert resp.get_json()["mode"] == "journal"
+    assert (tmp_path / "data" / "t.json.gz").read_bytes() == snapshot
+    assert client.post('/save', json={"doc_id": doc_id, "filename": "t.json.gz"}).get_json()["mode"] == "unchanged"
+
+    expected = client.post('/save', json={"doc_id": doc_id, "filename": "plain.json"})
+    expected_history = json.loads((tmp_path / "data" / "plain.json").read_text())["history"]
+    assert storage.load_document("data/t.json.gz")["history"] == expected_history
+    resp = client.get('/steps?file=t.json.gz&offset=1&limit=1')
+    assert resp.get_json()["steps"][0]["thought"] == "NEW"
+
+    # A session opened from the file keeps journaling into it
+    reopened = client.post('/sessions', json={"file": "t.json.gz"}).get_json()["doc_id"]
+    client.post('/replace_thought', json={"doc_id": reopened, "original_index": 2, "new_thought": "AGAIN"})
+    assert client.post('/save', json={"doc_id": reopened, "filename": "t.json.gz"}).get_json()["mode"] == "journal"
+    assert storage.load_document("data/t.json.gz")["history"][4]["thought"] == "AGAIN"
+
+    # A torn journal line is ignored and forces the next save to write a snapshot
+    with open("data/t.json.gz.journal", "a") as f:
+        f.write('{"version": 9, "ops": [')
+    torn = client.post('/sessions', json={"file": "t.json.gz"}).get_json()["doc_id"]
+    client.post('/replace_thought', json={"doc_id": torn, "original_index": 1, "new_thought": "LAST"})
+    assert client.post('/save', json={"doc_id": torn, "filename": "t.json.gz"}).get_json()["mode"] == "snapshot"
+    assert not (tmp_path / "data" / "t.json.gz.journal").exists()
+    assert storage.load_document("data/t.json.gz")["history"][2]["thought"] == "LAST"
+
+    # Touching the snapshot keeps its journal valid
+    client.post('/replace_thought', json={"doc_id": torn, "original_index": 1, "new_thought": "TOUCHED"})
+    assert client.post('/save', json={"doc_id": torn, "filename": "t.json.gz"}).get_json()["mode"] == "journal"
+    os.utime("data/t.json.gz", ns=(1, 1))
+    assert storage.load_document("data/t.json.gz")["history"][2]["thought"] == "TOUCHED"
+
+    # A journal left behind by another snapshot is replaced, not appended to
+    with open("data/t.json.gz.journal", "w") as f:
+        f.write(json.dumps({"sha256": "0" * 64}) + "\n")
+    stale = client.post('/sessions', json={"file": "t.json.gz"}).get_json()["doc_id"]
+    client.post('/replace_thought', json={"doc_id": stale, "original_index": 1, "new_thought": "FRESH"})
+    assert client.post('/save', json={"doc_id": stale, "filename": "t.json.gz"}).get_json()["mode"] == "journal"
+    assert storage.load_document("data/t.json.gz")["history"][2]["thought"] == "FRESH"
+
+
+def test_compressed_saves_measure_the_journal_against_the_document_size(client, tmp_path, monkeypatch):
+    import storage
+
+    monkeypatch.chdir(tmp_path)
+    # Repetitive observations: gzip shrinks the snapshot far below the document
+    doc = build_mock_trajectory(num_steps=4)
+    for message in doc["history"]:
+        message["content"] = "pytest output line\n" * 500
+    doc_id = client.post('/sessions', json={"content": json.dumps(doc)}).get_json()["doc_id"]
+    client.post('/save', json={"doc_id": doc_id, "filename": "t.json", "compression": "gzip"})
+    new_thought = " ".join(str(n) for n in range(300))
+    client.post('/replace_thought', json={"doc_id": doc_id, "original_index": 1, "new_thought": new_thought})
+    snapshot = os.path.getsize("data/t.json.gz")
+
+    resp = client.post('/save', json={"doc_id": doc_id, "filename": "t.json.gz"})
+    assert resp.get_json()["mode"] == "journal"
+    assert os.path.getsize("data/t.json.gz.journal") > storage.JOURNAL_MAX_RATIO * snapshot
+
+
+def test_session_undo_versions_count_against_memory_cap():
+    from sessions import SessionStore
+
+    history = build_mock_trajectory(num_steps=4)["history"]
+    size = len(json.dumps(history))
+    store = SessionStore(max_entries=4, max_bytes=size + 1000)
+    session = store.create(history, size)
+    for n in range(20):
+        new_history = list(session.history)
+        new_history[2] = {**new_history[2], "thought": "x" * 100 + str(n)}
+        session.history = new_history
+        session.record_edit([{"op": "replace", "path": "/history/2", "value": new_history[2]}])
+        # The store is charged the versions, which are dropped oldest first past the cap
+        assert store.stats()["bytes"] == session.footprint() <= store.max_bytes
+    assert 0 < session.describe()["undo"] < 20
+    assert session.undo() is not None
+    assert store.stats()["bytes"] == session.footprint()
+
+
+def test_session_undo_redo_shares_unchanged_entries(client):
+    import app as app_module
+
+    doc = build_mock_trajectory(num_steps=4)
+    doc_id = client.post('/sessions', json={"content": json.dumps(doc)}).get_json()["doc_id"]
+    session = app_module.sessions.get(doc_id)
+    original = session.history
+
+    client.post('/replace_thought', json={"doc_id": doc_id, "original_index": 1, "new_thought": "NEW"})
+    after_thought = session.history
+    client.post('/remove_step', json={"doc_id": doc_id, "original_index": 3})
+    assert client.get(f'/sessions/{doc_id}').get_json()["undo"] == 2
+    # Versions share every message the edits did not replace
+    assert sum(a is not b for a, b in zip(original, after_thought)) == 1
+
+    expected = json.loads(json.dumps({"history": session.history}))
+    resp = client.post(f'/sessions/{doc_id}/undo', json={"response_format": "patch"})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert body["version"] == 3 and body["undo"] == 1 and body["redo"] == 1
+    assert [op["op"] for op in body["patch"]] == ["add", "add"]
+    assert apply_json_patch(expected, body["patch"]) == {"history": after_thought}
+    assert session.history is after_thought
+
+    client.post(f'/sessions/{doc_id}/undo')
+    assert session.history is original
+    assert client.post(f'/sessions/{doc_id}/undo').status_code == 409
+
+    client.post(f'/sessions/{doc_id}/redo')
+    assert session.history is after_thought
+    # A new edit discards what could have been redone
+    client.post('/replace', json={"doc_id": doc_id, "search_term": "action_4", "replace_term": "zebra"})
+    assert client.post(f'/sessions/{doc_id}/redo').status_code == 409
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "zebra"})
+    assert resp.get_json()["total"] == 1
+    client.post(f'/sessions/{doc_id}/undo')
+    resp = client.post('/search', json={"doc_id": doc_id, "query": "zebra"})
+    assert resp.get_json()["total"] == 0
+
+
+def test_requests_failing_with_an_exception_are_counted():
+    from flask import Flask
+
+    import metrics
+
+    app = Flask(__name__)
+    metrics.init_app(app)
+
+    @app.route('/boom')
+    def boom():
+        raise RuntimeError("boom")
+
+    labels = ("/boom", "GET", "500")
+    for propagate in (False, True):
+        app.config["PROPAGATE_EXCEPTIONS"] = propagate
+        before = metrics.REQUESTS.value(labels)
+        if propagate:
+            with pytest.raises(RuntimeError):
+                app.test_client().get('/boom')
+        else:
+            assert app.test_client().get('/boom').status_code == 500
+        assert metrics.REQUESTS.value(labels) == before + 1
+
+
+def test_server_timing_metrics_and_request_profiler(client, monkeypatch, tmp_path):
+    import time
+    from types import SimpleNamespace
+
+    import app as app_module
+    import metrics
+
+    doc = build_mock_trajectory(num_steps=3)
+    resp = client.post('/replace_thought', json={"content": json.dumps(doc), "original_index": 1, "new_thought": "T"})
+    phases = [entry.split(";")[0] for entry in resp.headers["Server-Timing"].split(", ")]
+    assert phases == ["parse", "load", "edit", "serialize", "encode", "total"]
+
+    def create(**kwargs):
+        if kwargs["messages"][-1]["content"] == "fail":
+            raise RuntimeError("upstream down")
+        time.sleep(0.05)
+        message = SimpleNamespace(to_dict=lambda: {"role": "assistant", "content": "ok"})
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)])
+
+    monkeypatch.setattr(app_module.client.chat.completions, "create", create)
+    monkeypatch.setattr(metrics, "PROFILE_REQUESTS", True)
+    monkeypatch.setattr(metrics, "PROFILE_DIR", str(tmp_path))
+    app_module.prompt_cache.clear()
+    errors_before = metrics.UPSTREAM_ERRORS.value(("RuntimeError",))
+    chats_before = metrics.REQUESTS.value(("/chat", "POST", "200"))
+
+    resp = client.post('/chat', headers={"X-Profile": "1"}, json={
+        "messages": [{"role": "user", "content": "hi"}], "history": doc["history"], "cache": False,
+    })
+    assert resp.status_code == 200
+    timing = resp.headers["Server-Timing"]
+    for name in ("build_steps", "format_prompt", "upstream"):
+        assert f"{name};dur=" in timing
+    with open(resp.headers["X-Profile-File"]) as f:
+        assert "app.py:chat" in f.read()
+
+    resp = client.post('/chat', json={"messages": [{"role": "user", "content": "fail"}], "history": doc["history"]})
+    assert resp.status_code == 500
+    assert metrics.UPSTREAM_ERRORS.value(("RuntimeError",)) == errors_before + 1
+    assert metrics.REQUESTS.value(("/chat", "POST", "200")) == chats_before + 1
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert '# TYPE traj_phase_duration_seconds histogram' in text
+    assert 'traj_phase_duration_seconds_bucket{route="/chat",phase="upstream",le="+Inf"}' in text
+    assert 'traj_http_requests_total{route="/chat",method="POST",status="500"}' in text
+    assert 'traj_prompt_tokens_count{route="/chat"}' in text
+
+
+def test_corpus_stats_index_only_changed_files(client, tmp_path, monkeypatch):
+    import app as app_module
+    import corpus
+    from benchmarks.trajectories import generate_trajectory
+
+    monkeypatch.chdir(tmp_path)
+    index = corpus.CorpusIndex("data", "data/corpus.sqlite")
+    monkeypatch.setattr(app_module, "corpus_index", index)
+    monkeypatch.setattr(app_module, "CORPUS_SCAN_INTERVAL", 0)
+    docs = {"a.json": generate_trajectory(20, 200, seed=1), "b.json": generate_trajectory(60, 200, seed=2)}
+    for name, doc in docs.items():
+        client.post('/save', json={"content": json.dumps(doc), "filename": name})
+    client.post('/save', json={"content": json.dumps(generate_trajectory(5, 200, seed=3)), "filename": "c.json",
+                               "compression": "gzip"})
+    (tmp_path / "data" / "notes.json").write_text('{"no": "history"}')
+
+    def bash_calls(doc):
+        return sum(1 for m in doc["history"] for call in m.get("tool_calls", []) if call["function"]["name"] == "bash")
+
+    threshold = bash_calls(docs["a.json"]) + 1
+    assert bash_calls(docs["b.json"]) >= threshold
+    resp = client.get(f'/corpus/stats?tool=bash&min_calls={threshold}')
+    assert resp.status_code == 200, resp.get_json()
+    stats = resp.get_json()
+    assert stats["files"] == 3 and stats["unreadable_files"] == 1
+    assert stats["steps"]["total"] == 21 + 61 + 6 and stats["steps"]["median"] == 21
+    assert stats["steps"]["distribution"][0] == {"max_steps": 10, "files": 1}
+    assert stats["tool_calls"] == 20 + 60 + 5
+    assert stats["matches"] == [{"file": "b.json", "steps": 61, "calls": bash_calls(docs["b.json"])}]
+
+    assert index.scan() == {"indexed": 0, "unchanged": 4, "removed": 0, "errors": 0}
+    os.utime(tmp_path / "data" / "a.json", ns=(1, 1))
+    (tmp_path / "data" / "c.json.gz").unlink()
+    client.post('/save', json={"content": json.dumps(generate_trajectory(80, 200)), "filename": "b.json"})
+    assert index.scan() == {"indexed": 1, "unchanged": 2, "removed": 1, "errors": 0}
+    stats = client.get('/corpus/stats?min_steps=30').get_json()
+    assert stats["files"] == 1 and stats["steps"]["max"] == 81
+
+
+def test_jsonl_shard_ingest_session_and_streaming_export(client, tmp_path, monkeypatch):
+    import gzip
+    import hashlib
+
+    from trajectory import pairing_errors
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    chat = build_mock_trajectory(num_steps=2)["history"]
+    lines = [
+        json.dumps({"instance_id": "repo__a-1", "history": build_mock_trajectory(num_steps=3)["history"]}),
+        json.dumps({"id": 7, "messages": chat, "resolved": True}),
+        json.dumps({"instance_id": "repo__b-2", "history": chat[:-1]}),
+        "{not json",
+        json.dumps({"instance_id": "repo__c-3", "history": chat}, ensure_ascii=False),
+    ]
+    with gzip.open(tmp_path / "data" / "runs.jsonl.gz", "wt") as f:
+        f.write("\n".join(lines) + "\n")
+    assert pairing_errors(chat[:-1]) == [f"history[{len(chat) - 2}] has no observation after it"]
+
+    resp = client.post('/shards/ingest', json={"file": "runs.jsonl.gz"})
+    assert resp.status_code == 200, resp.get_json()
+    body = resp.get_json()
+    assert (body["records"], body["valid"], body["invalid"]) == (5, 3, 2)
+    assert [r["id"] for r in body["page"]] == ["repo__a-1", "7", "repo__b-2", None, "repo__c-3"]
+    assert not body["page"][2]["valid"] and "no observation" in body["page"][2]["errors"][0]
+
+    resp = client.post('/sessions', json={"shard": "runs.jsonl.gz", "record": 2})
+    assert resp.status_code == 400
+    first = client.post('/sessions', json={"shard": "runs.jsonl.gz", "record_id": "repo__a-1"}).get_json()
+    sha256 = hashlib.sha256(lines[0].encode()).hexdigest()
+    assert first["origin"] == {"shard": "runs.jsonl.gz", "record": 0, "id": "repo__a-1", "sha256": sha256}
+    client.post('/remove_step', json={"doc_id": first["doc_id"], "original_index": 1})
+    second = client.post('/sessions', json={"shard": "runs.jsonl.gz", "record": 1}).get_json()
+    client.post('/replace_thought', json={"doc_id": second["doc_id"], "original_index": 2, "new_thought": "NEW"})
+
+    resp = client.post('/shards/export', json={"file": "runs.jsonl.gz", "output": "edited.jsonl"})
+    assert resp.status_code == 200, resp.get_json()
+    assert resp.get_json()["records"] == 5 and resp.get_json()["replaced"] == 2
+    exported = (tmp_path / "data" / "edited.jsonl").read_text().splitlines()
+    assert exported[2:] == lines[2:]
+    assert len(json.loads(exported[0])["history"]) == len(json.loads(lines[0])["history"]) - 2
+    record = json.loads(exported[1])
+    assert record["resolved"] is True and record["messages"][4]["thought"] == "NEW"
+
+    resp = client.post('/shards/export', json={"file": "runs.jsonl.gz", "output": "only.jsonl.gz",
+                                               "doc_ids": [second["doc_id"]]})
+    assert resp.get_json()["replaced"] == 1
+    with gzip.open(tmp_path / "data" / "only.jsonl.gz", "rt") as f:
+        assert f.read().splitlines()[0] == lines[0]
+
+    # A record added in front moves every record: the edits must not land on the wrong one
+    with gzip.open(tmp_path / "data" / "runs.jsonl.gz", "wt") as f:
+        f.write("\n".join([lines[4]] + lines) + "\n")
+    resp = client.post('/shards/export', json={"file": "runs.jsonl.gz", "output": "moved.jsonl"})
+    assert resp.status_code == 400
+    assert resp.get_json()["error"] == "Record 0 changed since it was opened"
+    assert not (tmp_path / "data" / "moved.jsonl").exists()
+
+
+def test_in_place_shard_exports_do_not_invalidate_later_records(client, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "data").mkdir()
+    lines = [json.dumps({"id": i, "history": build_mock_trajectory(num_steps=3)["history"]}, indent=1).replace("\n", "")
+             for i in range(4)]
+    (tmp_path / "data" / "runs.jsonl").write_text("\n".join(lines) + "\n")
+    a = client.post('/sessions', json={"shard": "runs.jsonl", "record": 1}).get_json()
+    b = client.post('/sessions', json={"shard": "runs.jsonl", "record": 3}).get_json()
+    client.post('/replace_thought', json={"doc_id": a["doc_id"], "original_index": 1, "new_thought": "A"})
+    client.post('/replace_thought', json={"doc_id": b["doc_id"], "original_index": 1, "new_thought": "B"})
+
+    # Re-encoding record 1 moves record 3 in the file
+    resp = client.post('/shards/export', json={"file": "runs.jsonl", "doc_ids": [a["doc_id"]]})
+    assert resp.status_code == 200, resp.get_json()
+    resp = client.post('/shards/export', json={"file": "runs.jsonl", "doc_ids": [b["doc_id"]]})
+    assert resp.status_code == 200, resp.get_json()
+    client.post('/replace_thought', json={"doc_id": a["doc_id"], "original_index": 2, "new_thought": "A2"})
+    resp = client.post('/shards/export', json={"file": "runs.jsonl"})
+    assert resp.status_code == 200, resp.get_json()
+    assert resp.get_json()["replaced"] == 2
+
+    exported = [json.loads(line) for line in (tmp_path / "data" / "runs.jsonl").read_text().splitlines()]
+    assert exported[0] == json.loads(lines[0]) and exported[2] == json.loads(lines[2])
+    assert [m.get("thought") for m in exported[1]["history"]][2:5:2] == ["A", "A2"]
+    assert exported[3]["history"][2]["thought"] == "B"
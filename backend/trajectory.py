@@ -0,0 +1,171 @@
+"""
+The step model of a trajectory's ``history`` list.
+
+history[1] is step 0 (the user instructions); history[2j] / history[2j+1] are
+the assistant and tool messages of step j. Step records read their fields
+straight from those messages: nothing is copied until a field is accessed, and
+the observation is located in the tool message's text by offset rather than
+split into a new string up front.
+"""
+
+from collections.abc import Sequence
+
+OBSERVATION_DELIMITER = 'OBSERVATION:\n'
+
+
+def extract_content_text(content):
+    """
+    Extract text from content field which can be either:
+    - A string: "some text"
+    - A list of objects: [{"type": "text", "text": "some text"}]
+
+    Returns the text as a string, or empty string if content is None/invalid.
+    """
+    if content is None:
+        return ""
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list) and len(content) > 0:
+        first_item = content[0]
+        if isinstance(first_item, dict):
+            return first_item.get("text", "")
+    return ""
+
+
+def num_steps(history):
+    """Number of steps in `history`: step 0 plus one per complete assistant/tool pair."""
+    if not isinstance(history, Sequence) or isinstance(history, str) or len(history) < 2:
+        return 0
+    return 1 + (len(history) - 2) // 2
+
+
+def step_indices(step_number):
+    """History indices (assistant, tool) of step `step_number` >= 1."""
+    return 2 * step_number, 2 * step_number + 1
+
+
+def history_step(history_index):
+    """The step a history index belongs to, or None for history[0]."""
+    if history_index < 1:
+        return None
+    return 0 if history_index == 1 else history_index // 2
+
+
+def pairing_errors(history, max_errors=10):
+    """
+    Why `history` cannot be edited step by step, as a list of messages (empty
+    if it can): it must be a list of message objects starting with the system
+    prompt and the user instructions, followed by an assistant message and the
+    message holding its observation for every step.
+    """
+    if not isinstance(history, list):
+        return ["history is not a list"]
+    if len(history) < 2:
+        return ["history needs a system prompt and a user message"]
+    errors = []
+    for index, message in enumerate(history):
+        if not isinstance(message, dict):
+            errors.append(f"history[{index}] is not an object")
+        elif index >= 2 and (index % 2 == 0) != (message.get('role') == 'assistant'):
+            expected = "an assistant message" if index % 2 == 0 else "the observation of the assistant message before it"
+            errors.append(f"history[{index}] should be {expected}, found role {message.get('role')!r}")
+        if len(errors) == max_errors:
+            return errors
+    if len(history) % 2:
+        errors.append(f"history[{len(history) - 1}] has no observation after it")
+    return errors[:max_errors]
+
+
+class Step:
+    """One step of a history, reading its fields lazily from the underlying messages."""
+
+    __slots__ = ("number", "assistant", "tool", "_text", "_observation_start")
+
+    def __init__(self, number, assistant, tool):
+        self.number = number
+        # Step 0 has no assistant message; `tool` is then the user message
+        self.assistant = assistant if isinstance(assistant, dict) else {}
+        self.tool = tool if isinstance(tool, dict) else {}
+        self._text = None
+        self._observation_start = None
+
+    @property
+    def text(self):
+        """The full text of the tool (or, for step 0, user) message."""
+        if self._text is None:
+            self._text = extract_content_text(self.tool.get("content"))
+        return self._text
+
+    @property
+    def thought(self):
+        return self.assistant.get('thought', '')
+
+    @property
+    def action(self):
+        return self.assistant.get('action', '')
+
+    @property
+    def observation_start(self):
+        """Offset of the observation in `text`: after the delimiter if present, else 0."""
+        if self._observation_start is None:
+            text = self.text
+            at = text.find(OBSERVATION_DELIMITER)
+            self._observation_start = 0 if at == -1 else at + len(OBSERVATION_DELIMITER)
+        return self._observation_start
+
+    @property
+    def observation(self):
+        start = self.observation_start
+        return self.text[start:] if start else self.text
+
+    def fields(self):
+        """(name, text) of the step's searchable fields, as in to_dict()."""
+        if self.number == 0:
+            return (("content", self.text),)
+        return (("thought", self.thought), ("action", self.action), ("observation", self.observation))
+
+    def to_dict(self):
+        """The step as sent to the model: {"step", "content"} for step 0, else thought/action/observation."""
+        if self.number == 0:
+            return {"step": 0, "content": self.text}
+        return {
+            "step": self.number,
+            "thought": self.thought,
+            "action": self.action,
+            "observation": self.observation,
+        }
+
+
+def get_step(history, step_number):
+    """Step `step_number` of `history`, or None if it has no such step."""
+    if not 0 <= step_number < num_steps(history):
+        return None
+    if step_number == 0:
+        return Step(0, None, history[1])
+    assistant_idx, tool_idx = step_indices(step_number)
+    return Step(step_number, history[assistant_idx], history[tool_idx])
+
+
+def iter_steps(history, start=0, stop=None):
+    """Yield the Step records of `history` from `start` up to (not including) `stop`."""
+    total = num_steps(history)
+    stop = total if stop is None else min(stop, total)
+    for step_number in range(max(start, 0), stop):
+        yield get_step(history, step_number)
+
+
+def sanitized_step(history, step_number):
+    """
+    Step `step_number` (>= 0) of `history` in build_sanitized_steps() form, or
+    None if the history has no such step.
+    """
+    step = get_step(history, step_number)
+    return step.to_dict() if step is not None else None
+
+
+def build_sanitized_steps(history):
+    """
+    Build the step list sent to the model: step 0 as {"step", "content"} and
+    every later step as {"step", "thought", "action", "observation"}.
+    """
+    return [step.to_dict() for step in iter_steps(history)]
@@ -25,14 +25,47 @@ const Chat = ({ history, onFilter }) => {
       const response = await fetch('http://localhost:5001/chat', {
         method: 'POST',
         headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({ messages: newMessages, history }),
+        body: JSON.stringify({ messages: newMessages, history, stream: true }),
       });
 
       if (!response.ok) {
         throw new Error('Network response was not ok');
       }
 
-      const data = await response.json();
+      // Read Server-Sent Events: "delta" events carry content tokens as they
+      // arrive, "done" carries the complete message (including tool calls).
+      const reader = response.body.getReader();
+      const decoder = new TextDecoder();
+      let buffer = '';
+      let streamedContent = '';
+      let data = null;
+
+      while (data === null) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+
+        let boundary;
+        while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+          const block = buffer.slice(0, boundary);
+          buffer = buffer.slice(boundary + 2);
+          const event = block.match(/^event: (.*)$/m)?.[1];
+          const payload = JSON.parse(block.match(/^data: (.*)$/m)?.[1] || 'null');
+
+          if (event === 'delta') {
+            streamedContent += payload.content;
+            setMessages([...newMessages, { role: 'assistant', content: streamedContent }]);
+          } else if (event === 'done') {
+            data = payload;
+          } else if (event === 'error') {
+            throw new Error(payload.error);
+          }
+        }
+      }
+
+      if (data === null) {
+        throw new Error('Stream ended before completion');
+      }
       
       if (data.tool_calls) {
         const toolCall = data.tool_calls[0];